@@ -21,12 +21,20 @@
     these functions.
 '''
 
+import threading
 import time
-from .TemiCommandHandle import RobotCommandHandle
-from .connect import connect    
+from contextlib import contextmanager
+from .battery_monitor import BatteryMonitor
+from .connect import connect
+from .heartbeat import HeartbeatMonitor
+from .history import RobotHistory
 from .robot import Robot
+from .telemetry import FleetTelemetry
 import yaml
-import os
+
+
+# seconds to wait for a robot to load a new map before a goal is given up
+MAP_LOAD_TIMEOUT = 30.0
 
 
 class TemiAPI:
@@ -35,35 +43,153 @@ class TemiAPI:
     # http requests. Users should modify the constructor as per the
     # requirements of their robot's API
 
-    def __init__(self, prefix: str):
-        #find yaml file in configs folder
-        with open('mqtt.yaml', "r") as stream:
-            try:
-                # parameters
-                MQTT = yaml.safe_load(stream)
-                MQTT_HOST = MQTT['HOST']
-                MQTT_PORT = MQTT['PORT']
-                MQTT_USER = MQTT['USERNAME']
-                MQTT_PASSWORD = MQTT['PASSWORD']
-                TEMI_SERIAL = MQTT['SERIAL']
-            except yaml.YAMLError as exc:
-                print(exc)
+    def __init__(self, prefix: str, mqtt_config_path: str = 'mqtt.yaml',
+                 battery_ttl: float = 60.0, history_minutes: float = 10.0,
+                 serials=None, telemetry=None, heartbeat=None, teleop=None):
+        # serials and telemetry let a worker process of a sharded fleet
+        # handle part of the robots in SERIAL and write their telemetry to
+        # shared memory, see sharding.py
+        # MQTT broker and robot parameters
+        with open(mqtt_config_path, "r") as stream:
+            MQTT = yaml.safe_load(stream)
+        MQTT_HOST = MQTT['HOST']
+        MQTT_PORT = MQTT['PORT']
+        MQTT_USER = MQTT['USERNAME']
+        MQTT_PASSWORD = MQTT['PASSWORD']
+        TEMI_SERIAL = MQTT['SERIAL'] if serials is None else serials
 
         # connect to the MQTT broker
-        mqtt_client = connect(MQTT_HOST, MQTT_PORT,MQTT_USER,MQTT_PASSWORD)
+        # optional PUBLISH section: outbound rate limits, see publisher.py
+        mqtt_client = connect(MQTT_HOST, MQTT_PORT, MQTT_USER, MQTT_PASSWORD,
+                              publish_limits=MQTT.get('PUBLISH'))
+
+        # create robot objects. SERIAL is either the serial of a single
+        # robot or a mapping from robot names in config.yaml to serials
+        if not isinstance(TEMI_SERIAL, dict):
+            TEMI_SERIAL = {TEMI_SERIAL: TEMI_SERIAL}
+        # one telemetry row per robot, written by the MQTT network thread
+        if telemetry is None:
+            telemetry = FleetTelemetry(capacity=len(TEMI_SERIAL))
+        self.telemetry = telemetry
+        # heartbeat holds the probe period and the timeout after which an
+        # unanswered robot counts as unreachable, both in seconds
+        heartbeat = heartbeat or {}
+        self.robots = {name: Robot(mqtt_client, str(serial), telemetry=self.telemetry,
+                                   history=RobotHistory(minutes=history_minutes),
+                                   heartbeat_timeout=heartbeat.get('timeout', 3.0),
+                                   teleop=teleop)
+                       for name, serial in TEMI_SERIAL.items()}
+        self.robot = next(iter(self.robots.values()))
+        # snapshot of the update tick, only seen by the thread that took it
+        self._tick = threading.local()
+
+        # keep the cached battery state of every robot fresh
+        self.battery_monitor = BatteryMonitor(self.robots, ttl=battery_ttl)
+        self.battery_monitor.start()
+
+        # probe every robot to measure round trip times and spot lost robots
+        self.heartbeat_monitor = HeartbeatMonitor(
+            self.robots, period=heartbeat.get('period', 1.0))
+        self.heartbeat_monitor.start()
+
+    def _robot(self, robot_name: str):
+        """
+        Return the Robot for robot_name, or None if it is not configured.
+        With a single SERIAL every robot name refers to that robot.
+        """
+        if len(self.robots) == 1:
+            return self.robot
+        return self.robots.get(robot_name)
+
+    @contextmanager
+    def snapshot(self):
+        """
+        Read the telemetry of all robots at once. Inside the with block,
+        getPosition, position_stamp and battery_soc answer from this
+        snapshot instead of reading each robot separately. Only the
+        calling thread sees the snapshot, other threads keep reading live
+        telemetry.
+        """
+        self._tick.snapshot = self.telemetry.snapshot()
+        try:
+            yield
+        finally:
+            self._tick.snapshot = None
+
+    def _read(self, robot, *names):
+        snapshot = getattr(self._tick, 'snapshot', None)
+        if snapshot is None or robot.row >= len(snapshot[names[0]]):
+            return self.telemetry.read(robot.row, *names)
+        return [snapshot[name][robot.row].item() for name in names]
+
+    def history(self, robot_name: str):
+        """
+        Return the RobotHistory of the robot, or None if it is not
+        configured
+        """
+        robot = self._robot(robot_name)
+        return None if robot is None else robot.history
 
-        # create robot object
-        self.robot = Robot(mqtt_client, TEMI_SERIAL)
+    def dump_history(self, robot_name: str, path: str):
+        """
+        Write the recent history of the robot to path as a .npz file.
+        Return True if it was written, else False
+        """
+        try:
+            self._robot(robot_name).history.dump(path)
+            return True
+        except Exception as e:
+            print(f"An error has occurred when dumping robot history: {e}")
+            return False
+
+    def wait_until_ready(self, robot_name: str, timeout=None):
+        """
+        Block until the robot has reported its position and battery state.
+        Return True if it is ready, False if the timeout expired.
+        """
+        robot = self._robot(robot_name)
+        if robot is None:
+            print(f"No serial configured for robot {robot_name}")
+            time.sleep(timeout or 0.0)
+            return False
+        return robot.wait_until_ready(timeout)
+
+    def clock(self):
+        """
+        Return the current time on the clock of all stamps this API
+        reports, time.monotonic()
+        """
+        return time.monotonic()
+
+    def shutdown(self):
+        """
+        Stop the background battery refresh and heartbeat probes
+        """
+        self.battery_monitor.stop()
+        self.heartbeat_monitor.stop()
 
     def check_connection(self):
         """
-        Return True if connection to the robot API server is successful
+        Return True if every robot has answered a heartbeat probe recently
         """
+        return all(robot.link.alive() for robot in self.robots.values())
 
-        self.robot.tts(text='Hello!')
-        time.sleep(0.1)
+    def is_reachable(self, robot_name: str):
+        """
+        Return True if the robot has answered a heartbeat probe within the
+        heartbeat timeout
+        """
+        robot = self._robot(robot_name)
+        return robot is not None and robot.link.alive()
 
-        return True
+    def connection_health(self, robot_name: str):
+        """
+        Return the heartbeat statistics of the robot: alive, smoothed rtt
+        and jitter in seconds, age of the last answer, probes sent and lost.
+        None if the robot is not configured
+        """
+        robot = self._robot(robot_name)
+        return None if robot is None else robot.link.stats()
 
     def getPosition(self, robot_name: str):
         """
@@ -71,47 +197,245 @@ class TemiAPI:
             None if any errors are encountered
         """
         try:
-            return list(self.robot.currentPosition.values())[:3]
+            robot = self._robot(robot_name)
+            if not robot.ready:
+                return None
+            return self._read(robot, 'x', 'y', 'yaw')
 
         except Exception as e:
             print(f"An error has occurred when getting robot position: {e}")
             return None
 
+    def position_stamp(self, robot_name: str):
+        """
+        Return the time.monotonic() time at which the position returned by
+        getPosition was received, or None if it is not known
+        """
+        robot = self._robot(robot_name)
+        if robot is None:
+            return None
+        stamp, = self._read(robot, 'position_stamp')
+        return None if stamp != stamp else stamp
+
+    def position_trace(self, robot_name: str):
+        """
+        Return the time.monotonic() stamps at which the current position was
+        received, parsed and stored, or None if they are not known
+        """
+        robot = self._robot(robot_name)
+        if robot is None:
+            return None
+        stamps = self._read(
+            robot, 'position_received', 'position_parsed', 'position_stamp')
+        return None if any(s != s for s in stamps) else stamps
+
     def navigate(self, robot_name: str, pose, map_name: str):
         """
         Request the robot to navigate to pose:[x,y,theta] where x, y and
-        theta are in the robot's coordinate convention. This function
-        should return True if the robot has accepted the request,
-        else False
+        theta are in the robot's coordinate convention. The robot first
+        loads map_name if it is on another map. This function should return
+        True if the robot has acknowledged the request, else False, also if
+        a newer goal replaced it before it was sent
         """
         try:
-            self.robot.goToPosition(x=pose[0], y=pose[1], yaw=pose[2], tiltAngle=22)
-            time.sleep(2)
-            return True
+            robot = self._robot(robot_name)
+            if map_name and not robot.maps.ensure(map_name, MAP_LOAD_TIMEOUT):
+                print(f"Robot {robot_name} could not load map {map_name}")
+                return False
+            result = robot.goToPosition(
+                x=pose[0], y=pose[1], yaw=pose[2], tiltAngle=22)
+            return result is True
         except Exception as e:
             print(f"An error has occurred during navigation: {e}")
             return False
 
+    def saved_location(self, robot_name: str, waypoint_name: str):
+        """
+        Return the name of the location saved on the robot that matches the
+        RMF waypoint waypoint_name, or None if there is none
+        """
+        robot = self._robot(robot_name)
+        return None if robot is None else robot.location_index.lookup(waypoint_name)
+
+    def navigate_to_location(self, robot_name: str, location: str, map_name=None):
+        """
+        Request the robot to navigate to one of its saved locations on
+        map_name, using its own planner for the whole way. This function
+        should return True if the robot has acknowledged the request, else
+        False, also if a newer goal replaced it before it was sent
+        """
+        try:
+            robot = self._robot(robot_name)
+            if map_name and not robot.maps.ensure(map_name, MAP_LOAD_TIMEOUT):
+                print(f"Robot {robot_name} could not load map {map_name}")
+                return False
+            result = robot.goToLocation(location)
+            return result is True
+        except Exception as e:
+            print(f"An error has occurred during navigation to {location}: {e}")
+            return False
+
+    def prepare_map(self, robot_name: str, map_name: str, pose=None):
+        """
+        Start loading map_name on the robot in the background if it is on
+        another map, e.g. while it rides the lift to that level. pose is
+        [x, y, theta] on the new map where the robot will be once it
+        arrives, e.g. the lift, in the robot's coordinate convention. The
+        next navigate to map_name waits for the load to finish
+        """
+        robot = self._robot(robot_name)
+        if robot is not None:
+            robot.maps.prefetch(map_name, pose)
+
+    def map_stats(self, robot_name: str):
+        """
+        Return the map loading statistics of the robot: current map, loads,
+        skipped loads, failures, load latencies and the time goals were held
+        up by loads, in seconds. None if the robot is not configured
+        """
+        robot = self._robot(robot_name)
+        return None if robot is None else robot.maps.stats()
+
+    def teleop(self, robot_name: str, x=None, y=None, rotate=None, tilt=None):
+        """
+        Stream manual driving commands: hold the joystick at x, y until the
+        next call, turn by rotate degrees and tilt the head to tilt degrees.
+        Only the latest setpoints are sent, at the teleop period. Return
+        True if the robot is configured, else False
+        """
+        robot = self._robot(robot_name)
+        if robot is None:
+            return False
+        if x is not None or y is not None:
+            robot.teleop.joystick(x or 0.0, y or 0.0)
+        if rotate is not None:
+            robot.teleop.rotate(rotate)
+        if tilt is not None:
+            robot.teleop.tilt(tilt)
+        return True
+
+    def teleop_release(self, robot_name: str):
+        """
+        Let go of the joystick, the robot is sent a zero command
+        """
+        robot = self._robot(robot_name)
+        if robot is not None:
+            robot.teleop.release()
+
+    def teleop_stats(self, robot_name: str):
+        """
+        Return the teleop streaming statistics of the robot: setpoints
+        submitted, messages sent, setpoints replaced before being sent,
+        deadman stops and the lag from setpoint to message, in seconds.
+        None if the robot is not configured
+        """
+        robot = self._robot(robot_name)
+        return None if robot is None else robot.teleop.stats()
+
     def stop(self, robot_name: str):
         """
         Command the robot to stop.
-        Return True if robot has successfully stopped. Else False
+        Return True once the robot has acknowledged the stop, else False
         """
         try:
-            self.robot.stop()
-            time.sleep(1)
-            return True
+            return self._robot(robot_name).stop() is True
         except Exception as e:
             print(f"An error has occurred when stopping robot movement: {e}")
             return False
 
+    def dock(self, robot_name: str):
+        """
+        Send the robot to its home base to charge.
+        Return True if the request was sent, else False
+        """
+        try:
+            robot = self._robot(robot_name)
+            robot.goToLocation(robot.HOME_BASE)
+            return True
+        except Exception as e:
+            print(f"An error has occurred when docking robot: {e}")
+            return False
+
+    def request_battery(self, robot_name: str):
+        """
+        Ask the robot for its battery state without waiting for the reply
+        """
+        try:
+            self._robot(robot_name).getBatteryData(wait=False)
+        except Exception as e:
+            print(f"An error has occurred when requesting battery data: {e}")
+
+    def has_active_goal(self, robot_name: str):
+        """
+        Return True if the robot may still be moving towards a goal, i.e.
+        it has not reported that its last goal completed or was aborted
+        """
+        try:
+            robot = self._robot(robot_name)
+            return robot.status not in (robot.GOTO_COMPLETE, robot.GOTO_ABORT)
+        except Exception as e:
+            print(f"An error has occurred when getting the goto status: {e}")
+            return True
+
+    def request_position(self, robot_name: str):
+        """
+        Ask the robot for its position without waiting for the reply
+        """
+        try:
+            self._robot(robot_name).getCurrentPosition(wait=False)
+        except Exception as e:
+            print(f"An error has occurred when requesting the position: {e}")
+
+    def goto_status(self, robot_name: str):
+        """
+        Return (status, location) of the robot's last goto, e.g.
+        ("going", "home base"), or None if any errors are encountered
+        """
+        try:
+            robot = self._robot(robot_name)
+            return robot.status, robot.currentLocation
+        except Exception as e:
+            print(f"An error has occurred when getting the goto status: {e}")
+            return None
+
+    def add_goto_listener(self, robot_name: str, callback):
+        """
+        Call callback(status, location) whenever the robot reports on its
+        goto, e.g. ("abort", "COORDINATES"). The callback runs on the MQTT
+        network thread and must return quickly
+        """
+        self._robot(robot_name).goto_listeners.append(callback)
+
+    def publish_stats(self):
+        """
+        Outbound queue statistics of every priority class, see
+        PublishScheduler.stats
+        """
+        return self.robot.client.publisher.stats()
+
+    def telemetry_version(self, robot_name: str):
+        """
+        Return a number that changes whenever new telemetry is received
+        from the robot. Pass it to wait_for_update
+        """
+        robot = self._robot(robot_name)
+        return robot.telemetry.version(robot.row)
+
+    def wait_for_update(self, robot_name: str, version, timeout=None):
+        """
+        Block until the robot's telemetry changes from version or the
+        timeout expires. Return True if it changed
+        """
+        robot = self._robot(robot_name)
+        return robot.telemetry.wait_for_change(robot.row, version, timeout)
+
     def docking_completed(self, robot_name: str):
         """
         Check if robot reached home base.
         Return True if robot has successfully docked. Else False
         """
         try:
-            return self.robot.checkIfDockingCompleted()
+            return self._robot(robot_name).checkIfDockingCompleted()
         except Exception as e:
             print(f"An error has occurred when stopping robot movement: {e}")
             return False
@@ -122,7 +446,7 @@ class TemiAPI:
         destination
         """
         try:
-            return float(self.robot.durationToDestination.get('duration', 0.0))
+            return float(self._robot(robot_name).durationToDestination.get('duration', 0.0))
         except Exception as e:
             print(f"An error has occurred when retrieving remaining robot duration: {e}")
 
@@ -132,7 +456,7 @@ class TemiAPI:
         navigation request. Else False.
         """
         try:
-            return self.robot.navigationCompleted()
+            return self._robot(robot_name).navigationCompleted()
 
         except Exception as e:
             print(f"An error has occurred when checking : {e}")
@@ -161,11 +485,23 @@ class TemiAPI:
     def battery_soc(self, robot_name: str):
         """
         Return the state of charge of the robot as a value between 0.0
-        and 1.0. Else return None if any errors are encountered
+        and 1.0. Else return None if any errors are encountered or no
+        battery state has been received yet
         """
         try:
-            return self.robot.battery['percentage']
+            soc, = self._read(self._robot(robot_name), 'soc')
+            return None if soc != soc else soc
 
         except Exception as e:
             print(f"An error has occurred when obtaining the battery level: {e}")
             return None
+
+    def battery_age(self, robot_name: str):
+        """
+        Return the number of seconds since the state of charge returned by
+        battery_soc was received, or None if it is not known
+        """
+        robot = self._robot(robot_name)
+        if robot is None:
+            return None
+        return robot.batteryAge
@@ -11,26 +11,30 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import asyncio
-
 from rclpy.duration import Duration
 
 import rmf_adapter as adpt
-import rmf_adapter.plan as plan
-import rmf_adapter.schedule as schedule
-
-from rmf_fleet_msgs.msg import DockSummary
 
 import numpy as np
 
-import threading
 import math
 import copy
 import enum
+import threading
 import time
 
+from collections import namedtuple
 from datetime import timedelta
 
+from .compiled_path import CompiledPath, time_seconds
+from .eta import ArrivalEstimator
+from .motion_model import PoseExtrapolator
+from .profiling import TimedLock
+from .tasks import TaskRunner
+from .tracing import LatencyTracer
+from .update_filter import UpdateFilter
+from .watchdog import NavigationWatchdog, Verdict
+
 
 # States for RobotCommandHandle's state machine used when guiding robot along
 # a new path
@@ -40,6 +44,25 @@ class RobotState(enum.IntEnum):
     MOVING = 2
 
 
+# Where the robot is in the navigation graph. Instances are never modified;
+# a new snapshot is swapped in whenever a field changes so that readers such
+# as update_state() never need to take a lock.
+TrackingState = namedtuple(
+    'TrackingState',
+    [
+        # if robot is waiting at a waypoint. This is a Graph::Waypoint index
+        'on_waypoint',
+        # if robot is travelling on a lane. This is a Graph::Lane index
+        'on_lane',
+        # this is a Plan::Waypoint
+        'target_waypoint',
+        # The graph index of the waypoint the robot is currently docking into
+        'dock_waypoint_index',
+        'last_known_lane_index',
+        'last_known_waypoint_index'],
+    defaults=(None,) * 6)
+
+
 class RobotCommandHandle(adpt.RobotCommandHandle):
     def __init__(self,
                  name,
@@ -55,7 +78,11 @@ class RobotCommandHandle(adpt.RobotCommandHandle):
                  charger_waypoint,
                  update_frequency,
                  adapter,
-                 api):
+                 api,
+                 task_runner=None,
+                 eta=None,
+                 update_timer=True,
+                 tracer=None):
         adpt.RobotCommandHandle.__init__(self)
         self.name = name
         self.fleet_name = fleet_name
@@ -74,7 +101,13 @@ class RobotCommandHandle(adpt.RobotCommandHandle):
         self.update_frequency = update_frequency
         self.update_handle = None  # RobotUpdateHandle
         self.battery_soc = 1.0
+        # Whether the robot answers heartbeats, None until first checked
+        self.reachable = None
         self.api = api
+        # Clock of the stamps the API reports, time.monotonic() for real
+        # robots and simulated time in a simulation. Timeouts, extrapolation
+        # and filters run on it too
+        self.clock = api.clock
         self.position = position  # (x,y,theta) in RMF coordinates (meters, radians)
         self.initialized = False
         self.state = RobotState.IDLE
@@ -82,29 +115,74 @@ class RobotCommandHandle(adpt.RobotCommandHandle):
         self.adapter = adapter
 
         self.requested_waypoints = []  # RMF Plan waypoints
-        self.remaining_waypoints = []
+        # The path being followed, compiled once when it arrives
+        self.path = None
+        # Row of self.path the robot is heading to, and the next row to send
+        self.path_row = None
+        self.next_row = 0
         self.path_finished_callback = None
         self.next_arrival_estimator = None
         self.path_index = 0
         self.docking_finished_callback = None
 
+        # Arrival estimates come from the vehicle limits and path geometry
+        # rather than the duration last reported by the robot
+        if eta is None:
+            eta = ArrivalEstimator(
+                [vehicle_traits.linear.nominal_velocity,
+                 vehicle_traits.linear.nominal_acceleration],
+                [vehicle_traits.rotational.nominal_velocity,
+                 vehicle_traits.rotational.nominal_acceleration])
+        self.eta = eta
+        # Fills in the pose between the robot's position messages
+        self.motion_model = PoseExtrapolator(
+            self.eta.linear_velocity,
+            self.eta.angular_velocity,
+            horizon=self.config.get('extrapolation_horizon', 1.0))
+        self._position_stamp = None
+        # Only forwards updates to RMF that carry new information
+        self.update_filter = UpdateFilter(
+            **self.config.get('state_publishing', {}), clock=self.clock)
+        # Latency of positions from the MQTT client to RMF, may be shared
+        # by the fleet. _trace holds the stage stamps of a fresh position
+        # until it is sent to RMF
+        self.tracer = LatencyTracer() if tracer is None else tracer
+        self._trace = None
+
+        # Abort and obstacle goto events are pushed here by the MQTT thread
+        # so that the path task can react without waiting for max_delay
+        self.goto_retries = self.config.get('goto_retries', 2)
+        # A path waits this long for an unreachable robot before RMF is
+        # asked to replan
+        self.unreachable_timeout = self.config.get('unreachable_timeout', 30.0)
+        self._goto_failure = None
+        self._goto_failed = threading.Event()
+        self._goto_failure_lock = threading.Lock()
+        self.api.add_goto_listener(self.name, self._on_goto_event)
+        # Catches goals whose completion was never reported and robots that
+        # stopped making progress
+        self.watchdog = NavigationWatchdog(
+            **self.config.get('navigation_watchdog', {}), clock=self.clock)
+        # Goals at locations saved on the robot are sent by name
+        saved_locations = self.config.get('saved_locations', {})
+        self.use_saved_locations = saved_locations.get('enabled', True)
+        self.saved_locations_final_only = saved_locations.get('final_only', True)
+        self.location_aliases = saved_locations.get('aliases') or {}
+        # RMF level names -> names of the maps saved on the robot
+        self.robot_maps = self.config.get('maps') or {}
+
         # RMF location trackers
-        self.last_known_lane_index = None
-        self.last_known_waypoint_index = None
-        # if robot is waiting at a waypoint. This is a Graph::Waypoint index
-        self.on_waypoint = None
-        # if robot is travelling on a lane. This is a Graph::Lane index
-        self.on_lane = None
-        self.target_waypoint = None  # this is a Plan::Waypoint
-        # The graph index of the waypoint the robot is currently docking into
-        self.dock_waypoint_index = None
+        self.tracking = TrackingState()
 
         # Threading variables
-        self._lock = threading.Lock()
-        self._follow_path_thread = None
-        self._quit_path_event = threading.Event()
-        self._dock_thread = None
-        self._quit_dock_event = threading.Event()
+        self._lock = TimedLock()
+        # Only held to swap in a new TrackingState, never around I/O
+        self._tracking_lock = TimedLock()
+        # Path, dock and stop tasks run on the robot's own worker of the
+        # fleet's TaskRunner. A robot has at most one active task at a time.
+        if task_runner is None:
+            task_runner = TaskRunner()
+        self.task_runner = task_runner
 
         self.node.get_logger().info(
             f"The robot is starting at: [{self.position[0]:.2f}, "
@@ -112,47 +190,119 @@ class RobotCommandHandle(adpt.RobotCommandHandle):
 
         # Update tracking variables
         if start.lane is not None:  # If the robot is on a lane
-            self.last_known_lane_index = start.lane
-            self.on_lane = start.lane
-            self.last_known_waypoint_index = start.waypoint
+            self.update_tracking(
+                last_known_lane_index=start.lane,
+                on_lane=start.lane,
+                last_known_waypoint_index=start.waypoint)
         else:  # Otherwise, the robot is on a waypoint
-            self.last_known_waypoint_index = start.waypoint
-            self.on_waypoint = start.waypoint
+            self.update_tracking(
+                last_known_waypoint_index=start.waypoint,
+                on_waypoint=start.waypoint)
 
-        self.state_update_timer = self.node.create_timer(
-            1.0 / self.update_frequency,
-            self.update)
+        # Without a timer, update() is driven by the fleet's update tick
+        self.state_update_timer = None
+        if update_timer:
+            self.state_update_timer = self.node.create_timer(
+                1.0 / self.update_frequency,
+                self.update)
 
         self.initialized = True
 
-    def sleep_for(self, seconds):
+    def update_tracking(self, **changes):
+        ''' Atomically replace the tracking snapshot with one where the given
+            fields are changed. Returns the new snapshot.'''
+        with self._tracking_lock:
+            self.tracking = self.tracking._replace(**changes)
+            return self.tracking
+
+    def update_stats(self):
+        ''' Updates sent to RMF and suppressed as unchanged, by kind'''
+        return self.update_filter.stats()
+
+    def lock_stats(self):
+        ''' Contention statistics for the locks of this command handle'''
+        return {
+            'lock': self._lock.stats(),
+            'tracking_lock': self._tracking_lock.stats()}
+
+    def sleep_for(self, seconds, token=None, wake=None):
+        # Returns early if the token is cancelled or the wake event is set
         goal_time = \
             self.node.get_clock().now() + Duration(nanoseconds=1e9 * seconds)
         while self.node.get_clock().now() <= goal_time:
+            if token is not None and token.cancelled:
+                return
+            if wake is not None and wake.is_set():
+                return
             time.sleep(0.001)
 
+    def _on_goto_event(self, status, location):
+        # Runs on the MQTT network thread
+        if status in ("abort", "obstacle detected"):
+            with self._goto_failure_lock:
+                self._goto_failure = status
+                self._goto_failed.set()
+
+    def _take_goto_failure(self):
+        ''' The failure reported since the last call, or None'''
+        with self._goto_failure_lock:
+            failure = self._goto_failure
+            self._goto_failure = None
+            self._goto_failed.clear()
+            return failure
+
+    def _report_interruption(self, reason):
+        # The robot gave up on its goal; ask RMF for a new plan right away
+        self.node.get_logger().error(
+            f"Robot {self.name} could not reach its target waypoint "
+            f"({reason}), requesting a replan")
+        self.clear()
+        if self.update_handle is not None:
+            self.update_handle.replan()
+
+    def _report_dock_failure(self, reason):
+        # Stop reporting the robot as docking and let RMF plan around it
+        self.node.get_logger().error(
+            f"Robot {self.name} {reason}, giving up docking and requesting "
+            f"a replan")
+        self.update_tracking(dock_waypoint_index=None)
+        self.clear()
+        if self.update_handle is not None:
+            self.update_handle.replan()
+
     def clear(self):
         with self._lock:
             self.requested_waypoints = []
-            self.remaining_waypoints = []
+            self.path = None
+            self.path_row = None
+            self.next_row = 0
             self.path_finished_callback = None
             self.next_arrival_estimator = None
             self.docking_finished_callback = None
             self.state = RobotState.IDLE
+        # Estimates for the next path go to a new estimator, whatever was
+        # sent to this one
+        self.update_filter.reset('arrival')
 
     def stop(self):
-        # Stop the robot. Tracking variables should remain unchanged.
-        while True:
+        # Cancel whatever the robot is doing and stop it in the background.
+        # Tracking variables should remain unchanged.
+        self.task_runner.replace(self.name, self._stop_robot)
+
+    def _stop_robot(self, token):
+        # Returns False if a newer task took over before the robot stopped
+        if self.state == RobotState.IDLE and \
+                not self.api.has_active_goal(self.name):
+            # Nothing to stop, don't delay the next command
+            self.clear()
+            return True
+        while not token.cancelled:
             self.node.get_logger().info("Requesting robot to stop...")
             if self.api.stop(self.name):
-                break
-            self.sleep_for(0.1)
-        if self._follow_path_thread is not None:
-            self._quit_path_event.set()
-            if self._follow_path_thread.is_alive():
-                self._follow_path_thread.join()
-            self._follow_path_thread = None
-            self.clear()
+                self.clear()
+                return True
+            self.sleep_for(0.1, token)
+        return False
 
     def follow_new_path(
             self,
@@ -160,128 +310,254 @@ class RobotCommandHandle(adpt.RobotCommandHandle):
             next_arrival_estimator,
             path_finished_callback):
 
-        self.stop()
-        self._quit_path_event.clear()
-
         self.node.get_logger().info("Received new path to follow...")
         self.node.get_logger().info("Waypoints in new path:" + "".join(str(w) for w in waypoints))
 
-        self.remaining_waypoints = self.get_remaining_waypoints(waypoints)
+        path = self.compile_path(self.get_remaining_waypoints(waypoints))
         assert next_arrival_estimator is not None
         assert path_finished_callback is not None
-        self.next_arrival_estimator = next_arrival_estimator
-        self.path_finished_callback = path_finished_callback
 
-        def _follow_path():
+        def _follow_path(token):
+            # The previous task has returned by now; stop the robot before
+            # taking over the path state
+            if not self._stop_robot(token):
+                return
+            # A path that starts on another level arrives when the lift
+            # does. Loading a map resets the robot's pose, so only start
+            # once nothing drives on the current level anymore
+            self.prepare_level(path, 0)
+            with self._lock:
+                self.path = path
+                self.path_row = None
+                self.next_row = 0
+                self.next_arrival_estimator = next_arrival_estimator
+                self.path_finished_callback = path_finished_callback
+
+            row = None
             target_pose = []
+            goal = []
+            attempts = 0
+            unreachable_since = None
             while (
-                    self.remaining_waypoints or
+                    self.next_row < len(path) or
                     self.state == RobotState.MOVING or
                     self.state == RobotState.WAITING):
-            # while self.remaining_waypoints:
                 # Check if we need to abort
-                if self._quit_path_event.is_set():
+                if token.cancelled:
                     self.node.get_logger().info("Aborting previously followed path")
                     self.node.get_logger().info(
-                        "Remaining waypoints" + "".join(str(w) for w in self.remaining_waypoints))
+                        "Remaining waypoints" + "".join(
+                            str(w) for w in path.waypoints[self.next_row:]))
                     return
                 # State machine
                 if self.state == RobotState.IDLE:
                     # Assign the next waypoint
-                    self.target_waypoint = self.remaining_waypoints[0][1]
-                    self.path_index = self.remaining_waypoints[0][0]
+                    row = self.next_row
+                    target_waypoint = path.waypoints[row]
+                    self.update_tracking(target_waypoint=target_waypoint)
+                    self.path_row = row
+                    self.path_index = int(path.path_indices[row])
                     # Move robot to next waypoint
-                    target_pose = self.target_waypoint.position
-                    [x, y] = self.transforms["rmf_to_robot"].transform(
-                        target_pose[:2])
-                    theta = target_pose[2] + \
-                            self.transforms['orientation_offset']
-                    print('theta=================', theta)
-                    response = self.api.navigate(self.name,
-                                                 [x, y, theta],
-                                                 self.map_name)
+                    target_pose = path.position(row)
+                    [x, y, theta] = path.goal(row)
+                    level = path.level_change(row, self.map_name)
+                    if level is not None:
+                        # Does nothing if the map is already being loaded
+                        self.prepare_level(path, row, log=False)
+                        self.node.get_logger().info(
+                            f"Robot {self.name} is changing level from "
+                            f"{self.map_name} to {level}")
+                        self.map_name = level
+                    if not self.api.is_reachable(self.name):
+                        # Don't send goals into the void, wait for the
+                        # robot to answer again, but not forever
+                        if unreachable_since is None:
+                            unreachable_since = self.clock()
+                        elif self.clock() - unreachable_since > \
+                                self.unreachable_timeout:
+                            self._report_interruption(
+                                f"not reachable for "
+                                f"{self.unreachable_timeout:.0f}s")
+                            return
+                        self.sleep_for(0.1, token)
+                        continue
+                    unreachable_since = None
+                    self._take_goto_failure()
+                    # The robot's own planner does the final approach to
+                    # its saved locations
+                    goal = self.saved_location(path, row)
+                    if goal is None:
+                        goal = [x, y, theta]
+                    else:
+                        self.node.get_logger().info(
+                            f"Sending robot {self.name} to its saved location "
+                            f"'{goal}' for waypoint {path.names[row]}")
+                    response = self._send_goal(goal)
 
                     if response:
-                        self.remaining_waypoints = self.remaining_waypoints[1:]
+                        self.next_row = row + 1
                         self.state = RobotState.MOVING
+                        attempts = 0
+                        self.watchdog.start(
+                            self.eta.time_to(self.position, target_pose))
                     else:
                         self.node.get_logger().info(
                             f"Robot {self.name} failed to navigate to "
                             f"[{x:.0f}, {y:.0f}, {theta:.0f}] coordinates. "
                             f"Retrying...")
-                        self.sleep_for(0.1)
+                        self.sleep_for(0.1, token)
 
                 elif self.state == RobotState.WAITING:
-                    self.sleep_for(0.1)
-                    time_now = self.adapter.now()
-                    with self._lock:
-                        if self.target_waypoint is not None:
-                            waypoint_wait_time = self.target_waypoint.time
-                            if waypoint_wait_time < time_now:
-                                self.state = RobotState.IDLE
-                            else:
-                                if self.path_index is not None:
-                                    self.node.get_logger().info(
-                                        f"Waiting for "
-                                        f"{(waypoint_wait_time - time_now).seconds}s")
-                                    self.next_arrival_estimator(
-                                        self.path_index, timedelta(seconds=0.0))
+                    self.sleep_for(0.1, token)
+                    if token.cancelled:
+                        continue
+                    wait = path.deadlines[row] - time_seconds(self.adapter.now())
+                    if wait < 0.0:
+                        self.state = RobotState.IDLE
+                    elif self.path_index is not None:
+                        self.node.get_logger().info(
+                            f"Waiting for {int(wait)}s")
+                        self.estimate_arrival(self.path_index, 0.0)
 
                 elif self.state == RobotState.MOVING:
-                    self.sleep_for(0.1)
+                    self.sleep_for(0.1, token, wake=self._goto_failed)
+                    if token.cancelled:
+                        continue
+                    failure = self._take_goto_failure()
+                    if failure is not None:
+                        if attempts >= self.goto_retries:
+                            self._report_interruption(failure)
+                            return
+                        attempts += 1
+                        self.node.get_logger().warn(
+                            f"Robot {self.name} reported {failure}, resending "
+                            f"its goal (attempt {attempts} of "
+                            f"{self.goto_retries})")
+                        self._send_goal(goal)
+                        self.watchdog.start(
+                            self.eta.time_to(self.position, target_pose))
+                        continue
+                    # Query the robot without holding any lock, then publish
+                    # the outcome as a new tracking snapshot
+                    tracking = self.tracking
                     # Check if we have reached the target
-                    with self._lock:
-                        if self.api.navigation_completed(self.name):
-                            self.node.get_logger().info(
-                                f"Robot [{self.name}] has reached its target "
-                                f"waypoint")
-                            self.state = RobotState.WAITING
-                            if self.target_waypoint.graph_index is not None:
-                                self.on_waypoint = \
-                                    self.target_waypoint.graph_index
-                                self.last_known_waypoint_index = \
-                                    self.on_waypoint
-                            else:
-                                self.on_waypoint = None  # still on a lane
+                    completed = self.api.navigation_completed(self.name)
+                    if not completed:
+                        verdict = self.watchdog.check(
+                            self.dist(self.get_position(), target_pose),
+                            self.api.position_stamp(self.name),
+                            self.api.navigation_remaining_duration(self.name))
+                        if verdict == Verdict.ARRIVED:
+                            self.node.get_logger().warn(
+                                f"Robot {self.name} is at its target but "
+                                f"never reported the goal as complete")
+                            completed = True
+                        elif verdict != Verdict.OK:
+                            reason = verdict.name.lower()
+                            if attempts >= self.goto_retries:
+                                self._report_interruption(reason)
+                                return
+                            attempts += 1
+                            self.node.get_logger().warn(
+                                f"Robot {self.name} is {reason} after "
+                                f"{self.watchdog.elapsed():.0f}s, resending "
+                                f"its goal (attempt {attempts} of "
+                                f"{self.goto_retries})")
+                            # A fresh position shows whether it has moved
+                            self.api.request_position(self.name)
+                            self._send_goal(goal)
+                            self.watchdog.start(
+                                self.eta.time_to(self.position, target_pose))
+                            continue
+                    graph_index = path.graph_index(row)
+                    if completed:
+                        self.node.get_logger().info(
+                            f"Robot [{self.name}] has reached its target "
+                            f"waypoint")
+                        if row + 1 < len(path):
+                            # e.g. inside the lift, load the next level's
+                            # map during the ride
+                            self.prepare_level(path, row + 1)
+                        if graph_index is not None:
+                            self.update_tracking(
+                                on_waypoint=graph_index,
+                                last_known_waypoint_index=graph_index)
                         else:
-                            # Update the lane the robot is on
-                            lane = self.get_current_lane()
-                            if lane is not None:
-                                self.on_waypoint = None
-                                self.on_lane = lane
+                            self.update_tracking(on_waypoint=None)  # still on a lane
+                        self.state = RobotState.WAITING
+                    else:
+                        # Update the lane the robot is on
+                        lane = self.get_current_lane()
+                        if lane is not None:
+                            self.update_tracking(on_waypoint=None, on_lane=lane)
+                        else:
+                            # The robot may either be on the previous
+                            # waypoint or the target one
+                            if graph_index is not None and \
+                                    self.dist(self.position, target_pose) < 0.5:
+                                self.update_tracking(on_waypoint=graph_index)
+                            elif tracking.last_known_waypoint_index is not \
+                                    None and self.dist(
+                                self.position, self.graph.get_waypoint(
+                                    tracking.last_known_waypoint_index).location) < 0.5:
+                                self.update_tracking(
+                                    on_waypoint=tracking.last_known_waypoint_index)
                             else:
-                                # The robot may either be on the previous
-                                # waypoint or the target one
-                                if self.target_waypoint.graph_index is not \
-                                        None and self.dist(self.position, target_pose) < 0.5:
-                                    self.on_waypoint = self.target_waypoint.graph_index
-                                elif self.last_known_waypoint_index is not \
-                                        None and self.dist(
-                                    self.position, self.graph.get_waypoint(
-                                        self.last_known_waypoint_index).location) < 0.5:
-                                    self.on_waypoint = self.last_known_waypoint_index
-                                else:
-                                    self.on_lane = None  # update_off_grid()
-                                    self.on_waypoint = None
-                        duration = self.api.navigation_remaining_duration(self.name)
-                        if self.path_index is not None:
-                            self.next_arrival_estimator(
-                                self.path_index, timedelta(seconds=duration))
+                                # update_off_grid()
+                                self.update_tracking(on_lane=None, on_waypoint=None)
+                    duration = self.eta.time_to(self.position, target_pose)
+                    if self.path_index is not None:
+                        self.estimate_arrival(self.path_index, duration)
             self.path_finished_callback()
 
             self.node.get_logger().info(
                 f"Robot {self.name} has successfully navigated along "
                 f"requested path.")
 
-        # self._quit_path_event.clear()
-        #
-        # if self._follow_path_thread is not None:
-        #     self._follow_path_thread.join()
+        # Returns immediately; the previous path or dock task is cancelled
+        # and this one starts as soon as it has wound down
+        self.task_runner.replace(self.name, _follow_path)
 
-        self._follow_path_thread = threading.Thread(
-            target=_follow_path)
-
-        self._follow_path_thread.start()
+    def saved_location(self, path, row):
+        '''
+        Name of the location saved on the robot for row of path, or None if
+        the goal should be sent as coordinates
+        '''
+        if not self.use_saved_locations:
+            return None
+        if self.saved_locations_final_only and row != len(path) - 1:
+            return None
+        name = path.names[row]
+        if name is None:
+            return None
+        return self.api.saved_location(
+            self.name, self.location_aliases.get(name, name))
+
+    def robot_map(self, level):
+        ''' Name of the map saved on the robot for an RMF level'''
+        return self.robot_maps.get(level, level)
+
+    def prepare_level(self, path, row, log=True):
+        ''' Start loading the map of row if it is on another level. The
+            robot is placed at the goal of row, the first waypoint on the new
+            level, e.g. the lift'''
+        level = path.level_change(row, self.map_name)
+        if level is None:
+            return
+        if log:
+            self.node.get_logger().info(
+                f"Robot {self.name} will change level to {level}, "
+                f"loading its map")
+        self.api.prepare_map(self.name, self.robot_map(level), path.goal(row))
+
+    def _send_goal(self, goal):
+        # goal is either a saved location name or [x, y, theta] in the
+        # robot frame. The robot loads the map first if it changed level
+        if isinstance(goal, str):
+            return self.api.navigate_to_location(
+                self.name, goal, self.robot_map(self.map_name))
+        return self.api.navigate(
+            self.name, goal, self.robot_map(self.map_name))
 
     def dock(
             self,
@@ -295,49 +571,77 @@ class RobotCommandHandle(adpt.RobotCommandHandle):
             cleaning process or load/unload a cart for delivery.
         '''
 
-        self._quit_dock_event.clear()
-        if self._dock_thread is not None:
-            self._dock_thread.join()
-
-        self.dock_name = dock_name
         assert docking_finished_callback is not None
-        self.docking_finished_callback = docking_finished_callback
 
         # Get the waypoint that the robot is trying to dock into
-        dock_waypoint = self.graph.find_waypoint(self.dock_name)
+        dock_waypoint = self.graph.find_waypoint(dock_name)
         assert dock_waypoint
-        self.dock_waypoint_index = dock_waypoint.index
 
-        def _dock():
+        def _dock(token):
+            self.dock_name = dock_name
+            self.docking_finished_callback = docking_finished_callback
+            self.update_tracking(dock_waypoint_index=dock_waypoint.index)
+
             # Request the robot to start the relevant process
             self.node.get_logger().info(
                 f"Requesting robot {self.name} to dock at {self.dock_name}")
-            # self.api.start_process(self.name, self.dock_name, self.map_name)
-
-            with self._lock:
-                self.on_waypoint = None
-                self.on_lane = None
-            self.sleep_for(0.1)
-            # ------------------------ #
-            # IMPLEMENT YOUR CODE HERE #
-            # With whatever logic you need for docking #
-            # ------------------------ #
-            while not self.api.docking_completed(self.name):
-                # Check if we need to abort
-                if self._quit_dock_event.is_set():
+            self.update_tracking(on_waypoint=None, on_lane=None)
+            while not self.api.dock(self.name):
+                if token.cancelled:
                     self.node.get_logger().info("Aborting docking")
                     return
-                self.node.get_logger().info("Robot is docking...")
-                self.sleep_for(0.1)
-
-            with self._lock:
-                self.on_waypoint = self.dock_waypoint_index
-                self.dock_waypoint_index = None
-                self.docking_finished_callback()
-                self.node.get_logger().info("Docking completed")
-
-        self._dock_thread = threading.Thread(target=_dock)
-        self._dock_thread.start()
+                self.sleep_for(0.1, token)
+
+            # Wake up on every telemetry message from the robot instead of
+            # polling. The wait is bounded so cancellation is noticed.
+            timeout = self.config.get('dock_timeout', 300.0)
+            start = self.clock()
+            last_status = None
+            battery_requested = False
+            attempts = 0
+            while True:
+                version = self.api.telemetry_version(self.name)
+                if self.api.docking_completed(self.name):
+                    break
+                if token.cancelled:
+                    self.node.get_logger().info("Aborting docking")
+                    return
+                elapsed = self.clock() - start
+                if elapsed > timeout:
+                    self._report_dock_failure(
+                        f"did not dock within {timeout:.0f}s")
+                    return
+                status = self.api.goto_status(self.name)
+                if status != last_status:
+                    self.node.get_logger().info(
+                        f"Robot {self.name} docking: {status} "
+                        f"after {elapsed:.1f}s")
+                    last_status = status
+                    if status is not None and \
+                            status[0] in ("abort", "obstacle detected"):
+                        if attempts >= self.goto_retries:
+                            self._report_dock_failure(
+                                f"could not reach {self.dock_name} "
+                                f"({status[0]})")
+                            return
+                        attempts += 1
+                        self.api.dock(self.name)
+                        continue
+                if status is not None and status[0] == "complete" \
+                        and not battery_requested:
+                    # Reached home base, confirm it is charging
+                    self.api.request_battery(self.name)
+                    battery_requested = True
+                self.api.wait_for_update(
+                    self.name, version, min(0.5, timeout - elapsed))
+
+            self.update_tracking(
+                on_waypoint=self.tracking.dock_waypoint_index,
+                dock_waypoint_index=None)
+            self.docking_finished_callback()
+            self.node.get_logger().info("Docking completed")
+
+        self.task_runner.replace(self.name, _dock)
 
     def get_position(self):
         """ This helper function returns the live position of the robot in the
@@ -370,14 +674,81 @@ class RobotCommandHandle(adpt.RobotCommandHandle):
                 "Unable to retrieve battery data from robot.")
             return self.battery_soc
 
+    def remaining_path_time(self):
+        ''' Estimated seconds until the end of the current path'''
+        path = self.path
+        row = self.path_row
+        if path is None or row is None:
+            return 0.0
+        leg = self.eta.time_to(self.position, path.position(row))
+        return leg + path.remaining_cost(row)
+
+    def get_lane_geometry(self):
+        ''' [entry, exit] locations of the lane the robot is on, or None'''
+        lane_index = self.tracking.on_lane
+        if lane_index is None:
+            return None
+        lane = self.graph.get_lane(lane_index)
+        return [self.graph.get_waypoint(lane.entry.waypoint_index).location,
+                self.graph.get_waypoint(lane.exit.waypoint_index).location]
+
     def update(self):
-        self.position = self.get_position()
+        tick = self.clock()
+        position = self.get_position()
+        stamp = self.api.position_stamp(self.name)
+        if stamp is not None and stamp != self._position_stamp:
+            # A fresh reading from the robot
+            self._position_stamp = stamp
+            self.motion_model.add(position, stamp)
+            self.eta.observe(position, stamp)
+            trace = self.api.position_trace(self.name)
+            if trace is not None and trace[2] == stamp:
+                self._trace = list(trace) + [tick]
+        if self.state == RobotState.MOVING and stamp is not None:
+            position = self.motion_model.predict(
+                self.clock(), self.get_lane_geometry())
+        self.position = position
         self.battery_soc = self.get_battery_soc()
+        self._check_reachable()
         if self.update_handle is not None:
             self.update_state()
+        # Positions that did not change RMF's view are not traced
+        self._trace = None
+
+    def _check_reachable(self):
+        # Log when the robot stops or resumes answering heartbeats. Runs on
+        # every update tick, so is_reachable must not block
+        reachable = self.api.is_reachable(self.name)
+        if reachable == self.reachable:
+            return
+        if reachable:
+            if self.reachable is not None:
+                self.node.get_logger().info(
+                    f"Robot {self.name} is reachable again")
+        else:
+            self.node.get_logger().warn(f"Robot {self.name} is not reachable")
+        self.reachable = reachable
+
+    def estimate_arrival(self, path_index, duration):
+        ''' Forward an arrival estimate to RMF if it changed enough'''
+        next_arrival_estimator = self.next_arrival_estimator
+        if next_arrival_estimator is None:
+            return
+        if self.update_filter.arrival(path_index, duration):
+            next_arrival_estimator(path_index, timedelta(seconds=duration))
+
+    def _update_location(self, update, *args):
+        # Call an update_handle location update and complete the trace of
+        # the position it carries
+        update(*args)
+        trace = self._trace
+        if trace is not None:
+            self._trace = None
+            self.tracer.record(trace + [self.clock()])
 
     def update_state(self):
-        self.update_handle.update_battery_soc(self.battery_soc)
+        if self.update_filter.battery(self.battery_soc):
+            self.update_handle.update_battery_soc(self.battery_soc)
         if not self.charger_is_set:
             if ("max_delay" in self.config.keys()):
                 max_delay = self.config["max_delay"]
@@ -392,37 +763,53 @@ class RobotCommandHandle(adpt.RobotCommandHandle):
                     "Invalid waypoint supplied for charger. "
                     "Using default nearest charger in the map")
             self.charger_is_set = True
-        # Update position
-        with self._lock:
-            if (self.on_waypoint is not None):  # if robot is on a waypoint
-                self.update_handle.update_current_waypoint(
-                    self.on_waypoint, self.position[2])
-            elif (self.on_lane is not None):  # if robot is on a lane
-                # We only keep track of the forward lane of the robot.
-                # However, when calling this update it is recommended to also
-                # pass in the reverse lane so that the planner does not assume
-                # the robot can only head forwards. This would be helpful when
-                # the robot is still rotating on a waypoint.
-                forward_lane = self.graph.get_lane(self.on_lane)
-                entry_index = forward_lane.entry.waypoint_index
-                exit_index = forward_lane.exit.waypoint_index
-                reverse_lane = self.graph.lane_from(exit_index, entry_index)
-                lane_indices = [self.on_lane]
-                if reverse_lane is not None:  # Unidirectional graph
-                    lane_indices.append(reverse_lane.index)
-                self.update_handle.update_current_lanes(
-                    self.position, lane_indices)
-            elif (self.dock_waypoint_index is not None):
-                self.update_handle.update_off_grid_position(
-                    self.position, self.dock_waypoint_index)
-            # if robot is merging into a waypoint
-            elif (self.target_waypoint is not None and
-                  self.target_waypoint.graph_index is not None):
-                self.update_handle.update_off_grid_position(
-                    self.position, self.target_waypoint.graph_index)
-            else:  # if robot is lost
-                self.update_handle.update_lost_position(
-                    self.map_name, self.position)
+        # Update position from a consistent snapshot without blocking on
+        # the path or dock threads
+        tracking = self.tracking
+        position = self.position
+        if (tracking.on_waypoint is not None):  # if robot is on a waypoint
+            if self.update_filter.location(
+                    ('waypoint', tracking.on_waypoint), position):
+                self._update_location(
+                    self.update_handle.update_current_waypoint,
+                    tracking.on_waypoint, position[2])
+        elif (tracking.on_lane is not None):  # if robot is on a lane
+            # We only keep track of the forward lane of the robot.
+            # However, when calling this update it is recommended to also
+            # pass in the reverse lane so that the planner does not assume
+            # the robot can only head forwards. This would be helpful when
+            # the robot is still rotating on a waypoint.
+            forward_lane = self.graph.get_lane(tracking.on_lane)
+            entry_index = forward_lane.entry.waypoint_index
+            exit_index = forward_lane.exit.waypoint_index
+            reverse_lane = self.graph.lane_from(exit_index, entry_index)
+            lane_indices = [tracking.on_lane]
+            if reverse_lane is not None:  # Unidirectional graph
+                lane_indices.append(reverse_lane.index)
+            if self.update_filter.location(
+                    ('lanes', tuple(lane_indices)), position):
+                self._update_location(
+                    self.update_handle.update_current_lanes,
+                    position, lane_indices)
+        elif (tracking.dock_waypoint_index is not None):
+            if self.update_filter.location(
+                    ('off_grid', tracking.dock_waypoint_index), position):
+                self._update_location(
+                    self.update_handle.update_off_grid_position,
+                    position, tracking.dock_waypoint_index)
+        # if robot is merging into a waypoint
+        elif (tracking.target_waypoint is not None and
+              tracking.target_waypoint.graph_index is not None):
+            if self.update_filter.location(
+                    ('off_grid', tracking.target_waypoint.graph_index), position):
+                self._update_location(
+                    self.update_handle.update_off_grid_position,
+                    position, tracking.target_waypoint.graph_index)
+        else:  # if robot is lost
+            if self.update_filter.location(('lost', self.map_name), position):
+                self._update_location(
+                    self.update_handle.update_lost_position,
+                    self.map_name, position)
 
     def get_current_lane(self):
         def projection(current_position,
@@ -436,9 +823,10 @@ class RobotCommandHandle(adpt.RobotCommandHandle):
             exit = np.array(lane_exit)
             return np.dot(p - t, exit - entry)
 
-        if self.target_waypoint is None:
+        target_waypoint = self.tracking.target_waypoint
+        if target_waypoint is None:
             return None
-        approach_lanes = self.target_waypoint.approach_lanes
+        approach_lanes = target_waypoint.approach_lanes
         # Spin on the spot
         if approach_lanes is None or len(approach_lanes) == 0:
             return None
@@ -460,6 +848,23 @@ class RobotCommandHandle(adpt.RobotCommandHandle):
         assert (len(B) > 1)
         return math.sqrt((A[0] - B[0]) ** 2 + (A[1] - B[1]) ** 2)
 
+    def compile_path(self, remaining_waypoints):
+        '''
+        Compile the (index, waypoint) tuples of a new plan. A plan equal to
+        the one being followed, as RMF sends again after some replans,
+        reuses its compiled form.
+        '''
+        path = self.path
+        if path is not None and \
+                path.key == CompiledPath.key_of(remaining_waypoints):
+            return path
+        path = CompiledPath(
+            remaining_waypoints, self.transforms, self.eta, self.graph)
+        for problem in path.check(self.graph.num_waypoints):
+            self.node.get_logger().warn(
+                f"Path for robot {self.name}: {problem}")
+        return path
+
     def get_remaining_waypoints(self, waypoints: list):
         '''
         The function returns a list where each element is a tuple of the index
@@ -0,0 +1,79 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Keeps the battery state of every robot in the fleet fresh. A single
+    background thread requests battery data from a robot once its cached
+    value is older than the TTL. The first requests are spread evenly over
+    one TTL, with some random jitter, so that robots do not all query the
+    broker at the same moment.
+'''
+
+import heapq
+import random
+import threading
+import time
+
+
+class BatteryMonitor:
+
+    def __init__(self, robots, ttl=60.0, jitter=0.1):
+        '''
+        robots maps robot names to Robot objects. ttl is the maximum age in
+        seconds of a cached battery state and jitter the fraction of the TTL
+        by which each refresh is randomly shifted.
+        '''
+        self.robots = robots
+        self.ttl = ttl
+        self.jitter = jitter
+        self.requests = 0
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name='temi_battery_monitor', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _jittered(self, period):
+        return period * (1.0 + random.uniform(-self.jitter, self.jitter))
+
+    def _run(self):
+        now = time.monotonic()
+        count = len(self.robots)
+        schedule = [
+            (now + self._jittered(self.ttl * i / count), name)
+            for i, name in enumerate(self.robots)]
+        heapq.heapify(schedule)
+        while schedule:
+            due, robot_name = heapq.heappop(schedule)
+            if self._stop_event.wait(max(0.0, due - time.monotonic())):
+                return
+            age = self.robots[robot_name].batteryAge
+            if age is not None and age < self.ttl:
+                # Fresh data arrived on its own, check again when it expires
+                heapq.heappush(
+                    schedule,
+                    (time.monotonic() + self._jittered(self.ttl - age), robot_name))
+                continue
+            # The reply updates the cache through the battery subscription
+            self.robots[robot_name].getBatteryData(wait=False)
+            self.requests += 1
+            heapq.heappush(
+                schedule, (time.monotonic() + self._jittered(self.ttl), robot_name))
@@ -0,0 +1,99 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Drops robot commands that would not change anything. Each command
+    belongs to a slot, e.g. all goals share the "goto" slot. A slot has at
+    most one command in flight (sent and waiting for its response) and, for
+    replaceable slots, at most one pending command waiting to be sent.
+
+    - A command identical to the one in flight or pending is not sent again;
+      the caller gets the result of the existing one.
+    - A newer command in a replaceable slot takes the place of the pending
+      one, whose caller gets None back without anything being sent.
+    - A command may supersede the pending command of other slots, e.g. a
+      stop drops a goal that has not been sent yet.
+'''
+
+import threading
+
+
+class _Call:
+
+    def __init__(self, key):
+        self.key = key
+        self.done = False
+        self.result = None
+
+
+class CommandCoalescer:
+
+    def __init__(self):
+        self._changed = threading.Condition()
+        self._in_flight = {}  # slot -> _Call
+        self._pending = {}  # slot -> _Call
+        self.sent = 0
+        self.dropped = 0
+        self.replaced = 0
+
+    def submit(self, slot, key, send, replace=False, supersedes=()):
+        '''
+        Run send() unless an identical command, as given by key, is already
+        in flight or pending in slot, and return its result. Blocks while a
+        replaceable slot is busy. Returns None if the command was replaced
+        or superseded before it could be sent.
+        '''
+        with self._changed:
+            for other in supersedes:
+                self._drop_pending(other)
+            for existing in (self._in_flight.get(slot), self._pending.get(slot)):
+                if existing is not None and existing.key == key:
+                    self.dropped += 1
+                    self._changed.wait_for(lambda: existing.done)
+                    return existing.result
+            call = _Call(key)
+            if replace:
+                # An older command still waiting must never be sent after
+                # this one
+                self._drop_pending(slot)
+            if replace and slot in self._in_flight:
+                self._pending[slot] = call
+                self._changed.wait_for(
+                    lambda: call.done or slot not in self._in_flight)
+                if call.done:
+                    return None
+                del self._pending[slot]
+            self._in_flight.setdefault(slot, call)
+            self.sent += 1
+
+        try:
+            call.result = send()
+            return call.result
+        finally:
+            with self._changed:
+                if self._in_flight.get(slot) is call:
+                    del self._in_flight[slot]
+                call.done = True
+                self._changed.notify_all()
+
+    def stats(self):
+        return {'sent': self.sent, 'dropped': self.dropped, 'replaced': self.replaced}
+
+    def _drop_pending(self, slot):
+        # Must be called with self._changed held
+        call = self._pending.pop(slot, None)
+        if call is not None:
+            call.done = True
+            self.replaced += 1
+            self._changed.notify_all()
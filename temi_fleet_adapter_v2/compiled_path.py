@@ -0,0 +1,152 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    A plan from RMF compiled once, when follow_new_path receives it. Row i
+    holds everything the path follower needs for the i-th goal: the goal in
+    the robot frame, the RMF pose, the length and heading of the segment
+    leading to it, the time RMF wants the robot to wait until and the graph
+    waypoint with its name and level. Following the path, retrying a goal or checking
+    how much of the path is left then only indexes into these arrays.
+'''
+
+import math
+
+from datetime import timedelta
+
+import numpy as np
+
+
+# graph_indices value of waypoints that are not on the navigation graph
+NO_WAYPOINT = -1
+
+
+def time_seconds(t):
+    ''' An RMF time in seconds. rmf_traffic times are steady clock time
+        points and come as a timedelta since the clock's epoch, other times
+        as a datetime. Only differences of two times are meaningful.'''
+    if isinstance(t, timedelta):
+        return t.total_seconds()
+    return t.timestamp()
+
+
+class CompiledPath:
+
+    def __init__(self, entries, transforms, eta, graph=None):
+        '''
+        entries are the (path index, Plan waypoint) tuples returned by
+        get_remaining_waypoints, transforms the transforms of the command
+        handle and eta its ArrivalEstimator. Waypoint names are looked up
+        in graph, if given.
+        '''
+        self.waypoints = [waypoint for _, waypoint in entries]
+        count = len(self.waypoints)
+        self.path_indices = np.array(
+            [index for index, _ in entries], dtype=np.int64)
+        self.graph_indices = np.array(
+            [NO_WAYPOINT if w.graph_index is None else w.graph_index
+             for w in self.waypoints], dtype=np.int64)
+        # Names of the graph waypoints, None where there is no name
+        self.names = [
+            graph.get_waypoint(int(index)).waypoint_name
+            if graph is not None and 0 <= index < graph.num_waypoints
+            else None
+            for index in self.graph_indices]
+        # Level of each goal. Goals off the graph are on the level of the
+        # goal before them
+        self.maps = []
+        for index in self.graph_indices:
+            if graph is not None and 0 <= index < graph.num_waypoints:
+                self.maps.append(graph.get_waypoint(int(index)).map_name)
+            else:
+                self.maps.append(self.maps[-1] if self.maps else None)
+        # [x, y, theta] in the RMF frame
+        self.positions = np.array(
+            [list(w.position[:3]) for w in self.waypoints],
+            dtype=np.float64).reshape(count, 3)
+        # [x, y, theta] in the robot frame, as sent to TemiAPI.navigate
+        self.goals = np.empty((count, 3))
+        for i, position in enumerate(self.positions):
+            self.goals[i, :2] = transforms['rmf_to_robot'].transform(
+                position[:2].tolist())
+        self.goals[:, 2] = \
+            self.positions[:, 2] + transforms['orientation_offset']
+        # Segment i leads from waypoint i - 1 to waypoint i; the first one
+        # starts wherever the robot is and has no length
+        steps = np.diff(self.positions[:, :2], axis=0, prepend=self.positions[:1, :2])
+        self.segment_lengths = np.hypot(steps[:, 0], steps[:, 1])
+        self.headings = np.where(
+            self.segment_lengths > eta.MIN_TRAVEL,
+            np.arctan2(steps[:, 1], steps[:, 0]),
+            self.positions[:, 2])
+        # Comparable to time_seconds(adapter.now())
+        self.deadlines = np.array(
+            [time_seconds(w.time) for w in self.waypoints], dtype=np.float64)
+        # Cumulative travel time from the first waypoint
+        self.costs = np.array(eta.path_costs(self.positions.tolist()))
+        self.key = self.key_of(entries)
+
+    @staticmethod
+    def key_of(entries):
+        ''' Identifies a plan; equal keys compile to the same path'''
+        return tuple(
+            (index, w.graph_index, time_seconds(w.time)) +
+            tuple(float(v) for v in w.position[:3])
+            for index, w in entries)
+
+    def __len__(self):
+        return len(self.waypoints)
+
+    def goal(self, row):
+        ''' Robot frame goal of row as [x, y, theta]'''
+        return self.goals[row].tolist()
+
+    def position(self, row):
+        ''' RMF frame pose of row as [x, y, theta]'''
+        return self.positions[row].tolist()
+
+    def graph_index(self, row):
+        ''' Graph waypoint of row, or None if it is off the graph'''
+        index = int(self.graph_indices[row])
+        return None if index == NO_WAYPOINT else index
+
+    def level_change(self, row, map_name):
+        ''' Level of row if it differs from map_name, else None'''
+        level = self.maps[row]
+        return None if level is None or level == map_name else level
+
+    def remaining_cost(self, row):
+        ''' Travel time from waypoint row to the end of the path'''
+        return float(self.costs[-1] - self.costs[row])
+
+    def check(self, num_waypoints):
+        ''' Problems with the plan, as a list of messages. num_waypoints is
+            the size of the navigation graph.'''
+        problems = []
+        if not len(self):
+            return ['the path is empty']
+        if not np.all(np.isfinite(self.goals)):
+            rows = np.flatnonzero(~np.isfinite(self.goals).all(axis=1))
+            problems.append(f'goals {rows.tolist()} are not finite')
+        if np.any(np.diff(self.deadlines) < 0.0):
+            problems.append('waypoint times go backwards')
+        off_graph = (self.graph_indices != NO_WAYPOINT) & \
+            ((self.graph_indices < 0) | (self.graph_indices >= num_waypoints))
+        if np.any(off_graph):
+            problems.append(
+                f'graph indices {self.graph_indices[off_graph].tolist()} '
+                f'are not in the navigation graph')
+        if np.any(np.abs(self.positions[:, 2]) > 2.0 * math.pi):
+            problems.append('orientations are not in radians')
+        return problems
@@ -8,11 +8,14 @@ from datetime import datetime
 
 import paho.mqtt.client as mqtt
 import socket
-import time
+import threading
 import os
-import ssl
-import certifi
+from .publisher import PublishScheduler
 from .robot import now
+from .router import TopicRouter
+
+# seconds to wait for the broker to accept the connection and subscription
+CONNECT_TIMEOUT = 10.0
 
 
 def _on_connect(client, userdata, flags, rc):
@@ -25,11 +28,17 @@ def _on_connect(client, userdata, flags, rc):
 
     # subscribing in on_connect() means that if we lose the connection and
     # reconnect, then subscriptions will be renewed
-    client.subscribe("temi/#", qos=2)
+    client.subscribe(TopicRouter.SUBSCRIPTION, qos=2)
+
+
+def _on_subscribe(client, userdata, mid, granted_qos):
+    """Signal that the client is connected and receiving robot topics"""
+    client.ready.set()
 
 
 def _on_disconnect(client, userdata, rc):
     """Disconnect from MQTT broker"""
+    client.ready.clear()
     print("DISCONNECTED!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!```````````````````````````````````````")
     print(
         "[STATUS] Disconnected from: {} (rc:{})".format(
@@ -44,9 +53,14 @@ def _on_message(client, userdata, msg):
     print("[{}][SUB] {} {}".format(now(), msg.topic, str(msg.payload)))
 
 
-def connect(host, port, username=None, password=None):
+def connect(host, port, username=None, password=None, timeout=CONNECT_TIMEOUT,
+            publish_limits=None):
     print("^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^^")
     """Connect to MQTT broker"""
+    # only needed for TLS setup, so keep them off the import path
+    import ssl
+    import certifi
+
     client_id = socket.gethostname() + "-" + datetime.now().strftime("%Y%m%d%H%M%S")
 
     # create a new MQTT client instance
@@ -54,7 +68,18 @@ def connect(host, port, username=None, password=None):
 
     # attach general callbacks
     client.on_connect = _on_connect
+    client.on_subscribe = _on_subscribe
     client.on_disconnect = _on_disconnect
+    client.ready = threading.Event()
+
+    # incoming messages are routed to the robots by serial and topic
+    client.router = TopicRouter()
+    client.on_message = client.router.dispatch
+
+    # robot commands are queued here instead of calling client.publish, see
+    # publisher.py. publish_limits holds keyword arguments of PublishScheduler
+    client.publisher = PublishScheduler(client, **(publish_limits or {}))
+    client.publisher.start()
 
     # set username and password
     if username and password:
@@ -78,9 +103,10 @@ def connect(host, port, username=None, password=None):
     # start listening to topics
     client.loop_start()
 
-    # wait for client to connect
-    # TODO check using on_connect()
-    time.sleep(1)
+    # wait for the broker to acknowledge the connection and subscription
+    if not client.ready.wait(timeout):
+        print("[{}] [ERROR] No response from MQTT broker {}:{} after {}s".format(
+            now(), host, port, timeout))
 
     return client
 
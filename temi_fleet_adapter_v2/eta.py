@@ -0,0 +1,131 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Arrival time estimates computed locally from the vehicle limits in
+    config.yaml, the geometry of the remaining plan and the speed the robot
+    is actually achieving. All positions are [x, y, theta] in the RMF frame.
+'''
+
+import math
+
+
+def _wrap(angle):
+    ''' Wrap an angle to [-pi, pi]'''
+    return math.atan2(math.sin(angle), math.cos(angle))
+
+
+def travel_time(distance, velocity, acceleration):
+    ''' Time to cover distance from rest to rest with a trapezoidal velocity
+        profile, falling back to a triangular one for short distances.'''
+    if distance <= 0.0:
+        return 0.0
+    if distance >= velocity * velocity / acceleration:
+        return distance / velocity + velocity / acceleration
+    return 2.0 * math.sqrt(distance / acceleration)
+
+
+class ArrivalEstimator:
+
+    # Below this distance a segment is treated as a turn on the spot
+    MIN_TRAVEL = 1e-3
+    # Positions are rounded to this many decimals when caching segment costs
+    CACHE_PRECISION = 3
+
+    def __init__(self, linear, angular, smoothing=0.3, cache=None):
+        '''
+        linear and angular are the [velocity, acceleration] limits from the
+        limits section of config.yaml. smoothing is the weight given to each
+        new speed observation. cache may be shared between estimators of
+        robots with the same limits.
+        '''
+        self.linear_velocity, self.linear_acceleration = linear
+        self.angular_velocity, self.angular_acceleration = angular
+        self.smoothing = smoothing
+        self._segment_costs = {} if cache is None else cache
+        self._last_observation = None
+        self.observed_speed = 0.0
+
+    def rotation_time(self, angle):
+        return travel_time(
+            abs(_wrap(angle)), self.angular_velocity, self.angular_acceleration)
+
+    def segment_cost(self, start, end):
+        '''
+        Seconds needed to go from the start pose to the end pose: turn to
+        face the end, drive there and turn to the final orientation.
+        '''
+        key = (tuple(round(v, self.CACHE_PRECISION) for v in start[:3]),
+               tuple(round(v, self.CACHE_PRECISION) for v in end[:3]))
+        cost = self._segment_costs.get(key)
+        if cost is None:
+            cost = self._segment_cost(start, end)
+            self._segment_costs[key] = cost
+        return cost
+
+    def _segment_cost(self, start, end):
+        dx = end[0] - start[0]
+        dy = end[1] - start[1]
+        distance = math.hypot(dx, dy)
+        if distance < self.MIN_TRAVEL:
+            return self.rotation_time(end[2] - start[2])
+        heading = math.atan2(dy, dx)
+        return (self.rotation_time(heading - start[2]) +
+                travel_time(distance, self.linear_velocity, self.linear_acceleration) +
+                self.rotation_time(end[2] - heading))
+
+    def path_costs(self, poses):
+        '''
+        Cumulative cost of following poses, where element i is the time
+        from poses[0] to poses[i]. Computed once per path.
+        '''
+        costs = [0.0]
+        for start, end in zip(poses[:-1], poses[1:]):
+            costs.append(costs[-1] + self.segment_cost(start, end))
+        return costs
+
+    def observe(self, position, stamp):
+        ''' Update the observed speed from a position sampled at stamp
+            seconds.'''
+        if self._last_observation is not None:
+            last_position, last_stamp = self._last_observation
+            dt = stamp - last_stamp
+            if dt <= 0.0:
+                return
+            speed = math.hypot(position[0] - last_position[0],
+                               position[1] - last_position[1]) / dt
+            speed = min(speed, self.linear_velocity)
+            self.observed_speed += self.smoothing * (speed - self.observed_speed)
+        self._last_observation = (position, stamp)
+
+    def time_to(self, position, target):
+        '''
+        Seconds for a robot currently at position to arrive at target. While
+        the robot is already under way the remaining distance is covered at
+        the observed speed, otherwise it starts from rest.
+        '''
+        dx = target[0] - position[0]
+        dy = target[1] - position[1]
+        distance = math.hypot(dx, dy)
+        if distance < self.MIN_TRAVEL:
+            return self.rotation_time(target[2] - position[2])
+        heading = math.atan2(dy, dx)
+        final_turn = self.rotation_time(target[2] - heading)
+        # Not moving yet, or moving too slowly to be a useful predictor
+        if self.observed_speed < 0.25 * self.linear_velocity:
+            return self._segment_cost(position, target)
+        # Deceleration at the end costs v / (2a) on top of cruising
+        cruise = distance / self.observed_speed
+        brake = self.observed_speed / (2.0 * self.linear_acceleration)
+        return cruise + brake + final_turn
@@ -0,0 +1,140 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Active connection checks. Every robot is sent a small probe on the
+    test/testConnection channel once per period and answers it on
+    event/test/testConnection. The round trip time through the broker and
+    the robot, its jitter and the time since the last answer tell whether a
+    robot can be reached. Any other message from the robot also shows that
+    it is alive.
+'''
+
+import threading
+import time
+
+
+class LinkHealth:
+    ''' Probe bookkeeping of one robot. Stamps are time.monotonic()'''
+
+    # Weight of a new sample in the smoothed RTT and jitter, as in RFC 3550
+    GAIN = 1.0 / 16.0
+
+    def __init__(self, timeout=3.0):
+        self.timeout = timeout
+        self.rtt = None
+        self.jitter = 0.0
+        self.last_reply = None
+        self.last_heard = None
+        self.sent = 0
+        self.lost = 0
+        self._outstanding = {}  # probe id -> stamp it was sent
+        self._lock = threading.Lock()
+        self._next_id = 0
+
+    def probe_sent(self, stamp):
+        ''' Returns the id of a new probe'''
+        with self._lock:
+            self._next_id += 1
+            self._outstanding[self._next_id] = stamp
+            self.sent += 1
+            # Probes that were never answered count as lost
+            for probe_id, sent in list(self._outstanding.items()):
+                if stamp - sent > self.timeout:
+                    del self._outstanding[probe_id]
+                    self.lost += 1
+            return self._next_id
+
+    def reply(self, probe_id, stamp):
+        '''
+        Record the answer to probe_id, or to the oldest outstanding probe if
+        the robot did not echo the id. Returns the RTT, or None if there was
+        no such probe.
+        '''
+        with self._lock:
+            if probe_id not in self._outstanding:
+                if probe_id is not None or not self._outstanding:
+                    self.last_reply = stamp
+                    return None
+                probe_id = min(self._outstanding)
+            rtt = stamp - self._outstanding.pop(probe_id)
+            if self.rtt is None:
+                self.rtt = rtt
+            else:
+                self.jitter += (abs(rtt - self.rtt) - self.jitter) * self.GAIN
+                self.rtt += (rtt - self.rtt) * self.GAIN
+            self.last_reply = stamp
+            return rtt
+
+    def heard(self, stamp):
+        ''' Record that some message arrived from the robot'''
+        self.last_heard = stamp
+
+    def age(self, now=None):
+        ''' Seconds since the robot was last heard from, or None'''
+        stamps = [s for s in (self.last_reply, self.last_heard) if s is not None]
+        if not stamps:
+            return None
+        if now is None:
+            now = time.monotonic()
+        return now - max(stamps)
+
+    def alive(self, now=None):
+        ''' True if the robot was heard from within the last timeout
+            seconds'''
+        age = self.age(now)
+        return age is not None and age <= self.timeout
+
+    def stats(self, now=None):
+        if now is None:
+            now = time.monotonic()
+        return {
+            'alive': self.alive(now),
+            'rtt': self.rtt,
+            'jitter': self.jitter,
+            'age': self.age(now),
+            'sent': self.sent,
+            'lost': self.lost}
+
+
+class HeartbeatMonitor:
+
+    def __init__(self, robots, period=1.0):
+        ''' robots maps robot names to Robot objects'''
+        self.robots = robots
+        self.period = period
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name='temi_heartbeat', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+
+    def _run(self):
+        # Probe all robots back to back; they share one timer so a fleet
+        # costs one wake-up per period
+        deadline = time.monotonic()
+        while True:
+            for robot in self.robots.values():
+                robot.ping()
+            # Skip beats that were missed rather than sending a burst
+            deadline = max(deadline + self.period, time.monotonic())
+            if self._stop_event.wait(max(0.0, deadline - time.monotonic())):
+                return
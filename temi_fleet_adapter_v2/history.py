@@ -0,0 +1,124 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Fixed-size history of what a robot reported and what it was told to do.
+    Samples and command events are kept in preallocated NumPy ring buffers,
+    so memory use does not grow with uptime.
+'''
+
+import threading
+import time
+
+import numpy as np
+
+
+SAMPLE_DTYPE = np.dtype([
+    ('stamp', np.float64),
+    ('x', np.float64),
+    ('y', np.float64),
+    ('yaw', np.float64),
+    ('soc', np.float64),
+    ('goto_status', np.int8),
+])
+
+# Commands recorded as events, stored by index
+COMMANDS = (
+    'stop', 'goToPosition', 'goToLocation', 'loadMap', 'getBatteryData',
+    'getCurrentPosition')
+
+EVENT_DTYPE = np.dtype([
+    ('stamp', np.float64),
+    ('command', np.int8),
+    ('x', np.float64),
+    ('y', np.float64),
+    ('yaw', np.float64),
+])
+
+
+class RingBuffer:
+    '''
+    Keeps the last capacity records of a NumPy dtype. Records must be
+    appended from one thread at a time in increasing stamp order. Readers
+    do not lock; records overwritten while they were being read are
+    dropped from the result.
+    '''
+
+    def __init__(self, capacity, dtype):
+        self.capacity = capacity
+        self._data = np.zeros(capacity, dtype=dtype)
+        self._count = 0  # records appended since creation
+
+    def __len__(self):
+        return min(self._count, self.capacity)
+
+    def append(self, record):
+        self._data[self._count % self.capacity] = record
+        self._count += 1
+
+    def ordered(self):
+        ''' Copy of all stored records, oldest first'''
+        count = self._count
+        if count <= self.capacity:
+            records = self._data[:count].copy()
+        else:
+            split = count % self.capacity
+            records = np.concatenate((self._data[split:], self._data[:split]))
+        # The oldest records may have been overwritten while copying
+        torn = max(0, self._count - self.capacity) - max(0, count - self.capacity)
+        return records[min(torn, len(records)):]
+
+    def between(self, start=-np.inf, end=np.inf):
+        ''' Records with start <= stamp <= end, oldest first'''
+        records = self.ordered()
+        stamps = records['stamp']
+        first = np.searchsorted(stamps, start, side='left')
+        last = np.searchsorted(stamps, end, side='right')
+        return records[first:last]
+
+
+class RobotHistory:
+
+    def __init__(self, minutes=10.0, sample_rate=10.0, event_capacity=1024):
+        '''
+        Samples are kept for about minutes of history at up to sample_rate
+        samples per second. Command events are kept in a separate buffer.
+        '''
+        self.samples = RingBuffer(
+            max(1, int(minutes * 60.0 * sample_rate)), SAMPLE_DTYPE)
+        self.events = RingBuffer(event_capacity, EVENT_DTYPE)
+        # Commands are sent from several threads
+        self._event_lock = threading.Lock()
+
+    def record_sample(self, stamp, x, y, yaw, soc, goto_status):
+        ''' Must only be called from the thread that writes telemetry'''
+        self.samples.append((stamp, x, y, yaw, soc, goto_status))
+
+    def record_command(self, command, x=np.nan, y=np.nan, yaw=np.nan):
+        with self._event_lock:
+            self.events.append(
+                (time.monotonic(), COMMANDS.index(command), x, y, yaw))
+
+    def last(self, seconds):
+        ''' Samples from the last seconds'''
+        return self.samples.between(time.monotonic() - seconds)
+
+    def dump(self, file):
+        ''' Write samples and events to file (a path or binary file object)
+            in NumPy .npz format'''
+        np.savez_compressed(
+            file,
+            samples=self.samples.ordered(),
+            events=self.events.ordered(),
+            commands=np.array(COMMANDS))
@@ -0,0 +1,60 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Matches RMF waypoint names to the locations saved on a Temi. Temi
+    stores location names in lower case, and users tend to write spaces
+    where the navigation graph has underscores, so tl_corner in the graph
+    matches "tl corner" on the robot. The index is rebuilt from the
+    waypoint_list of status/info messages whenever that list changes.
+'''
+
+import re
+
+
+def normalize(name):
+    ''' Key under which a location name is looked up'''
+    return re.sub(r'[\s_\-]+', ' ', name).strip().lower()
+
+
+class LocationIndex:
+
+    def __init__(self, locations=("home base",)):
+        self._locations = ()
+        # normalized name -> name as saved on the robot. Replaced, never
+        # modified, so lookups need no lock
+        self._index = {}
+        self.updates = 0
+        self.update(locations)
+
+    def update(self, locations):
+        ''' Rebuild the index if the saved locations changed. Returns True
+            if they did.'''
+        locations = tuple(locations)
+        if locations == self._locations:
+            return False
+        self._index = {normalize(name): name for name in locations}
+        self._locations = locations
+        self.updates += 1
+        return True
+
+    @property
+    def locations(self):
+        return list(self._locations)
+
+    def lookup(self, waypoint_name):
+        ''' Name of the saved location for an RMF waypoint, or None'''
+        if not waypoint_name:
+            return None
+        return self._index.get(normalize(waypoint_name))
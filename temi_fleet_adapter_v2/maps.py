@@ -0,0 +1,146 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Keeps track of the map loaded on a robot. loadMap blocks until the
+    robot answers and resets its pose, so it is only sent when the robot
+    really changes level. A load can be started early, e.g. while the
+    robot rides the lift, and the next goal only waits for whatever is left
+    of it. The robot is placed at the pose given for the map, e.g. the lift
+    on the new level. The time every load takes is measured.
+'''
+
+import threading
+import time
+
+
+class MapLoader:
+
+    def __init__(self, load, current=None, clock=time.monotonic):
+        '''
+        load(map_name, pose) asks the robot to load a map with the robot at
+        pose, or where it is if pose is None, and returns True once it has.
+        current is the map the robot is known to have loaded.
+        '''
+        self.load = load
+        # map name -> pose in that map to load it at
+        self._poses = {}
+        self.current = current
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._loading = None  # (map name, threading.Event) of a load in flight
+        self.loads = 0
+        self.skipped = 0
+        self.failed = 0
+        self.last_latency = None
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+        # Seconds spent in ensure() waiting for loads to finish. Loads that
+        # were prefetched early enough add nothing
+        self.blocked = 0.0
+
+    def _start(self, map_name):
+        # Called with the lock held
+        done = threading.Event()
+        self._loading = (map_name, done)
+        thread = threading.Thread(
+            target=self._run, args=(map_name, done),
+            name='temi_map_load', daemon=True)
+        thread.start()
+        return done
+
+    def _run(self, map_name, done):
+        start = self.clock()
+        try:
+            loaded = self.load(map_name, self._poses.get(map_name))
+        except Exception as e:
+            print(f"An error has occurred when loading map {map_name}: {e}")
+            loaded = False
+        latency = self.clock() - start
+        with self._lock:
+            self._loading = None
+            if loaded:
+                self.current = map_name
+                self.loads += 1
+                self.last_latency = latency
+                self.max_latency = max(self.max_latency, latency)
+                self.total_latency += latency
+            else:
+                self.failed += 1
+        print(f"Map {map_name} {'loaded' if loaded else 'failed to load'} "
+              f"after {latency:.2f}s")
+        done.set()
+
+    def prefetch(self, map_name, pose=None):
+        ''' Start loading map_name unless it is loaded or being loaded. pose
+            is where the robot is on that map'''
+        with self._lock:
+            if pose is not None:
+                self._poses[map_name] = pose
+            if map_name == self.current or (
+                    self._loading is not None and self._loading[0] == map_name):
+                return
+            if self._loading is None:
+                self._start(map_name)
+
+    def ensure(self, map_name, timeout=None, pose=None):
+        '''
+        Make sure map_name is loaded. Returns True at once if it already
+        is, otherwise waits for the load, or for a load in flight to finish
+        first. A robot whose map is not known is assumed to be on map_name,
+        as the adapter starts it there. pose is as for prefetch.
+        '''
+        if pose is not None:
+            with self._lock:
+                self._poses[map_name] = pose
+        start = self.clock()
+        deadline = None if timeout is None else start + timeout
+        started = False
+        waited = False
+        while True:
+            with self._lock:
+                if self.current is None and self._loading is None:
+                    self.current = map_name
+                loading = self._loading
+                if loading is None:
+                    if map_name == self.current:
+                        break
+                    if started:
+                        # The load this call started failed
+                        return False
+                    loading = (map_name, self._start(map_name))
+                    started = True
+            remaining = None if deadline is None else deadline - self.clock()
+            finished = loading[1].wait(remaining)
+            waited = True
+            if not finished:
+                break
+        if not waited:
+            self.skipped += 1
+            return True
+        self.blocked += self.clock() - start
+        return self.current == map_name
+
+    def stats(self):
+        return {
+            'current': self.current,
+            'loading': None if self._loading is None else self._loading[0],
+            'loads': self.loads,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'last_latency': self.last_latency,
+            'mean_latency':
+                self.total_latency / self.loads if self.loads else None,
+            'max_latency': self.max_latency,
+            'blocked': self.blocked}
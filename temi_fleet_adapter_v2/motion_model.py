@@ -0,0 +1,112 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Dead reckoning between the sparse currentPosition messages of a Temi.
+    Poses are [x, y, theta] in the RMF frame and stamps are seconds on a
+    monotonic clock.
+'''
+
+import math
+
+from collections import deque
+
+
+class PoseExtrapolator:
+
+    def __init__(self, linear_velocity, angular_velocity, history=3, horizon=1.0):
+        '''
+        linear_velocity and angular_velocity bound the estimated velocity.
+        history is the number of readings the velocity is fitted over and
+        horizon is how many seconds past the latest reading the pose may be
+        extrapolated.
+        '''
+        self.linear_velocity = linear_velocity
+        self.angular_velocity = angular_velocity
+        self.horizon = horizon
+        self._readings = deque(maxlen=history)
+
+    def add(self, pose, stamp):
+        ''' Record a measured pose. Repeated stamps are ignored.'''
+        if self._readings and stamp <= self._readings[-1][1]:
+            return
+        if self._readings:
+            # Unwrap theta against the previous reading so the fit is linear
+            previous = self._readings[-1][0][2]
+            theta = previous + math.atan2(
+                math.sin(pose[2] - previous), math.cos(pose[2] - previous))
+            pose = [pose[0], pose[1], theta]
+        self._readings.append((list(pose[:3]), stamp))
+
+    def reset(self):
+        self._readings.clear()
+
+    def velocity(self):
+        ''' Least squares [vx, vy, omega] over the stored readings, clamped
+            to the velocity limits'''
+        if len(self._readings) < 2:
+            return [0.0, 0.0, 0.0]
+        stamps = [stamp for _, stamp in self._readings]
+        mean_t = sum(stamps) / len(stamps)
+        denominator = sum((t - mean_t) ** 2 for t in stamps)
+        if denominator <= 0.0:
+            return [0.0, 0.0, 0.0]
+        slopes = []
+        for axis in range(3):
+            values = [pose[axis] for pose, _ in self._readings]
+            mean_v = sum(values) / len(values)
+            slopes.append(sum((t - mean_t) * (v - mean_v)
+                              for t, v in zip(stamps, values)) / denominator)
+        vx, vy, omega = slopes
+        speed = math.hypot(vx, vy)
+        if speed > self.linear_velocity:
+            vx *= self.linear_velocity / speed
+            vy *= self.linear_velocity / speed
+        omega = max(-self.angular_velocity, min(self.angular_velocity, omega))
+        return [vx, vy, omega]
+
+    def predict(self, stamp, lane=None):
+        '''
+        Pose at stamp, or None if nothing has been recorded yet. lane is an
+        optional pair of [x, y] lane end points. When given, the robot is
+        only moved along the lane and never past either of its ends.
+        '''
+        if not self._readings:
+            return None
+        pose, last_stamp = self._readings[-1]
+        dt = min(max(stamp - last_stamp, 0.0), self.horizon)
+        vx, vy, omega = self.velocity()
+        if lane is None:
+            dx, dy = vx * dt, vy * dt
+        else:
+            dx, dy = _along_lane(pose, vx * dt, vy * dt, lane[0], lane[1])
+        theta = math.atan2(math.sin(pose[2] + omega * dt),
+                           math.cos(pose[2] + omega * dt))
+        return [pose[0] + dx, pose[1] + dy, theta]
+
+
+def _along_lane(pose, dx, dy, start, end):
+    ''' The part of the displacement [dx, dy] along the lane from start to
+        end, limited so that the pose does not move beyond the lane ends'''
+    lx = end[0] - start[0]
+    ly = end[1] - start[1]
+    length = math.hypot(lx, ly)
+    if length <= 0.0:
+        return 0.0, 0.0
+    ux, uy = lx / length, ly / length
+    progress = (pose[0] - start[0]) * ux + (pose[1] - start[1]) * uy
+    lowest = -progress if progress > 0.0 else 0.0
+    highest = length - progress if progress < length else 0.0
+    step = max(lowest, min(highest, dx * ux + dy * uy))
+    return step * ux, step * uy
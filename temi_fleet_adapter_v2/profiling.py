@@ -0,0 +1,308 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Profiling helpers for the fleet adapter.
+'''
+
+import collections
+import contextlib
+import os
+import sys
+import threading
+import time
+
+
+# thread ident -> robot name, for threads working on behalf of one robot
+_thread_robots = {}
+
+# Thread name prefixes of the adapter's subsystems
+SUBSYSTEMS = (
+    ('temi_task', 'tasks'),
+    ('temi_publisher', 'publisher'),
+    ('temi_battery_monitor', 'battery'),
+    ('temi_heartbeat', 'heartbeat'),
+    ('temi_shard', 'shard'),
+    ('MainThread', 'executor'),
+)
+
+
+@contextlib.contextmanager
+def robot_tag(robot):
+    ''' Attribute samples of the current thread to robot while inside'''
+    ident = threading.get_ident()
+    _thread_robots[ident] = robot
+    try:
+        yield
+    finally:
+        _thread_robots.pop(ident, None)
+
+
+class StartupTimeline:
+    '''
+    Records named startup phases against a monotonic clock and prints them
+    as a timeline. When disabled every call is a no-op so the timeline can be
+    threaded through the startup path unconditionally.
+    '''
+
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self._start = time.monotonic()
+        self._marks = []
+        self._lock = threading.Lock()
+
+    def mark(self, phase):
+        ''' Record that phase has just finished'''
+        if not self.enabled:
+            return
+        with self._lock:
+            self._marks.append((phase, time.monotonic()))
+
+    def elapsed(self):
+        return time.monotonic() - self._start
+
+    def report(self):
+        ''' Print each phase with its duration and time since startup'''
+        if not self.enabled:
+            return
+        with self._lock:
+            marks = list(self._marks)
+        print("Startup timeline:")
+        previous = self._start
+        for phase, stamp in marks:
+            print(f"    {stamp - self._start:8.3f}s  "
+                  f"(+{stamp - previous:7.3f}s)  {phase}")
+            previous = stamp
+
+
+class TimedLock:
+    '''
+    A drop-in replacement for threading.Lock that records how often and for
+    how long callers had to wait to acquire it.
+    '''
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.acquisitions = 0
+        self.contended = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def acquire(self, blocking=True, timeout=-1):
+        if self._lock.acquire(blocking=False):
+            self.acquisitions += 1
+            return True
+        if not blocking:
+            return False
+        start = time.perf_counter()
+        acquired = self._lock.acquire(timeout=timeout)
+        if acquired:
+            # Stats are only modified while holding the lock
+            waited = time.perf_counter() - start
+            self.acquisitions += 1
+            self.contended += 1
+            self.total_wait += waited
+            self.max_wait = max(self.max_wait, waited)
+        return acquired
+
+    def release(self):
+        self._lock.release()
+
+    def locked(self):
+        return self._lock.locked()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+    def stats(self):
+        return {
+            'acquisitions': self.acquisitions,
+            'contended': self.contended,
+            'total_wait': self.total_wait,
+            'max_wait': self.max_wait}
+
+
+class SamplingProfiler:
+    '''
+    Samples the stacks of all threads at a fixed interval and counts them
+    as folded stacks, the input format of flamegraph.pl and speedscope.
+    Every stack starts with the subsystem and robot the thread was working
+    for, e.g. "tasks;temi_1;TemiCommandHandle:_follow_path;...".
+    '''
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self._stacks = collections.Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop_event = threading.Event()
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def start(self, window=None, done=None):
+        '''
+        Start sampling, for at most window seconds if given. done is called
+        from the sampling thread when the window has passed. Returns False
+        if the profiler is already running.
+        '''
+        if self.running:
+            return False
+        with self._lock:
+            self._stacks.clear()
+        self._stop_event.clear()
+        self._thread = threading.Thread(
+            target=self._run, args=(window, done), name='temi_profiler',
+            daemon=True)
+        self._thread.start()
+        return True
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    def write(self, path):
+        ''' Write the folded stacks collected so far to path'''
+        with self._lock:
+            stacks = sorted(self._stacks.items())
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w') as f:
+            for stack, count in stacks:
+                f.write(f"{stack} {count}\n")
+        return path
+
+    def _run(self, window, done):
+        deadline = None if window is None else time.monotonic() + window
+        me = threading.get_ident()
+        while not self._stop_event.wait(self.interval):
+            if deadline is not None and time.monotonic() >= deadline:
+                if done is not None:
+                    done()
+                return
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            samples = []
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                samples.append(self._fold(
+                    names.get(ident, str(ident)), _thread_robots.get(ident), frame))
+            with self._lock:
+                self._stacks.update(samples)
+
+    @staticmethod
+    def _fold(thread_name, robot, frame):
+        frames = []
+        while frame is not None:
+            code = frame.f_code
+            module = os.path.splitext(os.path.basename(code.co_filename))[0]
+            frames.append(f"{module}:{code.co_name}")
+            frame = frame.f_back
+        frames.reverse()
+        subsystem = thread_name
+        for prefix, name in SUBSYSTEMS:
+            if thread_name.startswith(prefix):
+                subsystem = name
+                break
+        else:
+            if any(f.startswith('client:_thread_main') for f in frames):
+                subsystem = 'mqtt'
+        return ';'.join([subsystem, robot or '-'] + frames)
+
+
+class ProfilingService:
+    '''
+    Runtime control of a SamplingProfiler through a std_srvs/SetBool
+    service named <node name>/profile: true starts profiling for window
+    seconds, false stops early. toggle() does either. Signal handlers call
+    request_toggle(), which only sets an event; a control thread does the
+    toggle, so a signal never blocks on the profiler's lock or thread.
+    Profiles are written to output_dir.
+    '''
+
+    def __init__(self, node, window=30.0, interval=0.01, output_dir='/tmp'):
+        # Only needed when the adapter runs under ROS
+        from std_srvs.srv import SetBool
+
+        self.node = node
+        self.window = window
+        self.output_dir = output_dir
+        self.profiler = SamplingProfiler(interval)
+        # Serializes start and stop between the service and the control
+        # thread
+        self._lock = threading.Lock()
+        self._toggle_requested = threading.Event()
+        self._control = threading.Thread(
+            target=self._run_control, name='temi_profiler_control',
+            daemon=True)
+        self._control.start()
+        self.service = node.create_service(
+            SetBool, f'{node.get_name()}/profile', self._on_request)
+
+    def start(self):
+        with self._lock:
+            if not self.profiler.start(self.window, done=self._write):
+                return False
+        self.node.get_logger().info(
+            f"Profiling all threads for up to {self.window:.0f}s")
+        return True
+
+    def stop(self):
+        ''' Stop early and write the profile. Returns its path, or None
+            if the profiler was not running'''
+        with self._lock:
+            if not self.profiler.running:
+                return None
+            self.profiler.stop()
+            return self._write()
+
+    def toggle(self):
+        if self.profiler.running:
+            self.stop()
+        else:
+            self.start()
+
+    def request_toggle(self):
+        ''' Toggle from the control thread. Safe to call from a signal
+            handler'''
+        self._toggle_requested.set()
+
+    def _run_control(self):
+        while True:
+            self._toggle_requested.wait()
+            self._toggle_requested.clear()
+            self.toggle()
+
+    def _write(self):
+        path = os.path.join(
+            self.output_dir,
+            time.strftime('temi_profile_%Y%m%d_%H%M%S.folded'))
+        self.profiler.write(path)
+        self.node.get_logger().info(f"Profile written to {path}")
+        return path
+
+    def _on_request(self, request, response):
+        if request.data:
+            response.success = self.start()
+            response.message = 'started' if response.success else 'already running'
+        else:
+            path = self.stop()
+            response.success = path is not None
+            response.message = path or 'not running'
+        return response
@@ -0,0 +1,179 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Rate limited, prioritized publishing of robot commands. Commands are
+    queued in one lane per priority class and handed to the MQTT client by
+    a single sender thread. A command is only sent when both the global
+    token bucket and the bucket of its robot have a token, and never while
+    a command of a higher class could be sent instead. Stop commands are
+    not rate limited at all.
+'''
+
+import threading
+import time
+
+from collections import deque
+
+
+STOP, NAVIGATION, QUERY, MEDIA = range(4)
+PRIORITY_NAMES = ('stop', 'navigation', 'query', 'media')
+
+
+def priority_of(command):
+    ''' Priority class of a command, e.g. "move/stop" or "tts"'''
+    if command == 'move/stop':
+        return STOP
+    if command == 'getData/loadMap' or command.startswith(
+            ('waypoint/', 'move/', 'follow/')):
+        return NAVIGATION
+    if command.startswith(('getData/', 'test/')):
+        return QUERY
+    return MEDIA
+
+
+class TokenBucket:
+
+    def __init__(self, rate, burst):
+        ''' rate tokens per second, holding at most burst tokens'''
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self._stamp = None
+
+    def delay(self, now):
+        ''' Seconds until a token is available'''
+        if self._stamp is not None:
+            self.tokens = min(
+                self.burst, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+        if self.tokens >= 1.0:
+            return 0.0
+        return (1.0 - self.tokens) / self.rate
+
+    def take(self):
+        self.tokens -= 1.0
+
+
+class PublishScheduler:
+
+    def __init__(self, client, rate=50.0, burst=20, robot_rate=10.0,
+                 robot_burst=5, clock=time.monotonic):
+        '''
+        rate and burst limit the messages per second of the whole client,
+        robot_rate and robot_burst those sent to any one robot.
+        '''
+        self.client = client
+        self.clock = clock
+        self.robot_rate = robot_rate
+        self.robot_burst = robot_burst
+        self._bucket = TokenBucket(rate, burst)
+        self._robot_buckets = {}
+        self._lanes = [deque() for _ in PRIORITY_NAMES]
+        self._changed = threading.Condition()
+        self._stopped = False
+        self._thread = None
+        # Per priority class
+        self.sent = [0] * len(PRIORITY_NAMES)
+        self.throttled = [0] * len(PRIORITY_NAMES)
+        self.total_wait = [0.0] * len(PRIORITY_NAMES)
+        self.max_wait = [0.0] * len(PRIORITY_NAMES)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            target=self._run, name='temi_publisher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        with self._changed:
+            self._stopped = True
+            self._changed.notify_all()
+
+    def publish(self, key, topic, payload, qos=0, priority=MEDIA):
+        ''' Queue a message for the robot identified by key. Returns at
+            once.'''
+        with self._changed:
+            self._lanes[priority].append(
+                (key, topic, payload, qos, self.clock(), [False]))
+            self._changed.notify()
+
+    def stats(self):
+        '''
+        Per priority class: messages waiting and sent, how many of them
+        had to wait for a token, and their mean and max queueing delay in
+        seconds.
+        '''
+        with self._changed:
+            return {
+                name: {
+                    'queued': len(self._lanes[i]),
+                    'sent': self.sent[i],
+                    'throttled': self.throttled[i],
+                    'mean_wait': self.total_wait[i] / self.sent[i] if self.sent[i] else 0.0,
+                    'max_wait': self.max_wait[i]}
+                for i, name in enumerate(PRIORITY_NAMES)}
+
+    def _robot_bucket(self, key):
+        bucket = self._robot_buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.robot_rate, self.robot_burst)
+            self._robot_buckets[key] = bucket
+        return bucket
+
+    def _next(self, now):
+        '''
+        Remove and return (priority, message) of the next message that may
+        be sent, or (None, seconds to wait) if none may be sent yet.
+        '''
+        wait = None
+        global_delay = self._bucket.delay(now)
+        for priority, lane in enumerate(self._lanes):
+            for index, message in enumerate(lane):
+                if priority == STOP:
+                    del lane[index]
+                    return priority, message
+                delay = max(global_delay, self._robot_bucket(message[0]).delay(now))
+                if delay == 0.0:
+                    self._bucket.take()
+                    self._robot_bucket(message[0]).take()
+                    del lane[index]
+                    return priority, message
+                message[5][0] = True  # had to wait for a token
+                wait = delay if wait is None else min(wait, delay)
+            if lane and global_delay > 0.0:
+                # Lower classes must not overtake this one
+                return None, global_delay
+        return None, wait
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while True:
+                    if self._stopped:
+                        return
+                    now = self.clock()
+                    priority, message = self._next(now)
+                    if priority is not None:
+                        break
+                    # message is the time until a token is available here
+                    self._changed.wait(message)
+                key, topic, payload, qos, queued, throttled = message
+                waited = now - queued
+                self.sent[priority] += 1
+                self.throttled[priority] += throttled[0]
+                self.total_wait[priority] += waited
+                self.max_wait[priority] = max(self.max_wait[priority], waited)
+            self.client.publish(topic, payload, qos=qos)
@@ -5,6 +5,7 @@
 """
 import json
 import re
+import threading
 import time
 import uuid
 
@@ -13,367 +14,395 @@ from datetime import datetime
 from paho.mqtt.packettypes import PacketTypes
 from paho.mqtt.properties import Properties
 
+from .coalescer import CommandCoalescer
+from .heartbeat import LinkHealth
+from .history import RobotHistory
+from .locations import LocationIndex
+from .maps import MapLoader
+from .publisher import priority_of
+from .telemetry import FleetTelemetry, goto_status_code, goto_status_name
+from .teleop import TeleopStream
+
+# seconds to wait for a command to be acknowledged on its response topic
+RESPONSE_TIMEOUT = 2.5
+
 
 def now():
-    """Return time in string format"""
-    return datetime.now().strftime("%H:%M:%S")
+    """Return wall-clock time in string format, with milliseconds"""
+    return datetime.now().strftime("%H:%M:%S.%f")[:-3]
 
 
-def _on_status(client, userdata, msg):
+# The subscription callbacks below receive the Robot the message is for as
+# their userdata. Numeric state goes into the robot's row of the telemetry
+# table, everything else into robot.state.
+
+def _on_status(client, robot, msg):
     """Periodically updates the locations in map"""
     d = json.loads(msg.payload)
-    userdata["locations"] = d["waypoint_list"]
+    robot.state["locations"] = d["waypoint_list"]
+    robot.location_index.update(d["waypoint_list"])
 
 
-def _on_battery(client, userdata, msg):
+def _on_battery(client, robot, msg):
     print("[{}] [SUB] [BATTERY] {}".format(now(), json.loads(msg.payload)))
     d = json.loads(msg.payload)["batteryData"]
 
     split_string = re.split('[= , ( )]', d)
-    userdata["battery"]["percentage"] = float(split_string[2]) / 100
-    userdata["battery"]["is_charging"] = split_string[-2]
+    stamp = time.monotonic()
+    robot.telemetry.write(robot.row,
+                          soc=float(split_string[2]) / 100,
+                          charging=split_string[-2] == "true",
+                          battery_stamp=stamp)
+    robot.record_sample(stamp)
+    robot.state["ready"]["battery"].set()
 
 
-def _on_goto(client, userdata, msg):
+def _on_goto(client, robot, msg):
     d = json.loads(msg.payload)
-    userdata["goto"]["location"] = d["location"]
-    userdata["goto"]["status"] = d["status"]
+    robot.state["goto"]["location"] = d["location"]
+    stamp = time.monotonic()
+    robot.telemetry.write(robot.row,
+                          goto_status=goto_status_code(d["status"]),
+                          goto_stamp=stamp)
+    robot.record_sample(stamp)
+    for listener in robot.goto_listeners:
+        listener(d["status"], d["location"])
 
 
-def _on_user(client, userdata, msg):
+def _on_user(client, robot, msg):
     print("[{}] [SUB] [USER] {}".format(now(), json.loads(msg.payload)))
-    userdata["user"] = json.loads(msg.payload)
-
+    robot.state["user"] = json.loads(msg.payload)
 
-def _on_currentPosition(client, userdata, msg):
-    print("[{}] [SUB] [CURRENT POSITION] {}".format(now(), json.loads(msg.payload)))
-    split_response = re.split('[= , )]', str(msg.payload))
-    userdata["currentPosition"] = {"x": float(split_response[1]),
-                                   "y": float(split_response[4]),
-                                   "yaw": float(split_response[7]),
-                                   "tiltAngle": float(split_response[10])}
 
-
-def _on_durationToDestination(client, userdata, msg):
+def _on_currentPosition(client, robot, msg):
+    # paho stamps messages with time.monotonic() when it decodes them
+    received = getattr(msg, "timestamp", None) or time.monotonic()
+    d = json.loads(msg.payload)
+    # x, y, yaw and tilt angle, in the order the robot sends them
+    x, y, yaw, tilt = (float(value) for value in list(d.values())[:4])
+    parsed = time.monotonic()
+    robot.telemetry.write(robot.row,
+                          x=x, y=y, yaw=yaw, tilt=tilt,
+                          position_received=received,
+                          position_parsed=parsed)
+    # stamped once the pose is in the table, so the store span covers the
+    # write. Readers take the pose as new when the stamp changes
+    stamp = time.monotonic()
+    robot.telemetry.write(robot.row, position_stamp=stamp)
+    print("[{}] [SUB] [CURRENT POSITION] {}".format(now(), d))
+    robot.record_sample(stamp)
+    robot.state["ready"]["currentPosition"].set()
+
+
+def _on_durationToDestination(client, robot, msg):
     print("[{}] [SUB] [DURATION TO DESTINATION] {}".format(now(), json.loads(msg.payload)))
-    userdata["durationToDestination"] = json.loads(msg.payload)
+    d = json.loads(msg.payload)
+    robot.telemetry.write(robot.row,
+                          duration=float(d.get("duration", 0.0)),
+                          duration_stamp=time.monotonic())
 
 
-def _on_receiveTestConnection(client, userdata, msg):
+def _on_receiveTestConnection(client, robot, msg):
     # print("[{}] [SUB] [TEST RECEIVE MESSAGE] {}".format(now(), msg.payload))
-    t = 1
+    try:
+        probe_id = json.loads(msg.payload).get("requestId")
+    except (ValueError, AttributeError):
+        probe_id = None
+    robot.link.reply(probe_id, time.monotonic())
 
 
 class Robot:
     """Robot Class"""
 
-    def __init__(self, mqtt_client, temi_serial, silent=True):
+    # seconds between writes of last_heard to the telemetry table, so that
+    # a burst of messages is not a burst of table writes
+    HEARD_RESOLUTION = 0.1
+
+    def __init__(self, mqtt_client, temi_serial, silent=True, telemetry=None, history=None,
+                 heartbeat_timeout=3.0, teleop=None):
         """Constructor"""
         self.client = mqtt_client
         self.id = temi_serial
         self.silent = silent
         self.successfulResponse = False
 
-        # set user data
-        # initialized default values for temi robot for location and current position
-        self.state = {"locations": ["home base"], "battery": {},
-                      "goto": {"location": "home base", "status": "complete"}, "user": {},
-                      "currentPosition": {"x": 0.0, "y": 0.0, "yaw": 0.0, "tiltAngle": 50},
-                      "durationToDestination": {'duration': 0.0}}
-        self.client.user_data_set(self.state)
-
-        # attach subscription callbacks
-        self.client.message_callback_add(
-            "temi/{}/status/info".format(temi_serial), _on_status
-        )
-        self.client.message_callback_add(
-            "temi/{}/status/utils/battery".format(temi_serial), _on_battery
-        )
-        self.client.message_callback_add(
-            "temi/{}/status/utils/currentPosition".format(temi_serial), _on_currentPosition
-        )
-        self.client.message_callback_add(
-            "temi/{}/status/utils/durationToDestination".format(temi_serial), _on_durationToDestination
-        )
-        self.client.message_callback_add(
-            "temi/{}/event/waypoint/goto".format(temi_serial), _on_goto
-        )
-        self.client.message_callback_add(
-            "temi/{}/event/user/detection".format(temi_serial), _on_user
-        )
-        self.client.message_callback_add(
-            "temi/{}/event/test/testConnection".format(temi_serial), _on_receiveTestConnection
-        )
-
-        # call method to initialize battery information
-        self.getBatteryData()
-        self.getCurrentPosition()
-        time.sleep(1)
+        # position, battery, goto status and duration live in a row of the
+        # (usually fleet-wide) telemetry table
+        if telemetry is None:
+            telemetry = FleetTelemetry(capacity=1)
+        self.telemetry = telemetry
+        self.row = telemetry.add(temi_serial)
+        # bounded record of recent telemetry and commands
+        if history is None:
+            history = RobotHistory()
+        self.history = history
+
+        # the last goal sent to the robot. Its goto status is "start" until
+        # the robot reports on it
+        self.goal = {"location": "home base", "stamp": -float("inf")}
+        # round trip time and liveness from heartbeat probes, see ping()
+        self.link = LinkHealth(timeout=heartbeat_timeout)
+        self._heard_written = -float("inf")
+
+        # drops repeated commands and goals that were replaced before
+        # they could be sent
+        self.commands = CommandCoalescer()
+
+        # called with (status, location) on every goto event, from the MQTT
+        # network thread. Listeners must return quickly
+        self.goto_listeners = []
+
+        # initialized default values for temi robot for location
+        self.state = {"locations": ["home base"],
+                      "goto": {"location": "home base"}, "user": {},
+                      "ready": {"currentPosition": threading.Event(),
+                                "battery": threading.Event()}}
+
+        # saved locations by normalized name, kept up to date by status/info
+        self.location_index = LocationIndex(self.state["locations"])
+
+        # paced, latest-only joystick, rotate and tilt commands for manual
+        # driving; teleop holds its period and deadman timeout
+        self.teleop = TeleopStream(self._send, **(teleop or {}))
+
+        # the map loaded on the robot, only reloaded on a level change
+        self.maps = MapLoader(self._load_map_at)
+
+        # requests waiting for their response, by request ID
+        self._responses = {}
+
+        # attach subscription callbacks. Robots may share a client, so each
+        # callback is bound to this robot instead of relying on the client's
+        # user data. Responses to all commands go to one callback
+        router = self.client.router
+        router.route(temi_serial, "responseTopic", self._on_response)
+        router.route(temi_serial, "status/info", self._bind(_on_status))
+        router.route(temi_serial, "status/utils/battery", self._bind(_on_battery))
+        router.route(temi_serial, "status/utils/currentPosition", self._bind(_on_currentPosition))
+        router.route(temi_serial, "status/utils/durationToDestination",
+                     self._bind(_on_durationToDestination))
+        router.route(temi_serial, "event/waypoint/goto", self._bind(_on_goto))
+        router.route(temi_serial, "event/user/detection", self._bind(_on_user))
+        router.route(temi_serial, "event/test/testConnection",
+                     self._bind(_on_receiveTestConnection))
+
+        # request initial battery information and position without blocking;
+        # wait_until_ready() returns once the first replies have arrived
+        self.getBatteryData(wait=False)
+        self.getCurrentPosition(wait=False)
+
+    def record_sample(self, stamp):
+        """Append the current telemetry of this robot to its history"""
+        x, y, yaw, soc, goto_status = self.telemetry.read(
+            self.row, "x", "y", "yaw", "soc", "goto_status")
+        self.history.record_sample(stamp, x, y, yaw, soc, goto_status)
+
+    def _bind(self, callback):
+        """Return callback with this robot passed as its userdata"""
+        def bound_callback(client, userdata, msg):
+            self.heard(time.monotonic())
+            callback(client, self, msg)
+        return bound_callback
+
+    def heard(self, stamp):
+        """Record that a message arrived. The stamp is also kept in the
+        telemetry table, where other processes can see that the robot is
+        alive"""
+        self.link.heard(stamp)
+        if stamp - self._heard_written >= self.HEARD_RESOLUTION:
+            self._heard_written = stamp
+            self.telemetry.write(self.row, last_heard=stamp)
 
     def checkIfDockingCompleted(self):
-        return self.state == "complete" and self.currentLocation == "home base"
+        """Docked once the goal to home base completed and it is charging"""
+        return (self.status == self.GOTO_COMPLETE and
+                self.currentLocation == self.HOME_BASE and
+                bool(self.battery.get("is_charging", False)))
 
     def navigationCompleted(self):
         return self.status == "complete"
 
-    def stop(self):
-        """Stop"""
-        if not self.silent:
-            print("[CMD] Stop")
-
-        topic = "temi/" + self.id + "/command/move/stop"
+    def _request(self, command, name, fields=None, wait=True, slot=None,
+                 replace=False, supersedes=(), on_send=None):
+        """Publish a command and wait for its response on the response topic
+
+        Returns True if the response arrived within RESPONSE_TIMEOUT, False
+        if it did not, and None if wait is False or the command was replaced
+        before it was sent. Commands that are waited for go through the
+        coalescer, see coalescer.py; slot defaults to the command. on_send
+        is called right before the command is published.
+        """
+        def send():
+            if on_send is not None:
+                on_send()
+            return self._publish(command, name, fields, wait)
+
+        if not wait:
+            return send()
+        key = (command, json.dumps(fields, sort_keys=True))
+        return self.commands.submit(
+            slot or command, key, send, replace=replace, supersedes=supersedes)
+
+    def _publish(self, command, name, fields, wait):
+        topic = "temi/" + self.id + "/command/" + command
+        responseTopic = "temi/" + self.id + "/responseTopic/" + command
+        requestId = str(uuid.uuid4())
+        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        request = {"requestId": requestId}
+        request.update(fields or {})
+        request.update({"responseTopic": responseTopic, "timestamp": timestamp})
+        payload = json.dumps(request)
 
-        try:
-            self.successfulResponse = False
-
-            responseTopic = "temi/" + self.id + "/responseTopic/move/stop"
-            requestId = str(uuid.uuid4())
-            timestamp = datetime.now().strftime("%Y-%M-%d %H:%M:%S")
-            payload = json.dumps({"requestId": requestId, "responseTopic": responseTopic, "timestamp": timestamp})
+        self.successfulResponse = False
+        if wait:
+            response = threading.Event()
+            self._responses[requestId] = response
 
-            def stop_callback(client, userdata, msg):
-                if json.loads(msg.payload)["requestId"] == requestId:
-                    self.successfulResponse = True
+        # Generate message with response topic and correlation data
+        print("[{}] [PUB] [{}] {}".format(now(), name, payload))
+        self._send(command, payload, qos=2)
 
-            self.client.message_callback_add(
-                responseTopic.format(self.id), stop_callback
-            )
+        if not wait:
+            return None
 
-            # Generate message with response topic and correlation data
-            print("[{}] [PUB] [STOP] {}".format(now(), payload))
-            self.client.publish(topic, payload, qos=2)
+        # Block until the response callback fires instead of polling
+        try:
+            if response.wait(RESPONSE_TIMEOUT):
+                print("[{}] [SUCCESS] Response received for request ID: {}, {}".format(
+                    now(), requestId, topic))
+                return True
+        finally:
+            self._responses.pop(requestId, None)
+
+        print("[{}] [ERROR] Response not received for request ID: {}, {}".format(
+            now(), requestId, topic))
+        return False
+
+    def _on_response(self, client, userdata, msg):
+        response = self._responses.pop(json.loads(msg.payload).get("requestId"), None)
+        if response is not None:
+            self.successfulResponse = True
+            response.set()
+
+    def _send(self, command, payload, qos):
+        """Queue a command on the client's rate limited publisher"""
+        self.client.publisher.publish(
+            self.id, "temi/" + self.id + "/command/" + command, payload,
+            qos=qos, priority=priority_of(command))
+
+    def ping(self):
+        """Send a heartbeat probe, answered on event/test/testConnection"""
+        probe_id = self.link.probe_sent(time.monotonic())
+        self._send("test/testConnection", json.dumps({"requestId": probe_id}), qos=0)
+
+    def wait_until_ready(self, timeout=None):
+        """Block until the first position and battery messages have arrived
+
+        Returns True if the robot is ready, False if the timeout expired.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for event in self.state["ready"].values():
+            remaining = None if deadline is None else max(0.0, deadline - time.monotonic())
+            if not event.wait(remaining):
+                return False
+        return True
 
-            # Loop to check if a response is received
-            # Will loop 5 times or until a response is received
-            for _ in range(5):
-                if not self.successfulResponse:
-                    time.sleep(0.5)
-                else:
-                    print("[{}] [SUCCESS] Response received for request ID: {}, {}".format(now(), requestId, topic))
-                    break
+    @property
+    def ready(self):
+        return all(event.is_set() for event in self.state["ready"].values())
 
-            if not self.successfulResponse:
-                print("[{}] [ERROR] Response not received for request ID: {}, {}".format(now(), requestId, topic))
+    def stop(self):
+        """Stop. Returns the result of _request"""
+        if not self.silent:
+            print("[CMD] Stop")
 
+        self.history.record_command("stop")
+        try:
+            return self._request("move/stop", "STOP", supersedes=("goto",))
         except Exception as e:
             print("Exception received when stopping robot! ", e)
+            return False
 
-    def goToLocation(self, location_name):
-        self.state["goto"]["location"] = location_name
-        self.state["goto"]["status"] = "start"
+    def _set_goal(self, location):
+        self.goal = {"location": location, "stamp": time.monotonic()}
 
-        """Go to a saved location"""
+    def goToLocation(self, location_name):
+        """Go to a saved location. Returns the result of _request"""
         if not self.silent:
             print("[CMD] Go-To Location: {}".format(location_name))
 
-        topic = "temi/" + self.id + "/command/waypoint/goToLocation"
-
+        self.history.record_command("goToLocation")
         try:
-            self.successfulResponse = False
-
-            responseTopic = "temi/" + self.id + "/responseTopic/waypoint/goToLocation"
-            requestId = str(uuid.uuid4())
-            timestamp = datetime.now().strftime("%Y-%M-%d %H:%M:%S")
-            payload = json.dumps({"requestId": requestId, "location": location_name,
-                                  "responseTopic": responseTopic, "timestamp": timestamp})
-
-            def go_to_location_callback(client, userdata, msg):
-                if json.loads(msg.payload)["requestId"] == requestId:
-                    self.successfulResponse = True
-
-            self.client.message_callback_add(
-                responseTopic.format(self.id), go_to_location_callback
-            )
-
-            # Generate message with response topic and correlation data
-            print("[{}] [PUB] [GO TO LOCATION] {}".format(now(), payload))
-            self.client.publish(topic, payload, qos=2)
-
-            # Loop to check if a response is received
-            # Will loop 5 times or until a response is received
-            for _ in range(5):
-                if not self.successfulResponse:
-                    time.sleep(0.5)
-                else:
-                    print("[{}] [SUCCESS] Response received for request ID: {}, {}".format(now(), requestId, topic))
-                    break
-
-            if not self.successfulResponse:
-                print("[{}] [ERROR] Response not received for request ID: {}, {}".format(now(), requestId, topic))
-
+            return self._request("waypoint/goToLocation", "GO TO LOCATION",
+                          {"location": location_name}, slot="goto", replace=True,
+                          on_send=lambda: self._set_goal(location_name))
         except Exception as e:
             print("Exception received when going to location! ", e)
+            return False
 
     def goToPosition(self, x, y, yaw, tiltAngle=22):
-        self.state["goto"]["location"] = "COORDINATES"
-        self.state["goto"]["status"] = "start"
-
-        """Go to a position"""
+        """Go to a position. Returns the result of _request"""
         if not self.silent:
             print("[CMD] Go-To Position:({}, {}), Angle = {} ".format(x, y, yaw))
 
-        topic = "temi/" + self.id + "/command/waypoint/goToPosition"
+        self.history.record_command("goToPosition", x, y, yaw)
         try:
-            self.successfulResponse = False
-
-            responseTopic = "temi/" + self.id + "/responseTopic/waypoint/goToPosition"
-            requestId = str(uuid.uuid4())
-            timestamp = datetime.now().strftime("%Y-%M-%d %H:%M:%S")
-            payload = json.dumps({"requestId": requestId, "x": x, "y": y, "yaw": yaw, "tiltAngle": tiltAngle,
-                                  "responseTopic": responseTopic, "timestamp": timestamp})
-
-            def go_to_position_callback(client, userdata, msg):
-                if json.loads(msg.payload)["requestId"] == requestId:
-                    self.successfulResponse = True
-
-            self.client.message_callback_add(
-                responseTopic.format(self.id), go_to_position_callback
-            )
-
-            # Generate message with response topic and correlation data
-            print("[{}] [PUB] [GO TO POSITION] {}".format(now(), payload))
-            self.client.publish(topic, payload, qos=2)
-
-            # Loop to check if a response is received
-            # Will loop 5 times or until a response is received
-            for _ in range(5):
-                if not self.successfulResponse:
-                    time.sleep(0.5)
-                else:
-                    print("[{}] [SUCCESS] Response received for request ID: {}, {}".format(now(), requestId, topic))
-                    break
-
-            if not self.successfulResponse:
-                print("[{}] [ERROR] Response not received for request ID: {}, {}".format(now(), requestId, topic))
-
+            return self._request("waypoint/goToPosition", "GO TO POSITION",
+                          {"x": x, "y": y, "yaw": yaw, "tiltAngle": tiltAngle},
+                          slot="goto", replace=True,
+                          on_send=lambda: self._set_goal("COORDINATES"))
         except Exception as e:
             print("Exception received when going to position! ", e)
+            return False
 
-    def getBatteryData(self):
+    def getBatteryData(self, wait=True):
         """Get Battery Data"""
         if not self.silent:
             print("[CMD] Get Battery Data")
-        topic = "temi/" + self.id + "/command/getData/batteryData"
 
+        self.history.record_command("getBatteryData")
         try:
-            self.successfulResponse = False
-
-            responseTopic = "temi/" + self.id + "/responseTopic/getData/batteryData"
-            requestId = str(uuid.uuid4())
-            timestamp = datetime.now().strftime("%Y-%M-%d %H:%M:%S")
-            payload = json.dumps({"requestId": requestId, "responseTopic": responseTopic, "timestamp": timestamp})
-
-            def get_battery_data_callback(client, userdata, msg):
-                if json.loads(msg.payload)["requestId"] == requestId:
-                    self.successfulResponse = True
-
-            self.client.message_callback_add(
-                responseTopic.format(self.id), get_battery_data_callback
-            )
-
-            # Generate message with response topic and correlation data
-            print("[{}] [PUB] [BATTERY] {}".format(now(), payload))
-            self.client.publish(topic, payload, qos=2)
-
-            # Loop to check if a response is received
-            # Will loop 5 times or until a response is received
-            for _ in range(5):
-                if not self.successfulResponse:
-                    time.sleep(0.5)
-                else:
-                    print("[{}] [SUCCESS] Response received for request ID: {}, {}".format(now(), requestId, topic))
-                    break
-
-            if not self.successfulResponse:
-                print("[{}] [ERROR] Response not received for request ID: {}, {}".format(now(), requestId, topic))
-
+            self._request("getData/batteryData", "BATTERY", wait=wait)
         except Exception as e:
             print("Exception received when getting battery data! ", e)
 
-    def getCurrentPosition(self):
+    def getCurrentPosition(self, wait=True):
         """Get Current Position"""
         if not self.silent:
             print("[CMD] Current Position")
 
-        topic = "temi/" + self.id + "/command/getData/currentPosition"
-
+        self.history.record_command("getCurrentPosition")
         try:
-            self.successfulResponse = False
-
-            responseTopic = "temi/" + self.id + "/responseTopic/getData/currentPosition"
-            requestId = str(uuid.uuid4())
-            timestamp = datetime.now().strftime("%Y-%M-%d %H:%M:%S")
-            payload = json.dumps({"requestId": requestId, "responseTopic": responseTopic, "timestamp": timestamp})
-
-            def get_current_position_callback(client, userdata, msg):
-                if json.loads(msg.payload)["requestId"] == requestId:
-                    self.successfulResponse = True
-
-            self.client.message_callback_add(
-                responseTopic.format(self.id), get_current_position_callback
-            )
-
-            # Generate message with response topic and correlation data
-            print("[{}] [PUB] [CURRENT POSITION] {}".format(now(), payload))
-            self.client.publish(topic, payload, qos=2)
-
-            # Loop to check if a response is received
-            # Will loop 5 times or until a response is received
-            for _ in range(5):
-                if not self.successfulResponse:
-                    time.sleep(0.5)
-                else:
-                    print("[{}] [SUCCESS] Response received for request ID: {}, {}".format(now(), requestId, topic))
-                    break
-
-            if not self.successfulResponse:
-                print("[{}] [ERROR] Response not received for request ID: {}, {}".format(now(), requestId, topic))
-
+            self._request("getData/currentPosition", "CURRENT POSITION", wait=wait)
         except Exception as e:
             print("Exception received when getting current position! ", e)
 
     def loadMap(self, mapName, x=0.0, y=0.0, yaw=0.0, tiltAngle=22):
-        """Load Map: Will be loaded to position (0, 0) in new map by default if no position is specified"""
+        """Load Map: Will be loaded to position (0, 0) in new map by default if no
+        position is specified
+
+        Returns True if the robot acknowledged the new map
+        """
         if not self.silent:
             print("[CMD] Load New Map with Map Name = {} ".format(mapName))
 
-        topic = "temi/" + self.id + "/command/getData/loadMap"
-
+        self.history.record_command("loadMap", x, y, yaw)
         try:
-            self.successfulResponse = False
-
-            responseTopic = "temi/" + self.id + "/responseTopic/getData/loadMap"
-            requestId = str(uuid.uuid4())
-            timestamp = datetime.now().strftime("%Y-%M-%d %H:%M:%S")
-            payload = json.dumps({"requestId": requestId, "mapName": mapName, "x": x, "y": y, "yaw": yaw,
-                                  "tiltAngle": tiltAngle, "responseTopic": responseTopic, "timestamp": timestamp})
-
-            def load_map_callback(client, userdata, msg):
-                if json.loads(msg.payload)["requestId"] == requestId:
-                    self.successfulResponse = True
-
-            self.client.message_callback_add(
-                responseTopic.format(self.id), load_map_callback
-            )
-
-            # Generate message with response topic and correlation data
-            print("[{}] [PUB] [LOAD MAP] {}".format(now(), payload))
-            self.client.publish(topic, payload, qos=2)
-
-            # Loop to check if a response is received
-            # Will loop 5 times or until a response is received
-            for _ in range(5):
-                if not self.successfulResponse:
-                    time.sleep(0.5)
-                else:
-                    print("[{}] [SUCCESS] Response received for request ID: {}, {}".format(now(), requestId, topic))
-                    break
-
-            if not self.successfulResponse:
-                print("[{}] [ERROR] Response not received for request ID: {}, {}".format(now(), requestId, topic))
-
+            return self._request("getData/loadMap", "LOAD MAP",
+                                 {"mapName": mapName, "x": x, "y": y, "yaw": yaw,
+                                  "tiltAngle": tiltAngle})
         except Exception as e:
             print("Exception received when loading map! ", e)
+            return False
+
+    def _load_map_at(self, mapName, pose=None):
+        """Load a map with the robot at pose [x, y, yaw] on that map, e.g. the
+        lift on the new level. Without a pose the robot is placed where it
+        last reported to be, which is only right if the maps line up"""
+        if pose is None:
+            pose = self.telemetry.read(self.row, "x", "y", "yaw")
+        x, y, yaw = [0.0 if value != value else value for value in pose]
+        return self.loadMap(mapName, x, y, yaw) is True
 
     def rotate(self, angle):
         """Rotate"""
@@ -381,39 +410,34 @@ class Robot:
             print("[CMD] Rotate: {} [deg]".format(angle))
 
         if angle != 0:
-            topic = "temi/" + self.id + "/command/move/turn_by"
             payload = json.dumps({"angle": angle})
 
-            self.client.publish(topic, payload, qos=0)
+            self._send("move/turn_by", payload, qos=0)
 
     def tilt(self, angle):
         """Tilt head (absolute angle)"""
         if not self.silent:
             print("[CMD] Tilt: {} [deg]".format(angle))
 
-        topic = "temi/" + self.id + "/command/move/tilt"
         payload = json.dumps({"angle": angle})
 
-        self.client.publish(topic, payload, qos=0)
+        self._send("move/tilt", payload, qos=0)
 
     def follow(self):
         """Follow"""
         if not self.silent:
             print("[CMD] Follow")
 
-        topic = "temi/" + self.id + "/command/follow/unconstrained"
-
-        self.client.publish(topic, "{}", qos=1)
+        self._send("follow/unconstrained", "{}", qos=1)
 
     def joystick(self, x, y):
         """Joystick"""
         if not self.silent:
             print("[CMD] Translate: {} {} [unitless]".format(x, y))
 
-        topic = "temi/" + self.id + "/command/move/joystick"
         payload = json.dumps({"x": x, "y": y})
 
-        self.client.publish(topic, payload, qos=0)
+        self._send("move/joystick", payload, qos=0)
 
     def tts(self, text):
         # print(self.currentPosition)
@@ -421,30 +445,27 @@ class Robot:
         if not self.silent:
             print("[CMD] TTS: {}".format(text))
 
-        topic = "temi/" + self.id + "/command/tts"
         payload = json.dumps({"utterance": text})
 
-        self.client.publish(topic, payload, qos=1)
+        self._send("tts", payload, qos=1)
 
     def video(self, url):
         """Play video"""
         if not self.silent:
             print("[CMD] Play Video: {}".format(url))
 
-        topic = "temi/" + self.id + "/command/media/video"
         payload = json.dumps({"url": url})
 
-        self.client.publish(topic, payload, qos=1)
+        self._send("media/video", payload, qos=1)
 
     def webview(self, url):
         """Show webview"""
         if not self.silent:
             print("[CMD] Show Webview: {}".format(url))
 
-        topic = "temi/" + self.id + "/command/media/webview"
         payload = json.dumps({"url": url})
 
-        self.client.publish(topic, payload, qos=1)
+        self._send("media/webview", payload, qos=1)
 
     @property
     def locations(self):
@@ -454,31 +475,60 @@ class Robot:
         else:
             return []
 
+    def _goal_pending(self, goto_stamp):
+        """True if the robot has not reported on the last goal yet"""
+        return not goto_stamp >= self.goal["stamp"]
+
     @property
     def status(self):
-        if "status" in self.state["goto"]:
-            return self.state["goto"]["status"]
-        else:
-            return None
+        code, stamp = self.telemetry.read(self.row, "goto_status", "goto_stamp")
+        if self._goal_pending(stamp):
+            # nothing heard about the last goal yet
+            if self.goal["stamp"] > -float("inf"):
+                return self.GOTO_START
+            return self.GOTO_COMPLETE
+        return goto_status_name(code)
 
     @property
     def currentLocation(self):
-        if "location" in self.state["goto"]:
-            return self.state["goto"]["location"]
-        else:
-            return None
+        stamp, = self.telemetry.read(self.row, "goto_stamp")
+        if self._goal_pending(stamp):
+            return self.goal["location"]
+        return self.state["goto"]["location"]
 
     @property
     def battery(self):
-        return self.state["battery"]
+        soc, charging, stamp = self.telemetry.read(
+            self.row, "soc", "charging", "battery_stamp")
+        if stamp != stamp:  # NaN until the first battery message
+            return {}
+        return {"percentage": soc, "is_charging": charging, "stamp": stamp}
+
+    @property
+    def batteryAge(self):
+        """Seconds since the battery state was received, None if never"""
+        stamp, = self.telemetry.read(self.row, "battery_stamp")
+        if stamp != stamp:
+            return None
+        return time.monotonic() - stamp
 
     @property
     def currentPosition(self):
-        return self.state["currentPosition"]
+        x, y, yaw, tilt, stamp = self.telemetry.read(
+            self.row, "x", "y", "yaw", "tilt", "position_stamp")
+        position = {"x": x, "y": y, "yaw": yaw, "tiltAngle": tilt}
+        if stamp == stamp:
+            position["stamp"] = stamp
+        return position
 
     @property
     def durationToDestination(self):
-        return self.state["durationToDestination"]
+        duration, = self.telemetry.read(self.row, "duration")
+        return {"duration": duration}
+
+    @property
+    def HOME_BASE(self):
+        return "home base"
 
     @property
     def GOTO_START(self):
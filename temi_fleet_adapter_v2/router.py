@@ -0,0 +1,65 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Routes incoming MQTT messages to handlers with dict lookups. Robot
+    topics look like temi/<serial>/<kind>, e.g. temi/00120474948/status/info,
+    and handlers are registered once per (serial, kind). A handler may also
+    be registered for the first part of a kind only, e.g. "responseTopic",
+    to receive every kind below it.
+'''
+
+
+class TopicRouter:
+
+    # The client subscribes to this once and the router sorts out the rest
+    SUBSCRIPTION = 'temi/#'
+
+    def __init__(self, unrouted=None):
+        '''
+        unrouted is an optional callback(client, userdata, msg) for
+        messages without a handler.
+        '''
+        self._handlers = {}  # (serial, kind) -> callback(client, userdata, msg)
+        self.unrouted = unrouted
+        self.routed = 0
+        self.dropped = 0
+
+    def route(self, serial, kind, handler):
+        ''' Send messages on temi/<serial>/<kind> to handler, replacing any
+            previous handler'''
+        self._handlers[(serial, kind)] = handler
+
+    def unroute(self, serial, kind):
+        self._handlers.pop((serial, kind), None)
+
+    def __len__(self):
+        return len(self._handlers)
+
+    def dispatch(self, client, userdata, msg):
+        ''' Use as the client's on_message callback'''
+        parts = msg.topic.split('/', 2)
+        handler = None
+        if len(parts) == 3 and parts[0] == 'temi':
+            serial, kind = parts[1], parts[2]
+            handler = self._handlers.get((serial, kind))
+            if handler is None:
+                handler = self._handlers.get((serial, kind.split('/', 1)[0]))
+        if handler is None:
+            self.dropped += 1
+            if self.unrouted is not None:
+                self.unrouted(client, userdata, msg)
+            return
+        self.routed += 1
+        handler(client, userdata, msg)
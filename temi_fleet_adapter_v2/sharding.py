@@ -0,0 +1,385 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Splits the robots of a fleet across worker processes. Every worker has
+    its own MQTT connection and TemiAPI for its share of the robots, and
+    writes their telemetry to a FleetTelemetry table in shared memory.
+
+    The parent process, which runs rclpy and rmf_adapter, reads positions,
+    battery and goto states and liveness straight from that table, so the
+    calls polled by the command handles never wait on a worker. Commands
+    are forwarded to the worker that owns the robot, and goto events are
+    sent back to the parent.
+'''
+
+import itertools
+import math
+import multiprocessing
+import threading
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from multiprocessing import shared_memory
+
+import yaml
+
+from .telemetry import FleetTelemetry, goto_status_name
+
+
+# seconds to wait for a worker to answer a call. Longer than
+# TemiClientAPI.MAP_LOAD_TIMEOUT, as navigate may wait for a map load
+CALL_TIMEOUT = 40.0
+
+
+def _run_worker(serials, keys, memory_name, mqtt_config_path, battery_ttl,
+                history_minutes, heartbeat, teleop, requests, replies):
+    ''' Entry point of a worker process'''
+    # paho and the robot code are only needed in the workers
+    from .TemiClientAPI import TemiAPI
+
+    memory = shared_memory.SharedMemory(name=memory_name)
+    telemetry = FleetTelemetry(
+        len(keys), buffer=memory.buf, keys=keys, reset=False)
+    api = TemiAPI(None, mqtt_config_path, battery_ttl, history_minutes,
+                  serials=serials, telemetry=telemetry, heartbeat=heartbeat,
+                  teleop=teleop)
+    for name in serials:
+        api.add_goto_listener(
+            name,
+            lambda status, location, name=name:
+                replies.put(('event', name, status, location)))
+
+    # Calls such as navigate block until the robot responds, so they must
+    # not hold up calls for other robots
+    executor = ThreadPoolExecutor(
+        max_workers=max(4, len(serials)), thread_name_prefix='temi_shard')
+
+    def call(call_id, method, args):
+        try:
+            result = getattr(api, method)(*args)
+        except Exception as e:
+            print(f"An error has occurred in {method}: {e}")
+            result = None
+        replies.put(('result', call_id, result))
+
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        executor.submit(call, *request)
+    executor.shutdown()
+    api.shutdown()
+
+
+class ShardedTemiAPI:
+    '''
+    Drop-in replacement for TemiAPI that runs the robots in worker
+    processes. Robot histories stay in the workers, so history() returns
+    None; use dump_history instead.
+    '''
+
+    def __init__(self, prefix: str, mqtt_config_path: str = 'mqtt.yaml',
+                 battery_ttl: float = 60.0, history_minutes: float = 10.0,
+                 workers: int = 2, heartbeat=None, teleop=None):
+        with open(mqtt_config_path, "r") as stream:
+            serials = yaml.safe_load(stream)['SERIAL']
+        if not isinstance(serials, dict):
+            serials = {serials: serials}
+        serials = {name: str(serial) for name, serial in serials.items()}
+        keys = list(serials.values())
+
+        self._memory = shared_memory.SharedMemory(
+            create=True, size=FleetTelemetry.nbytes(len(keys)))
+        self.telemetry = FleetTelemetry(
+            len(keys), buffer=self._memory.buf, keys=keys)
+        self.rows = {name: self.telemetry.row(serial)
+                     for name, serial in serials.items()}
+        # snapshot of the update tick, only seen by the thread that took it
+        self._tick = threading.local()
+        # seconds without a message before a robot counts as unreachable
+        self._heartbeat_timeout = (heartbeat or {}).get('timeout', 3.0)
+        # robot name -> (location, time.monotonic() stamp) of the last goal
+        # sent, taken before the worker sends it. Goto events older than the
+        # stamp are about an earlier goal
+        self._goals = {}
+
+        self._calls = itertools.count()
+        self._pending = {}  # call id -> [threading.Event, result]
+        self._listeners = {}  # robot name -> goto listeners
+
+        # spawn, not fork, so workers do not inherit the rclpy context
+        context = multiprocessing.get_context('spawn')
+        self._replies = context.Queue()
+        self._workers = []  # (process, request queue)
+        self._owners = {}  # robot name -> request queue
+        names = list(serials)
+        count = max(1, min(workers, len(names)))
+        for i in range(count):
+            shard = {name: serials[name] for name in names[i::count]}
+            requests = context.Queue()
+            process = context.Process(
+                target=_run_worker,
+                args=(shard, keys, self._memory.name, mqtt_config_path,
+                      battery_ttl, history_minutes, heartbeat, teleop,
+                      requests, self._replies),
+                name=f'temi_shard_{i}',
+                daemon=True)
+            process.start()
+            self._workers.append((process, requests))
+            for name in shard:
+                self._owners[name] = requests
+        self._reader = threading.Thread(
+            target=self._read_replies, name='temi_shard_replies', daemon=True)
+        self._reader.start()
+
+    def shutdown(self):
+        for _, requests in self._workers:
+            requests.put(None)
+        for process, _ in self._workers:
+            process.join(timeout=5.0)
+        self._replies.put(None)
+        # Views into the shared buffer must be gone before it is closed
+        self.telemetry = None
+        try:
+            self._memory.close()
+        except BufferError:
+            pass
+        self._memory.unlink()
+
+    def _resolve(self, robot_name, mapping):
+        # With a single robot every robot name refers to it, as in TemiAPI
+        if len(mapping) == 1:
+            return next(iter(mapping.values()))
+        return mapping.get(robot_name)
+
+    def _read_replies(self):
+        while True:
+            reply = self._replies.get()
+            if reply is None:
+                return
+            if reply[0] == 'result':
+                _, call_id, result = reply
+                waiter = self._pending.pop(call_id, None)
+                if waiter is not None:
+                    waiter[1] = result
+                    waiter[0].set()
+            else:
+                _, robot_name, status, location = reply
+                for listener in self._listeners.get(robot_name, ()):
+                    listener(status, location)
+
+    def _call(self, requests, method, *args, default=None):
+        if requests is None:
+            return default
+        call_id = next(self._calls)
+        waiter = [threading.Event(), default]
+        self._pending[call_id] = waiter
+        requests.put((call_id, method, args))
+        if not waiter[0].wait(CALL_TIMEOUT):
+            self._pending.pop(call_id, None)
+            print(f"No answer from worker to {method} after {CALL_TIMEOUT}s")
+            return default
+        return waiter[1]
+
+    def _call_robot(self, robot_name, method, *args, default=None):
+        return self._call(self._resolve(robot_name, self._owners),
+                          method, robot_name, *args, default=default)
+
+    def clock(self):
+        # CLOCK_MONOTONIC is shared by all processes
+        return time.monotonic()
+
+    @contextmanager
+    def snapshot(self):
+        self._tick.snapshot = self.telemetry.snapshot()
+        try:
+            yield
+        finally:
+            self._tick.snapshot = None
+
+    def _read(self, robot_name, *names):
+        row = self._resolve(robot_name, self.rows)
+        if row is None:
+            return None
+        snapshot = getattr(self._tick, 'snapshot', None)
+        if snapshot is None:
+            return self.telemetry.read(row, *names)
+        return [snapshot[name][row].item() for name in names]
+
+    def history(self, robot_name: str):
+        return None
+
+    def dump_history(self, robot_name: str, path: str):
+        return self._call_robot(robot_name, 'dump_history', path, default=False)
+
+    def _ready(self, robot_name):
+        # Read live, the snapshot may be older than the first messages
+        row = self._resolve(robot_name, self.rows)
+        if row is None:
+            return False
+        stamps = self.telemetry.read(row, 'position_stamp', 'battery_stamp')
+        return not any(math.isnan(stamp) for stamp in stamps)
+
+    def wait_until_ready(self, robot_name: str, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        # Written by another process, so poll instead of waiting on events
+        while not self._ready(robot_name):
+            if deadline is not None and time.monotonic() >= deadline:
+                return False
+            time.sleep(0.01)
+        return True
+
+    def check_connection(self):
+        return all(self._call(requests, 'check_connection', default=False)
+                   for _, requests in self._workers)
+
+    def is_reachable(self, robot_name: str):
+        # The workers keep the time each robot was last heard from in the
+        # table, so this never waits on a worker
+        heard = self._read(robot_name, 'last_heard')
+        return heard is not None and \
+            time.monotonic() - heard[0] <= self._heartbeat_timeout
+
+    def connection_health(self, robot_name: str):
+        return self._call_robot(robot_name, 'connection_health')
+
+    def getPosition(self, robot_name: str):
+        if not self._ready(robot_name):
+            return None
+        return self._read(robot_name, 'x', 'y', 'yaw')
+
+    def position_stamp(self, robot_name: str):
+        stamp = self._read(robot_name, 'position_stamp')
+        return None if stamp is None or math.isnan(stamp[0]) else stamp[0]
+
+    def position_trace(self, robot_name: str):
+        # CLOCK_MONOTONIC is shared by all processes, so the workers' stamps
+        # compare with the parent's
+        stamps = self._read(
+            robot_name, 'position_received', 'position_parsed', 'position_stamp')
+        return None if stamps is None or any(math.isnan(s) for s in stamps) \
+            else stamps
+
+    def _send_goal(self, robot_name, location, method, *args):
+        # Stamped before the worker sends the goal, kept if it was sent
+        stamp = time.monotonic()
+        sent = self._call_robot(robot_name, method, *args, default=False)
+        if sent:
+            self._goals[robot_name] = (location, stamp)
+        return sent
+
+    def _goto(self, robot_name):
+        # (status, location) of the last goal, as Robot.status and
+        # Robot.currentLocation work them out in the worker
+        location, sent = self._goals.get(robot_name, ("home base", -math.inf))
+        fields = self._read(robot_name, 'goto_status', 'goto_stamp')
+        if fields is None:
+            return None
+        code, stamp = fields
+        if not stamp >= sent:
+            # Nothing heard about the last goal yet
+            return ("start" if sent > -math.inf else "complete"), location
+        return goto_status_name(code), location
+
+    def navigate(self, robot_name: str, pose, map_name: str):
+        return self._send_goal(
+            robot_name, "COORDINATES", 'navigate', pose, map_name)
+
+    def saved_location(self, robot_name: str, waypoint_name: str):
+        return self._call_robot(robot_name, 'saved_location', waypoint_name)
+
+    def navigate_to_location(self, robot_name: str, location: str, map_name=None):
+        return self._send_goal(
+            robot_name, location, 'navigate_to_location', location, map_name)
+
+    def prepare_map(self, robot_name: str, map_name: str, pose=None):
+        self._call_robot(robot_name, 'prepare_map', map_name, pose)
+
+    def map_stats(self, robot_name: str):
+        return self._call_robot(robot_name, 'map_stats')
+
+    def teleop(self, robot_name: str, x=None, y=None, rotate=None, tilt=None):
+        # Not waited for, a slow worker must not hold up the operator
+        requests = self._resolve(robot_name, self._owners)
+        if requests is None:
+            return False
+        requests.put((next(self._calls), 'teleop', (robot_name, x, y, rotate, tilt)))
+        return True
+
+    def teleop_release(self, robot_name: str):
+        self._call_robot(robot_name, 'teleop_release')
+
+    def teleop_stats(self, robot_name: str):
+        return self._call_robot(robot_name, 'teleop_stats')
+
+    def stop(self, robot_name: str):
+        return self._call_robot(robot_name, 'stop', default=False)
+
+    def dock(self, robot_name: str):
+        return self._send_goal(robot_name, "home base", 'dock')
+
+    def request_battery(self, robot_name: str):
+        self._call_robot(robot_name, 'request_battery')
+
+    def request_position(self, robot_name: str):
+        self._call_robot(robot_name, 'request_position')
+
+    def has_active_goal(self, robot_name: str):
+        goto = self._goto(robot_name)
+        return goto is None or goto[0] not in ("complete", "abort")
+
+    def goto_status(self, robot_name: str):
+        return self._goto(robot_name)
+
+    def add_goto_listener(self, robot_name: str, callback):
+        # Workers forward the goto events of all their robots
+        self._listeners.setdefault(robot_name, []).append(callback)
+
+    def publish_stats(self):
+        ''' PublishScheduler.stats of every worker, by worker index'''
+        return {i: self._call(requests, 'publish_stats')
+                for i, (_, requests) in enumerate(self._workers)}
+
+    def telemetry_version(self, robot_name: str):
+        return self.telemetry.version(self._resolve(robot_name, self.rows))
+
+    def wait_for_update(self, robot_name: str, version, timeout=None):
+        return self.telemetry.poll_for_change(
+            self._resolve(robot_name, self.rows), version, timeout)
+
+    def docking_completed(self, robot_name: str):
+        goto = self._goto(robot_name)
+        charging = self._read(robot_name, 'charging')
+        return charging is not None and goto == ("complete", "home base") and \
+            bool(charging[0])
+
+    def navigation_remaining_duration(self, robot_name: str):
+        duration = self._read(robot_name, 'duration')
+        return None if duration is None else duration[0]
+
+    def navigation_completed(self, robot_name: str):
+        goto = self._goto(robot_name)
+        return goto is not None and goto[0] == "complete"
+
+    def battery_soc(self, robot_name: str):
+        soc = self._read(robot_name, 'soc')
+        return None if soc is None or math.isnan(soc[0]) else soc[0]
+
+    def battery_age(self, robot_name: str):
+        stamp = self._read(robot_name, 'battery_stamp')
+        if stamp is None or math.isnan(stamp[0]):
+            return None
+        return time.monotonic() - stamp[0]
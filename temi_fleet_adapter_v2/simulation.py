@@ -0,0 +1,471 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    In-process simulation of a Temi fleet behind the TemiAPI interface, for
+    running RMF task traffic without MQTT or robots. Robots turn towards
+    their goal, drive there and turn to the goal orientation, within the
+    velocity and acceleration limits of config.yaml. Their batteries drain
+    with the ambient and motion power of the battery, mechanical and
+    ambient systems, and charge at home base.
+
+    Simulated time advances in fixed steps, speed times faster than real
+    time. publish_clock(seconds) is called after every step so that the
+    adapter can publish it on /clock; with --use_sim_time, RMF and the
+    command handle then run at the same pace as the robots.
+
+    Positions use the robot's conventions: getPosition reports yaw in
+    degrees, while navigate takes theta in radians, as sent by the command
+    handle. Stamps such as position_stamp are simulated seconds since the
+    epoch, the time clock() returns and the one published on /clock, so
+    that timeouts and extrapolation in the command handle keep pace with
+    the robots. Timeouts given to the API, as in wait_for_update, are
+    simulated seconds too. Teleop commands are accepted but do not move
+    the robots.
+'''
+
+import math
+import threading
+import time
+
+from contextlib import nullcontext
+
+from .eta import travel_time
+from .locations import LocationIndex
+
+
+HOME_BASE = "home base"
+GRAVITY = 9.81
+
+
+def _wrap(angle):
+    return math.atan2(math.sin(angle), math.cos(angle))
+
+
+class _Axis:
+    ''' Speed along one degree of freedom, ramped within the limits'''
+
+    def __init__(self, velocity, acceleration):
+        self.max_velocity = velocity
+        self.acceleration = acceleration
+        self.velocity = 0.0
+
+    def step(self, remaining, dt):
+        ''' Distance covered towards remaining in dt, braking in time to
+            stop there'''
+        if remaining <= 0.0:
+            self.velocity = 0.0
+            return 0.0
+        self.velocity = min(self.max_velocity,
+                            self.velocity + self.acceleration * dt,
+                            math.sqrt(2.0 * self.acceleration * remaining))
+        covered = min(remaining, self.velocity * dt)
+        if covered >= remaining:
+            self.velocity = 0.0
+        return covered
+
+    def time_to(self, distance):
+        return travel_time(distance, self.max_velocity, self.acceleration)
+
+
+class SimulatedRobot:
+
+    # Goals closer than this are only a turn on the spot, in meters
+    MIN_TRAVEL = 1e-3
+    # Turns below this are done, in radians
+    MIN_TURN = 1e-3
+
+    def __init__(self, pose, linear, angular, home=None, stamp=0.0):
+        '''
+        pose is the start [x, y, yaw] with yaw in degrees, linear and
+        angular the [velocity, acceleration] limits. home is the pose of
+        home base, by default the start pose. stamp is the simulated time
+        at the start.
+        '''
+        self.x, self.y = pose[0], pose[1]
+        self.yaw = math.radians(pose[2])
+        self.linear = _Axis(*linear)
+        self.angular = _Axis(*angular)
+        self.home = list(pose if home is None else home)
+        self.soc = 1.0
+        self.charging = False
+        self.status = "complete"
+        self.location = HOME_BASE
+        self.goal = None  # [x, y, theta in radians]
+        self.phase = None  # 'turn', 'drive' or 'align' while under way
+        self.distance = 0.0  # meters driven
+        self.map_name = None
+        self.position_stamp = stamp
+        self.battery_stamp = self.position_stamp
+
+    def go(self, pose, location):
+        ''' Start towards pose, [x, y, theta in radians]'''
+        self.goal = [pose[0], pose[1], pose[2]]
+        self.location = location
+        self.status = "going"
+        self.charging = False
+        self.linear.velocity = self.angular.velocity = 0.0
+        far = math.hypot(pose[0] - self.x, pose[1] - self.y) > self.MIN_TRAVEL
+        self.phase = 'turn' if far else 'align'
+
+    def halt(self, status):
+        self.goal = None
+        self.phase = None
+        self.status = status
+        self.linear.velocity = self.angular.velocity = 0.0
+
+    def _turn(self, target, dt):
+        error = _wrap(target - self.yaw)
+        covered = self.angular.step(abs(error), dt)
+        self.yaw = _wrap(self.yaw + math.copysign(covered, error))
+        return abs(error) - covered < self.MIN_TURN
+
+    def step(self, dt):
+        ''' Advance dt seconds. Returns True when the goal was reached'''
+        if self.goal is None:
+            return False
+        gx, gy, gtheta = self.goal
+        if self.phase == 'turn':
+            if self._turn(math.atan2(gy - self.y, gx - self.x), dt):
+                self.phase = 'drive'
+        elif self.phase == 'drive':
+            dx, dy = gx - self.x, gy - self.y
+            remaining = math.hypot(dx, dy)
+            covered = self.linear.step(remaining, dt)
+            if remaining > 0.0:
+                self.x += dx * covered / remaining
+                self.y += dy * covered / remaining
+            self.distance += covered
+            if remaining - covered < self.MIN_TRAVEL:
+                self.x, self.y = gx, gy
+                self.phase = 'align'
+        elif self.phase == 'align':
+            if self._turn(gtheta, dt):
+                self.halt("complete")
+                if self.location == HOME_BASE:
+                    self.charging = True
+                return True
+        return False
+
+    def remaining_duration(self):
+        ''' Seconds to the goal from rest, as the robot would report'''
+        if self.goal is None:
+            return 0.0
+        gx, gy, gtheta = self.goal
+        distance = math.hypot(gx - self.x, gy - self.y)
+        if distance < self.MIN_TRAVEL:
+            return self.angular.time_to(abs(_wrap(gtheta - self.yaw)))
+        heading = math.atan2(gy - self.y, gx - self.x)
+        return (self.angular.time_to(abs(_wrap(heading - self.yaw))) +
+                self.linear.time_to(distance) +
+                self.angular.time_to(abs(_wrap(gtheta - heading))))
+
+
+class SimulatedTemiAPI:
+
+    def __init__(self, fleet_config, starts, homes=None, speed=10.0, step=0.1,
+                 publish_clock=None, start_time=None, locations=None):
+        '''
+        fleet_config is the rmf_fleet section of config.yaml and starts
+        maps robot names to start poses [x, y, yaw in degrees] in the robot
+        frame. homes maps robot names to their home base pose, by default
+        the start pose. locations maps the names of the locations saved on
+        every robot, besides home base, to their pose in the robot frame.
+        Each step advances simulated time by step seconds, step / speed
+        seconds of real time apart. publish_clock(seconds) is called with
+        the simulated time, in seconds since the epoch, after every step.
+        Simulated time starts at start_time, by default now.
+        '''
+        self.now = time.time() if start_time is None else start_time
+        limits = fleet_config['limits']
+        homes = homes or {}
+        self.robots = {
+            name: SimulatedRobot(pose, limits['linear'], limits['angular'],
+                                 homes.get(name), self.now)
+            for name, pose in starts.items()}
+        battery = fleet_config['battery_system']
+        mechanical = fleet_config['mechanical_system']
+        # Joules in a full battery and watts drawn or charged
+        self.energy = battery['voltage'] * battery['capacity'] * 3600.0
+        self.charging_power = battery['voltage'] * battery['charging_current']
+        self.ambient_power = fleet_config['ambient_system']['power']
+        self.rolling_force = \
+            mechanical['friction_coefficient'] * mechanical['mass'] * GRAVITY
+        self.speed = speed
+        self.step = step
+        self.publish_clock = publish_clock
+        self.steps = 0
+        # location name -> [x, y, yaw in degrees]
+        self.saved_poses = dict(locations or {})
+        self.locations = LocationIndex((HOME_BASE,) + tuple(self.saved_poses))
+        self._listeners = {}  # robot name -> goto listeners
+        self._teleop_setpoints = {}  # robot name -> setpoints submitted
+        self._version = 0
+        self._lock = threading.Lock()
+        self._changed = threading.Condition(self._lock)
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run, name='temi_simulation', daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        self._stop_event.set()
+        self._thread.join()
+
+    def _robot(self, robot_name):
+        if len(self.robots) == 1:
+            return next(iter(self.robots.values()))
+        return self.robots.get(robot_name)
+
+    def _name(self, robot):
+        for name, other in self.robots.items():
+            if other is robot:
+                return name
+        return None
+
+    def _run(self):
+        deadline = time.monotonic()
+        while not self._stop_event.is_set():
+            self.advance(self.step)
+            if self.publish_clock is not None:
+                self.publish_clock(self.now)
+            deadline += self.step / self.speed
+            delay = deadline - time.monotonic()
+            if delay > 0.0:
+                self._stop_event.wait(delay)
+            else:
+                # Running behind, do not try to catch up in a burst
+                deadline = time.monotonic()
+
+    def advance(self, dt):
+        ''' Advance the simulation by dt seconds of simulated time'''
+        events = []
+        with self._lock:
+            self.now += dt
+            stamp = self.now
+            self.steps += 1
+            for robot in self.robots.values():
+                moving = robot.goal is not None
+                driven = robot.distance
+                if robot.step(dt):
+                    events.append((robot, robot.status, robot.location))
+                power = self.ambient_power + \
+                    self.rolling_force * (robot.distance - driven) / dt
+                if robot.charging:
+                    power -= self.charging_power
+                robot.soc = min(
+                    1.0, max(0.0, robot.soc - power * dt / self.energy))
+                robot.battery_stamp = stamp
+                if moving:
+                    robot.position_stamp = stamp
+            self._version += 1
+            self._changed.notify_all()
+        self._notify(events)
+
+    def _notify(self, events):
+        # Outside the lock, listeners may call back into the API
+        for robot, status, location in events:
+            for listener in self._listeners.get(self._name(robot), ()):
+                listener(status, location)
+
+    def _go(self, robot_name, pose, location):
+        robot = self._robot(robot_name)
+        if robot is None:
+            return False
+        with self._lock:
+            robot.go(pose, location)
+            self._version += 1
+        self._notify([(robot, "going", location)])
+        return True
+
+    # TemiAPI interface
+
+    def clock(self):
+        with self._lock:
+            return self.now
+
+    def add_goto_listener(self, robot_name: str, callback):
+        for name in (self.robots if len(self.robots) == 1 else [robot_name]):
+            self._listeners.setdefault(name, []).append(callback)
+
+    def snapshot(self):
+        # Reads are cheap and consistent under the lock already
+        return nullcontext()
+
+    def history(self, robot_name: str):
+        return None
+
+    def dump_history(self, robot_name: str, path: str):
+        return False
+
+    def wait_until_ready(self, robot_name: str, timeout=None):
+        return self._robot(robot_name) is not None
+
+    def check_connection(self):
+        return True
+
+    def is_reachable(self, robot_name: str):
+        return self._robot(robot_name) is not None
+
+    def connection_health(self, robot_name: str):
+        return {'alive': self.is_reachable(robot_name), 'simulated': True}
+
+    def getPosition(self, robot_name: str):
+        robot = self._robot(robot_name)
+        if robot is None:
+            return None
+        with self._lock:
+            return [robot.x, robot.y, math.degrees(robot.yaw)]
+
+    def position_stamp(self, robot_name: str):
+        robot = self._robot(robot_name)
+        return None if robot is None else robot.position_stamp
+
+    def position_trace(self, robot_name: str):
+        # Poses are read straight from the simulation, so they are
+        # received, parsed and stored at the same instant
+        stamp = self.position_stamp(robot_name)
+        return None if stamp is None else (stamp, stamp, stamp)
+
+    def request_position(self, robot_name: str):
+        robot = self._robot(robot_name)
+        if robot is not None:
+            with self._lock:
+                robot.position_stamp = self.now
+
+    def navigate(self, robot_name: str, pose, map_name: str):
+        robot = self._robot(robot_name)
+        if robot is not None and map_name:
+            robot.map_name = map_name
+        return self._go(robot_name, pose, "COORDINATES")
+
+    def saved_location(self, robot_name: str, waypoint_name: str):
+        return self.locations.lookup(waypoint_name)
+
+    def navigate_to_location(self, robot_name: str, location: str, map_name=None):
+        if location == HOME_BASE:
+            return self.dock(robot_name)
+        if location not in self.saved_poses:
+            print(f"Simulated robot {robot_name} has no saved location "
+                  f"{location}, saved locations are {self.locations.locations}")
+            return False
+        robot = self._robot(robot_name)
+        if robot is not None and map_name:
+            robot.map_name = map_name
+        x, y, yaw = self.saved_poses[location]
+        return self._go(robot_name, [x, y, math.radians(yaw)], location)
+
+    def prepare_map(self, robot_name: str, map_name: str, pose=None):
+        robot = self._robot(robot_name)
+        if robot is not None:
+            robot.map_name = map_name
+
+    def map_stats(self, robot_name: str):
+        robot = self._robot(robot_name)
+        return None if robot is None else {'current': robot.map_name}
+
+    def dock(self, robot_name: str):
+        robot = self._robot(robot_name)
+        if robot is None:
+            return False
+        x, y, yaw = robot.home
+        return self._go(robot_name, [x, y, math.radians(yaw)], HOME_BASE)
+
+    def stop(self, robot_name: str):
+        robot = self._robot(robot_name)
+        if robot is None:
+            return False
+        with self._lock:
+            if robot.goal is not None:
+                robot.halt("abort")
+            self._version += 1
+        return True
+
+    def teleop(self, robot_name: str, x=None, y=None, rotate=None, tilt=None):
+        # Manual driving is not simulated, setpoints are only counted as
+        # delivered at once
+        robot = self._robot(robot_name)
+        if robot is None:
+            return False
+        setpoints = (int(x is not None or y is not None) +
+                     int(rotate is not None) + int(tilt is not None))
+        with self._lock:
+            self._teleop_setpoints[self._name(robot)] = \
+                self._teleop_setpoints.get(self._name(robot), 0) + setpoints
+        return True
+
+    def teleop_release(self, robot_name: str):
+        pass
+
+    def teleop_stats(self, robot_name: str):
+        robot = self._robot(robot_name)
+        if robot is None:
+            return None
+        with self._lock:
+            setpoints = self._teleop_setpoints.get(self._name(robot), 0)
+        return {'active': False, 'submitted': setpoints, 'sent': setpoints,
+                'coalesced': 0, 'deadman_stops': 0,
+                'mean_lag': 0.0 if setpoints else None, 'max_lag': 0.0}
+
+    def request_battery(self, robot_name: str):
+        pass
+
+    def battery_soc(self, robot_name: str):
+        robot = self._robot(robot_name)
+        return None if robot is None else robot.soc
+
+    def battery_age(self, robot_name: str):
+        robot = self._robot(robot_name)
+        if robot is None:
+            return None
+        with self._lock:
+            return self.now - robot.battery_stamp
+
+    def has_active_goal(self, robot_name: str):
+        robot = self._robot(robot_name)
+        return robot is not None and robot.goal is not None
+
+    def goto_status(self, robot_name: str):
+        robot = self._robot(robot_name)
+        return None if robot is None else (robot.status, robot.location)
+
+    def navigation_completed(self, robot_name: str):
+        robot = self._robot(robot_name)
+        return robot is not None and robot.status == "complete"
+
+    def navigation_remaining_duration(self, robot_name: str):
+        robot = self._robot(robot_name)
+        if robot is None:
+            return None
+        with self._lock:
+            return robot.remaining_duration()
+
+    def docking_completed(self, robot_name: str):
+        robot = self._robot(robot_name)
+        return robot is not None and robot.status == "complete" and \
+            robot.location == HOME_BASE and robot.charging
+
+    def publish_stats(self):
+        return {}
+
+    def telemetry_version(self, robot_name: str):
+        return self._version
+
+    def wait_for_update(self, robot_name: str, version, timeout=None):
+        # timeout is in simulated seconds, like every other time here
+        if timeout is not None:
+            timeout /= self.speed
+        with self._changed:
+            return self._changed.wait_for(
+                lambda: self._version != version, timeout)
@@ -0,0 +1,101 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Worker threads for the long running robot tasks (following a path,
+    docking, stopping). Every robot has its own serial worker, so a robot
+    that is busy docking never holds up another robot's path. Each robot has
+    at most one active task; submitting a new one cancels the previous task
+    through its CancellationToken and starts as soon as it has returned.
+'''
+
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+
+from .profiling import robot_tag
+
+
+def _run_tagged(key, fn, token, *args):
+    if token.cancelled:
+        # Superseded before it could start
+        return None
+    # Profiler samples of this thread belong to the task's robot
+    with robot_tag(key):
+        return fn(token, *args)
+
+
+class CancellationToken:
+    ''' Cooperative cancellation flag handed to every task'''
+
+    def __init__(self):
+        self._event = threading.Event()
+
+    def cancel(self):
+        self._event.set()
+
+    @property
+    def cancelled(self):
+        return self._event.is_set()
+
+    def wait(self, timeout=None):
+        ''' Sleep for up to timeout seconds. Returns True if cancelled.'''
+        return self._event.wait(timeout)
+
+
+class TaskRunner:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # key -> single worker executor, so tasks of a key run in order
+        self._executors = {}
+        # key -> token of the latest task submitted for that key
+        self._tokens = {}
+
+    def replace(self, key, fn, *args):
+        '''
+        Cancel the task currently registered under key and schedule
+        fn(token, *args) to run once it has returned. This never blocks.
+        Returns the CancellationToken of the new task.
+        '''
+        token = CancellationToken()
+        with self._lock:
+            previous = self._tokens.get(key)
+            self._tokens[key] = token
+            executor = self._executors.get(key)
+            if executor is None:
+                executor = ThreadPoolExecutor(
+                    max_workers=1, thread_name_prefix=f'temi_task_{key}')
+                self._executors[key] = executor
+        if previous is not None:
+            previous.cancel()
+        executor.submit(_run_tagged, key, fn, token, *args)
+        return token
+
+    def cancel(self, key):
+        ''' Cancel the task registered under key, if any'''
+        with self._lock:
+            token = self._tokens.get(key)
+        if token is not None:
+            token.cancel()
+
+    def shutdown(self, wait=True):
+        ''' Cancel every task and, if wait, wait for them to return'''
+        with self._lock:
+            tokens = list(self._tokens.values())
+            executors = list(self._executors.values())
+        for token in tokens:
+            token.cancel()
+        for executor in executors:
+            executor.shutdown(wait=wait)
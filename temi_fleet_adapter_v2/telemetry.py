@@ -0,0 +1,251 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Fleet-wide telemetry store. Every robot owns one row and every field is
+    a typed NumPy column, so reading a field for the whole fleet is a single
+    array copy.
+
+    Rows are written by a single thread, the MQTT network loop, and read
+    without locks. Each row has a sequence number that is odd while the row
+    is being written; readers retry until they see the same even sequence
+    number before and after reading. The sequence number doubles as a
+    version that threads can block on until a row changes.
+
+    The table can also live in a shared memory buffer, so that a process
+    other than the writer's can read it. Such a table has a fixed capacity.
+'''
+
+import math
+import threading
+import time
+
+import numpy as np
+
+
+# Goto statuses reported on event/waypoint/goto, stored by index
+GOTO_STATUSES = (
+    'start', 'going', 'calculating', 'complete', 'abort', 'obstacle detected')
+GOTO_UNKNOWN = -1
+
+COLUMNS = (
+    ('x', np.float64),
+    ('y', np.float64),
+    ('yaw', np.float64),
+    ('tilt', np.float64),
+    ('position_stamp', np.float64),
+    # when the position message was received and parsed, see tracing.py
+    ('position_received', np.float64),
+    ('position_parsed', np.float64),
+    ('soc', np.float64),
+    ('charging', np.bool_),
+    ('battery_stamp', np.float64),
+    ('goto_status', np.int8),
+    ('goto_stamp', np.float64),
+    ('duration', np.float64),
+    ('duration_stamp', np.float64),
+    # when any message last arrived from the robot, see Robot.heard
+    ('last_heard', np.float64),
+)
+
+# Fields that have never been written hold these values. Stamps are NaN
+# until the first message arrives.
+DEFAULTS = {
+    'tilt': 50.0,
+    'soc': math.nan,
+    'goto_status': GOTO_UNKNOWN,
+    'position_stamp': math.nan,
+    'position_received': math.nan,
+    'position_parsed': math.nan,
+    'battery_stamp': math.nan,
+    'goto_stamp': math.nan,
+    'duration_stamp': math.nan,
+    'last_heard': math.nan,
+}
+
+
+def _aligned(nbytes):
+    return (nbytes + 7) // 8 * 8
+
+
+def goto_status_code(status):
+    try:
+        return GOTO_STATUSES.index(status)
+    except ValueError:
+        return GOTO_UNKNOWN
+
+
+def goto_status_name(code):
+    if 0 <= code < len(GOTO_STATUSES):
+        return GOTO_STATUSES[code]
+    return None
+
+
+class FleetTelemetry:
+
+    # Attempts a reader makes before giving up on a consistent read
+    MAX_RETRIES = 100
+
+    def __init__(self, capacity=8, buffer=None, keys=(), reset=True):
+        '''
+        buffer is an optional writable buffer of at least nbytes(capacity)
+        bytes to keep the table in, e.g. SharedMemory.buf. keys are added
+        in order, so tables sharing a buffer agree on the rows. reset is
+        False when attaching to a buffer that already holds a table.
+        '''
+        self._capacity = capacity
+        self._size = 0
+        self._rows = {}  # key (robot serial) -> row index
+        self._add_lock = threading.Lock()
+        # Only taken by the writer while some thread waits for a change.
+        # Readers in other processes are not woken up.
+        self._changed = threading.Condition()
+        self._waiters = 0
+        self._shared = buffer is not None
+        if buffer is None:
+            self.seq = np.zeros(capacity, dtype=np.uint64)
+            self.columns = {
+                name: np.full(capacity, DEFAULTS.get(name, 0), dtype=dtype)
+                for name, dtype in COLUMNS}
+        else:
+            arrays = []
+            offset = 0
+            for dtype in [np.uint64] + [dtype for _, dtype in COLUMNS]:
+                array = np.ndarray(
+                    capacity, dtype=dtype, buffer=buffer, offset=offset)
+                arrays.append(array)
+                offset += _aligned(array.nbytes)
+            self.seq = arrays[0]
+            self.columns = {
+                name: array for (name, _), array in zip(COLUMNS, arrays[1:])}
+            if reset:
+                self.seq[:] = 0
+                for name, column in self.columns.items():
+                    column[:] = DEFAULTS.get(name, 0)
+        for key in keys:
+            self.add(key)
+
+    @staticmethod
+    def nbytes(capacity):
+        ''' Size of the buffer needed for a table of capacity rows'''
+        return sum(
+            _aligned(capacity * np.dtype(dtype).itemsize)
+            for dtype in [np.uint64] + [dtype for _, dtype in COLUMNS])
+
+    def __len__(self):
+        return self._size
+
+    def add(self, key):
+        ''' Allocate a row for key and return its index'''
+        with self._add_lock:
+            if key in self._rows:
+                return self._rows[key]
+            if self._size == self._capacity:
+                self._grow(2 * self._capacity)
+            row = self._size
+            self._rows[key] = row
+            self._size += 1
+            return row
+
+    def row(self, key):
+        return self._rows.get(key)
+
+    def _grow(self, capacity):
+        if self._shared:
+            raise RuntimeError('A shared telemetry table cannot grow')
+        # Readers keep using the old arrays until the new ones are in place.
+        # Rows are allocated while robots are created, before their
+        # subscriptions start delivering messages.
+        seq = np.zeros(capacity, dtype=np.uint64)
+        seq[:self._capacity] = self.seq
+        columns = {}
+        for name, dtype in COLUMNS:
+            column = np.full(capacity, DEFAULTS.get(name, 0), dtype=dtype)
+            column[:self._capacity] = self.columns[name]
+            columns[name] = column
+        self.columns = columns
+        self.seq = seq
+        self._capacity = capacity
+
+    def write(self, row, **fields):
+        ''' Update fields of a row. Must only be called from the writer
+            thread.'''
+        seq = self.seq
+        columns = self.columns
+        seq[row] += 1
+        for name, value in fields.items():
+            columns[name][row] = value
+        seq[row] += 1
+        if self._waiters:
+            with self._changed:
+                self._changed.notify_all()
+
+    def version(self, row):
+        ''' A number that increases every time the row is written'''
+        return int(self.seq[row]) // 2
+
+    def wait_for_change(self, row, version, timeout=None):
+        '''
+        Block until the row is written after it had the given version, or
+        the timeout expires. Returns True if the row changed.
+        '''
+        with self._changed:
+            self._waiters += 1
+            try:
+                return self._changed.wait_for(
+                    lambda: self.version(row) != version, timeout)
+            finally:
+                self._waiters -= 1
+
+    def poll_for_change(self, row, version, timeout, period=0.01):
+        '''
+        Like wait_for_change, for readers in a process other than the
+        writer's: checks the version every period seconds.
+        '''
+        deadline = time.monotonic() + (timeout or 0.0)
+        while self.version(row) == version:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0.0:
+                return False
+            time.sleep(min(period, remaining))
+        return True
+
+    def read(self, row, *names):
+        ''' Consistent values of the named fields of a row'''
+        for _ in range(self.MAX_RETRIES):
+            seq = self.seq
+            columns = self.columns
+            before = int(seq[row])
+            if before % 2:
+                continue
+            values = [columns[name][row].item() for name in names]
+            if int(seq[row]) == before:
+                return values
+        raise RuntimeError(f'Unable to read telemetry row {row}')
+
+    def snapshot(self):
+        '''
+        Copy every column for all robots at once. Returns a dict of arrays
+        indexed by row. The copy is retried if any row changed meanwhile.
+        '''
+        seq = self.seq
+        columns = self.columns
+        size = self._size
+        for _ in range(self.MAX_RETRIES):
+            before = seq[:size].copy()
+            copy = {name: column[:size].copy() for name, column in columns.items()}
+            after = seq[:size]
+            if not (before % 2).any() and (before == after).all():
+                return copy
+        raise RuntimeError('Unable to take a consistent telemetry snapshot')
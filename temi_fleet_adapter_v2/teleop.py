@@ -0,0 +1,173 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Streaming teleoperation of one robot. Setpoints may arrive at any rate,
+    but only the latest one is sent, once per period:
+
+        joystick  [x, y] is repeated every period while it is held, as the
+                  robot stops when joystick messages stop coming
+        rotate    relative turn in degrees, sent once
+        tilt      absolute head angle in degrees, sent once
+
+    A joystick setpoint that is not renewed within the deadman timeout is
+    replaced by a single zero command, so a crashed or disconnected
+    operator cannot leave the robot driving. The streaming thread only runs
+    while there is something to send.
+'''
+
+import json
+import threading
+import time
+
+
+JOYSTICK = 'move/joystick'
+ROTATE = 'move/turn_by'
+TILT = 'move/tilt'
+
+
+class TeleopStream:
+
+    def __init__(self, send, period=0.2, deadman=0.5, clock=time.monotonic):
+        '''
+        send(command, payload, qos) publishes a command, e.g. Robot._send.
+        period is the time between messages and deadman the time after
+        which an unrenewed joystick setpoint is zeroed, in seconds.
+        '''
+        self.send = send
+        self.period = period
+        self.deadman = deadman
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._joystick = None  # [x, y] being held, or None
+        self._joystick_stamp = None
+        # True until the joystick setpoint was sent once
+        self._joystick_new = False
+        self._pending = {}  # command -> (payload, stamp it was set)
+        self._thread = None
+        self.submitted = 0
+        self.sent = 0
+        # Sent setpoints that had not been sent before; their lag is the
+        # time from being set to being sent
+        self.fresh = 0
+        self.coalesced = 0
+        self.deadman_stops = 0
+        self.max_lag = 0.0
+        self._total_lag = 0.0
+
+    def joystick(self, x, y):
+        ''' Hold the joystick at [x, y] until the next setpoint'''
+        with self._lock:
+            self.submitted += 1
+            if self._joystick_new:
+                self.coalesced += 1
+            self._joystick_new = True
+            # Replaces a zero command from release() that was not sent yet
+            self._pending.pop(JOYSTICK, None)
+            self._joystick = [x, y]
+            self._joystick_stamp = self.clock()
+            self._start()
+
+    def rotate(self, angle):
+        ''' Turn by angle degrees, replacing a turn that was not sent yet'''
+        if angle != 0:
+            self._set(ROTATE, {"angle": angle})
+
+    def tilt(self, angle):
+        ''' Tilt the head to angle degrees'''
+        self._set(TILT, {"angle": angle})
+
+    def release(self):
+        ''' Let go of the joystick; a zero command is sent next period'''
+        with self._lock:
+            self._pending.pop(ROTATE, None)
+            if self._joystick is not None:
+                self._joystick = None
+                self._joystick_new = False
+                self._pending[JOYSTICK] = ({"x": 0, "y": 0}, self.clock())
+                self._start()
+
+    @property
+    def active(self):
+        return self._joystick is not None or bool(self._pending)
+
+    def _set(self, command, fields):
+        with self._lock:
+            self.submitted += 1
+            if command in self._pending:
+                self.coalesced += 1
+            self._pending[command] = (fields, self.clock())
+            self._start()
+
+    def _start(self):
+        # Called with the lock held
+        if self._thread is None:
+            self._thread = threading.Thread(
+                target=self._run, name='temi_teleop', daemon=True)
+            self._thread.start()
+
+    def _take(self, now):
+        # The messages to send this period, as (command, fields, stamp).
+        # stamp is when the setpoint was set, None for a repeated joystick
+        # setpoint. Called with the lock held
+        messages = [(command, fields, stamp)
+                    for command, (fields, stamp) in self._pending.items()]
+        self._pending.clear()
+        if self._joystick is not None:
+            if now - self._joystick_stamp > self.deadman:
+                self._joystick = None
+                self._joystick_new = False
+                self.deadman_stops += 1
+                messages.append((JOYSTICK, {"x": 0, "y": 0}, now))
+            else:
+                stamp = self._joystick_stamp if self._joystick_new else None
+                self._joystick_new = False
+                x, y = self._joystick
+                messages.append((JOYSTICK, {"x": x, "y": y}, stamp))
+        return messages
+
+    def _run(self):
+        deadline = self.clock()
+        while True:
+            with self._lock:
+                if not self.active:
+                    self._thread = None
+                    return
+                now = self.clock()
+                messages = self._take(now)
+            for command, fields, stamp in messages:
+                try:
+                    self.send(command, json.dumps(fields), 0)
+                except Exception as e:
+                    print(f"An error has occurred when streaming {command}: {e}")
+                    continue
+                self.sent += 1
+                if stamp is not None:
+                    lag = now - stamp
+                    self.fresh += 1
+                    self._total_lag += lag
+                    self.max_lag = max(self.max_lag, lag)
+            # Keep a fixed cadence, skipping periods that were missed
+            deadline = max(deadline + self.period, self.clock())
+            time.sleep(max(0.0, deadline - self.clock()))
+
+    def stats(self):
+        return {
+            'active': self.active,
+            'submitted': self.submitted,
+            'sent': self.sent,
+            'coalesced': self.coalesced,
+            'deadman_stops': self.deadman_stops,
+            'mean_lag': self._total_lag / self.fresh if self.fresh else None,
+            'max_lag': self.max_lag}
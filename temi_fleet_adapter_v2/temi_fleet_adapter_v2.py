@@ -9,12 +9,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-import asyncio
 import sys
 import argparse
+import itertools
+import math
+import os
+import signal
 import yaml
-import nudged
-import time
 import threading
 from functools import partial
 
@@ -29,18 +30,63 @@ import rmf_adapter.geometry as geometry
 import rmf_adapter.graph as graph
 import rmf_adapter.plan as plan
 
-from rmf_task_msgs.msg import TaskProfile, TaskType
-
-
 from .TemiCommandHandle import RobotCommandHandle
-from .TemiClientAPI import TemiAPI
+from .eta import ArrivalEstimator
+from .profiling import ProfilingService, StartupTimeline
+from .tasks import TaskRunner
+from .tracing import LatencyTracer
 
 # ------------------------------------------------------------------------------
 # Helper functions
 # ------------------------------------------------------------------------------
 
 
-def initialize_fleet(config_yaml, nav_graph_path, node, use_sim_time, server_uri):
+def simulated_poses(config_yaml, nav_graph, transforms):
+    ''' Start and home base poses of the simulated robots in the robot
+        frame, [x, y, yaw in degrees]. Robots start at their start
+        waypoint, or on their charger if it is not given'''
+    starts = {}
+    homes = {}
+    for robot_name, robot_config in config_yaml['robots'].items():
+        rmf_config = robot_config['rmf_config']
+        poses = []
+        for waypoint_name, orientation in (
+                (rmf_config['start'].get('waypoint') or
+                 rmf_config['charger']['waypoint'],
+                 rmf_config['start'].get('orientation') or 0.0),
+                (rmf_config['charger']['waypoint'], 0.0)):
+            x, y = transforms['rmf_to_robot'].transform(
+                nav_graph.find_waypoint(waypoint_name).location)
+            poses.append([x, y, math.degrees(
+                orientation + transforms['orientation_offset'])])
+        starts[robot_name], homes[robot_name] = poses
+    return starts, homes
+
+
+def simulated_locations(waypoint_names, nav_graph, transforms):
+    ''' Poses of the locations saved on the simulated robots in the robot
+        frame, [x, y, yaw in degrees], one at each of waypoint_names'''
+    locations = {}
+    for waypoint_name in waypoint_names:
+        x, y = transforms['rmf_to_robot'].transform(
+            nav_graph.find_waypoint(waypoint_name).location)
+        locations[waypoint_name] = [
+            x, y, math.degrees(transforms['orientation_offset'])]
+    return locations
+
+
+def initialize_fleet(config_yaml, nav_graph_path, node, use_sim_time, server_uri,
+                     mqtt_config_path='mqtt.yaml', timeline=None,
+                     simulate=False):
+    # Only needed once the fleet is being set up
+    import nudged
+    from rmf_task_msgs.msg import TaskProfile, TaskType
+    from .TemiClientAPI import TemiAPI
+    from .sharding import ShardedTemiAPI
+
+    if timeline is None:
+        timeline = StartupTimeline(enabled=False)
+
     # Profile and traits
     fleet_config = config_yaml['rmf_fleet']
     profile = traits.Profile(geometry.make_final_convex_circle(
@@ -78,6 +124,7 @@ def initialize_fleet(config_yaml, nav_graph_path, node, use_sim_time, server_uri
     tool_sink = battery.SimpleDevicePowerSink(battery_sys, tool_power_sys)
 
     nav_graph = graph.parse_graph(nav_graph_path, vehicle_traits)
+    timeline.mark("navigation graph parsed")
 
     # Adapter
     fleet_name = fleet_config['name']
@@ -87,8 +134,10 @@ def initialize_fleet(config_yaml, nav_graph_path, node, use_sim_time, server_uri
     assert adapter, ("Unable to initialize fleet adapter. Please ensure "
                      "RMF Schedule Node is running")
     adapter.start()
-    time.sleep(1.0)
+    timeline.mark("fleet adapter started")
 
+    # Adding the fleet does not depend on the adapter having finished
+    # discovery, so there is no need to wait for it here
     fleet_handle = adapter.add_fleet(fleet_name, vehicle_traits, nav_graph)
 
     if not fleet_config['publish_fleet_state']:
@@ -110,6 +159,7 @@ def initialize_fleet(config_yaml, nav_graph_path, node, use_sim_time, server_uri
         drain_battery,
         finishing_request)
     assert ok, ("Unable to set task planner params")
+    timeline.mark("fleet handle configured")
 
     task_capabilities = []
     if fleet_config['task_capabilities']['loop']:
@@ -160,20 +210,110 @@ def initialize_fleet(config_yaml, nav_graph_path, node, use_sim_time, server_uri
         """Insert a RobotUpdateHandle."""
         cmd_handle.update_handle = update_handle
 
-    # Initialize robot API for this fleet
-    api = TemiAPI(
-        fleet_config['fleet_manager']['prefix'])
+    # Initialize robot API for this fleet. With worker_processes the robots
+    # are split across that many processes, each with its own connection
+    worker_processes = fleet_config['fleet_manager'].get('worker_processes', 0)
+    if simulate:
+        # Robots are simulated in this process, without MQTT. With sim time
+        # the simulation drives /clock, so RMF keeps pace with the robots
+        from .simulation import SimulatedTemiAPI
+        simulation = dict(config_yaml.get('simulation', {}))
+        locations = simulated_locations(
+            simulation.pop('saved_locations', None) or [], nav_graph,
+            transforms)
+        publish_clock = None
+        if not use_sim_time:
+            # RMF follows the wall clock, so the robots must as well
+            simulation['speed'] = 1.0
+        else:
+            from rosgraph_msgs.msg import Clock
+            clock_publisher = node.create_publisher(Clock, '/clock', 10)
+
+            def _publish_clock(seconds):
+                msg = Clock()
+                msg.clock.sec = int(seconds)
+                msg.clock.nanosec = int((seconds % 1.0) * 1e9)
+                clock_publisher.publish(msg)
+            publish_clock = _publish_clock
+        starts, homes = simulated_poses(config_yaml, nav_graph, transforms)
+        api = SimulatedTemiAPI(
+            fleet_config, starts, homes, publish_clock=publish_clock,
+            locations=locations, **simulation)
+        timeline.mark("Simulation started")
+    elif worker_processes > 0:
+        api = ShardedTemiAPI(
+            fleet_config['fleet_manager']['prefix'],
+            mqtt_config_path,
+            fleet_config['fleet_manager'].get('battery_ttl', 60.0),
+            fleet_config['fleet_manager'].get('history_minutes', 10.0),
+            workers=worker_processes,
+            heartbeat=fleet_config['fleet_manager'].get('heartbeat'),
+            teleop=fleet_config['fleet_manager'].get('teleop'))
+        timeline.mark("Worker processes started")
+    else:
+        api = TemiAPI(
+            fleet_config['fleet_manager']['prefix'],
+            mqtt_config_path,
+            fleet_config['fleet_manager'].get('battery_ttl', 60.0),
+            fleet_config['fleet_manager'].get('history_minutes', 10.0),
+            heartbeat=fleet_config['fleet_manager'].get('heartbeat'),
+            teleop=fleet_config['fleet_manager'].get('teleop'))
+        timeline.mark("MQTT broker connected")
+
+    # Path, dock and stop tasks run on one serial worker per robot
+    task_runner = TaskRunner()
+    # Robots share the same limits, so they can share segment costs too
+    segment_costs = {}
+    # Positions of all robots are traced from MQTT to RMF in one place. The
+    # latency of each stage and the updates each robot sent to RMF are
+    # logged every latency_report_period
+    tracer = LatencyTracer()
+    latency_report_period = fleet_config['fleet_manager'].get(
+        'latency_report_period', 60.0)
+    if latency_report_period > 0:
+        def _report_latency():
+            if len(tracer):
+                node.get_logger().info(
+                    f"Position latency by stage:\n{tracer.report()}")
+            for robot_name, robot in list(robots.items()):
+                stats = robot.update_stats()
+                node.get_logger().info(
+                    f"Updates of robot {robot_name} sent to RMF: "
+                    f"{stats['sent']}, suppressed: {stats['suppressed']}")
+        node.create_timer(latency_report_period, _report_latency)
 
     # Initialize robots for this fleet
 
     missing_robots = config_yaml['robots']
+    robots = {}
+
+    # A single update tick reads the telemetry of every robot at once and
+    # then updates each command handle. The tick runs at the highest
+    # robot_state_update_frequency; robots with a lower one are updated on
+    # every n-th tick only
+    update_frequency = max(
+        robot_config['rmf_config'].get('robot_state_update_frequency', 1)
+        for robot_config in missing_robots.values())
+    ticks = itertools.count()
+
+    def _update_robots():
+        tick = next(ticks)
+        with api.snapshot():
+            for robot in list(robots.values()):
+                every = max(1, round(update_frequency / robot.update_frequency))
+                if tick % every == 0:
+                    robot.update()
+
+    node.create_timer(1.0 / update_frequency, _update_robots)
 
     def _add_fleet_robots():
-        robots = {}
         while len(missing_robots) > 0:
-            time.sleep(0.2)
             for robot_name in list(missing_robots.keys()):
                 node.get_logger().debug(f"Connecting to robot: {robot_name}")
+                # Returns as soon as the robot has reported its state
+                if not api.wait_until_ready(robot_name, timeout=0.2):
+                    continue
+                timeline.mark(f"robot {robot_name} ready")
                 position = api.getPosition(robot_name)
                 if position is None:
                     continue
@@ -231,7 +371,14 @@ def initialize_fleet(config_yaml, nav_graph_path, node, use_sim_time, server_uri
                         update_frequency=rmf_config.get(
                             'robot_state_update_frequency', 1),
                         adapter=adapter,
-                        api=api)
+                        api=api,
+                        task_runner=task_runner,
+                        eta=ArrivalEstimator(
+                            fleet_config['limits']['linear'],
+                            fleet_config['limits']['angular'],
+                            cache=segment_costs),
+                        update_timer=False,
+                        tracer=tracer)
 
                     if robot.initialized:
                         robots[robot_name] = robot
@@ -244,6 +391,7 @@ def initialize_fleet(config_yaml, nav_graph_path, node, use_sim_time, server_uri
                                                        robot))
                         node.get_logger().info(
                             f"Successfully added new robot: {robot_name}")
+                        timeline.mark(f"robot {robot_name} added")
 
                     else:
                         node.get_logger().error(
@@ -255,21 +403,24 @@ def initialize_fleet(config_yaml, nav_graph_path, node, use_sim_time, server_uri
                     pass
                     node.get_logger().debug(
                         f"{robot_name} not found, trying again...")
+        timeline.report()
         return
 
     add_robots = threading.Thread(target=_add_fleet_robots, args=())
     add_robots.start()
-    return adapter
+    return adapter, api, task_runner
 
 
 # ------------------------------------------------------------------------------
 # Main
 # ------------------------------------------------------------------------------
 def main(argv=sys.argv):
+    timeline = StartupTimeline(enabled='--profile-startup' in argv)
     # Init rclpy and adapter
     rclpy.init(args=argv)
     adpt.init_rclcpp()
     args_without_ros = rclpy.utilities.remove_ros_args(argv)
+    timeline.mark("rclpy initialized")
 
     parser = argparse.ArgumentParser(
         prog="fleet_adapter",
@@ -280,8 +431,14 @@ def main(argv=sys.argv):
                         help="Path to the nav_graph for this fleet adapter")
     parser.add_argument("-s", "--server_uri", type=str, required=False, default="",
                     help="URI of the api server to transmit state and task information.")
+    parser.add_argument("-m", "--mqtt_config", type=str, required=False, default="",
+                        help="Path to the mqtt.yaml file, default: next to the config file")
     parser.add_argument("--use_sim_time", action="store_true",
                         help='Use sim time, default: false')
+    parser.add_argument("--simulate", action="store_true",
+                        help='Simulate the robots instead of connecting to them, default: false')
+    parser.add_argument("--profile-startup", action="store_true",
+                        help='Print a timeline of the startup phases, default: false')
     args = parser.parse_args(args_without_ros[1:])
     print(f"Starting fleet adapter...")
 
@@ -291,10 +448,17 @@ def main(argv=sys.argv):
     # Load config and nav graph yamls
     with open(config_path, "r") as f:
         config_yaml = yaml.safe_load(f)
+    if args.mqtt_config == "":
+        mqtt_config_path = os.path.join(
+            os.path.dirname(os.path.abspath(config_path)), "mqtt.yaml")
+    else:
+        mqtt_config_path = args.mqtt_config
+    timeline.mark("configuration loaded")
 
     # ROS 2 node for the command handle
     fleet_name = config_yaml['rmf_fleet']['name']
     node = rclpy.node.Node(f'{fleet_name}_command_handle')
+    timeline.mark("command handle node created")
 
     # Enable sim time for testing offline
     if args.use_sim_time:
@@ -306,21 +470,35 @@ def main(argv=sys.argv):
     else:
         server_uri = args.server_uri
 
-    adapter = initialize_fleet(
+    adapter, api, task_runner = initialize_fleet(
         config_yaml,
         nav_graph_path,
         node,
         args.use_sim_time,
-        server_uri)
+        server_uri,
+        mqtt_config_path,
+        timeline,
+        args.simulate)
+
+    # On-demand profiling through a service on the command handle node and
+    # SIGUSR1, which toggles it from the profiler's control thread
+    profiler = ProfilingService(node, **config_yaml.get('profiling', {}))
+    signal.signal(signal.SIGUSR1, lambda signum, frame: profiler.request_toggle())
 
     # Create executor for the command handle node
     rclpy_executor = rclpy.executors.SingleThreadedExecutor()
     rclpy_executor.add_node(node)
 
     # Start the fleet adapter
-    rclpy_executor.spin()
-
-    # Shutdown
+    try:
+        rclpy_executor.spin()
+    except KeyboardInterrupt:
+        pass
+
+    # Shutdown. Robot tasks are cancelled and have returned before worker
+    # processes are joined and their shared memory is unlinked
+    task_runner.shutdown()
+    api.shutdown()
     node.destroy_node()
     rclpy_executor.shutdown()
     rclpy.shutdown()
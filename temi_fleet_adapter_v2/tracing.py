@@ -0,0 +1,99 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    End-to-end latency of robot positions, from the MQTT client receiving a
+    currentPosition message to the update_handle call that hands the pose
+    to RMF. Each traced pose carries a time.monotonic() stamp per stage:
+
+        receive  paho decoded the message on the network thread
+        parse    the payload was parsed in the subscription callback
+        store    the pose was written to the telemetry table
+        tick     the update tick picked up the new pose
+        rmf      the update_handle call returned
+
+    Every span is named after the stage it ends at, and total runs from
+    receive to rmf. The last capacity traces are kept for percentiles.
+'''
+
+import threading
+
+import numpy as np
+
+
+STAGES = ('receive', 'parse', 'store', 'tick', 'rmf')
+SPANS = STAGES[1:] + ('total',)
+
+
+class LatencyTracer:
+
+    def __init__(self, capacity=4096):
+        # One row of stage stamps per trace, used as a ring buffer
+        self._stamps = np.full((capacity, len(STAGES)), np.nan)
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._count, len(self._stamps))
+
+    def record(self, stamps):
+        ''' Add a trace given as one stamp per stage, in STAGES order'''
+        with self._lock:
+            self._stamps[self._count % len(self._stamps)] = stamps
+            self._count += 1
+
+    def spans(self):
+        ''' Span durations of the kept traces in seconds, one column per
+            span in SPANS order, oldest trace first'''
+        with self._lock:
+            count = len(self)
+            start = self._count % len(self._stamps) if \
+                self._count > len(self._stamps) else 0
+            stamps = np.roll(self._stamps[:count], -start, axis=0)
+        return np.column_stack(
+            (np.diff(stamps, axis=1), stamps[:, -1] - stamps[:, 0]))
+
+    def records(self, last=10):
+        ''' The last traces as dicts of span durations in seconds'''
+        return [dict(zip(SPANS, row.tolist())) for row in self.spans()[-last:]]
+
+    def summary(self, percentiles=(50, 90, 99)):
+        '''
+        Per span count, mean, max and percentiles in seconds, e.g.
+        summary()['tick']['p99']. Spans with missing stamps are skipped.
+        '''
+        spans = self.spans()
+        summary = {}
+        for i, name in enumerate(SPANS):
+            values = spans[:, i]
+            values = values[np.isfinite(values)]
+            if not len(values):
+                continue
+            entry = {'count': len(values),
+                     'mean': float(values.mean()),
+                     'max': float(values.max())}
+            for p, value in zip(percentiles, np.percentile(values, percentiles)):
+                entry[f'p{p}'] = float(value)
+            summary[name] = entry
+        return summary
+
+    def report(self):
+        ''' One line per span with its percentiles in milliseconds'''
+        lines = []
+        for name, entry in self.summary().items():
+            lines.append(
+                f"{name:>7}: " + ", ".join(
+                    f"{key} {value * 1e3:.1f}ms" if key != 'count'
+                    else f"n {value}" for key, value in entry.items()))
+        return "\n".join(lines)
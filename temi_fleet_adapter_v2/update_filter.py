@@ -0,0 +1,111 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Decides which robot state updates are worth forwarding to RMF. An update
+    is only sent when it differs from the last one sent by more than the
+    configured tolerances, or when keep_alive seconds have passed since.
+'''
+
+import math
+import time
+
+
+class UpdateFilter:
+
+    KINDS = ('battery', 'location', 'arrival')
+
+    def __init__(self,
+                 position_tolerance=0.05,
+                 yaw_tolerance=0.05,
+                 soc_tolerance=0.005,
+                 arrival_tolerance=0.5,
+                 keep_alive=5.0,
+                 clock=time.monotonic):
+        '''
+        position_tolerance is in meters, yaw_tolerance in radians, soc
+        tolerance as a fraction of full charge and arrival_tolerance in
+        seconds. These are the keys accepted in the state_publishing section
+        of a robot_config.
+        '''
+        self.position_tolerance = position_tolerance
+        self.yaw_tolerance = yaw_tolerance
+        self.soc_tolerance = soc_tolerance
+        self.arrival_tolerance = arrival_tolerance
+        self.keep_alive = keep_alive
+        self.clock = clock
+        # kind -> (value, time) of the last update that was sent
+        self._last = {}
+        self.sent = dict.fromkeys(self.KINDS, 0)
+        self.suppressed = dict.fromkeys(self.KINDS, 0)
+
+    def battery(self, soc):
+        ''' Return True if the state of charge should be sent'''
+        return self._check(
+            'battery', soc,
+            lambda last: abs(soc - last) >= self.soc_tolerance)
+
+    def location(self, key, position):
+        '''
+        Return True if the location should be sent. key identifies how the
+        robot is localized, e.g. ('lanes', (1, 2)), and any change of key is
+        always sent.
+        '''
+        def changed(last):
+            last_key, last_position = last
+            if key != last_key:
+                return True
+            if math.hypot(position[0] - last_position[0],
+                          position[1] - last_position[1]) >= self.position_tolerance:
+                return True
+            yaw = position[2] - last_position[2]
+            return abs(math.atan2(math.sin(yaw), math.cos(yaw))) >= self.yaw_tolerance
+        return self._check('location', (key, list(position)), changed)
+
+    def arrival(self, path_index, remaining):
+        '''
+        Return True if the arrival estimate should be sent. The previously
+        sent estimate is counted down by the time elapsed since, so a steady
+        estimate is not resent every tick.
+        '''
+        now = self.clock()
+
+        def changed(last):
+            last_index, last_remaining = last
+            if path_index != last_index:
+                return True
+            expected = max(0.0, last_remaining - (now - self._last['arrival'][1]))
+            return abs(remaining - expected) >= self.arrival_tolerance
+        return self._check('arrival', (path_index, remaining), changed, now)
+
+    def reset(self, *kinds):
+        ''' Forget what was sent of kinds, by default all, so the next
+            updates of them go through'''
+        for kind in kinds or self.KINDS:
+            self._last.pop(kind, None)
+
+    def stats(self):
+        return {'sent': dict(self.sent), 'suppressed': dict(self.suppressed)}
+
+    def _check(self, kind, value, changed, now=None):
+        if now is None:
+            now = self.clock()
+        last = self._last.get(kind)
+        if (last is None or now - last[1] >= self.keep_alive or
+                changed(last[0])):
+            self._last[kind] = (value, now)
+            self.sent[kind] += 1
+            return True
+        self.suppressed[kind] += 1
+        return False
@@ -0,0 +1,103 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+'''
+    Watches a robot on its way to a goal, so that a lost "complete" event
+    or a robot that silently gave up does not leave the path task waiting
+    forever. Each goal gets a time budget from the expected travel time,
+    and the robot must keep making progress towards the goal.
+'''
+
+import enum
+import time
+
+
+class Verdict(enum.IntEnum):
+    OK = 0
+    # At the goal, although the robot never reported it
+    ARRIVED = 1
+    # No progress, or no position from the robot, for too long
+    STALLED = 2
+    # Took much longer than the travel time expected from the path
+    OVERDUE = 3
+
+
+class NavigationWatchdog:
+
+    def __init__(self,
+                 budget_factor=2.0,
+                 slack=10.0,
+                 stall_timeout=15.0,
+                 progress_tolerance=0.1,
+                 arrival_tolerance=0.3,
+                 clock=time.monotonic):
+        '''
+        A goal expected to take t seconds is overdue after
+        budget_factor * t + slack seconds. It is stalled when the distance
+        to the goal has not shrunk by progress_tolerance meters, nor the
+        robot's remaining duration gone down, in stall_timeout seconds. The
+        robot has arrived once it is within arrival_tolerance meters of the
+        goal. These are the keys accepted in the navigation_watchdog
+        section of a robot_config.
+        '''
+        self.budget_factor = budget_factor
+        self.slack = slack
+        self.stall_timeout = stall_timeout
+        self.progress_tolerance = progress_tolerance
+        self.arrival_tolerance = arrival_tolerance
+        self.clock = clock
+        self.start(0.0)
+
+    def start(self, expected_duration):
+        ''' Start watching a new goal'''
+        now = self.clock()
+        self._start = now
+        self._expected = expected_duration
+        self._deadline = now + self.budget_factor * expected_duration + self.slack
+        self._last_progress = now
+        self._best_distance = None
+        self._last_remaining = None
+
+    def elapsed(self):
+        return self.clock() - self._start
+
+    def check(self, distance, position_stamp, remaining_duration=None):
+        '''
+        distance is between the robot and the goal, position_stamp the
+        time.monotonic() stamp of the position it is measured from and
+        remaining_duration the robot's own estimate, if any.
+        '''
+        now = self.clock()
+        # Only trust the distance once the robot should have finished
+        # turning and settling, and the position is newer than the goal
+        fresh = position_stamp is not None and position_stamp >= self._start
+        if fresh and distance <= self.arrival_tolerance and \
+                now - self._start >= self._expected:
+            return Verdict.ARRIVED
+        if self._best_distance is None or \
+                distance < self._best_distance - self.progress_tolerance:
+            self._best_distance = distance
+            self._last_progress = now
+        if remaining_duration is not None:
+            if self._last_remaining is not None and \
+                    remaining_duration < self._last_remaining:
+                self._last_progress = now
+            self._last_remaining = remaining_duration
+        if now > self._deadline:
+            return Verdict.OVERDUE
+        stale = position_stamp is None or now - position_stamp > self.stall_timeout
+        if now - self._last_progress > self.stall_timeout or \
+                (stale and now - self._start > self.stall_timeout):
+            return Verdict.STALLED
+        return Verdict.OK
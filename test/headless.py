@@ -0,0 +1,471 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Headless backend for running RobotCommandHandle without ROS 2 or RMF.
+
+install() puts minimal rclpy and rmf_adapter modules into sys.modules, so
+TemiCommandHandle can be imported. The node clock runs faster than real
+time, so waits at waypoints take a fraction of their nominal duration.
+FakeTemiAPI stands in for TemiAPI and moves the robot to each goal after a
+fixed delay.
+"""
+
+import importlib.util
+import math
+import sys
+import threading
+import time
+import types
+
+from contextlib import nullcontext
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+from temi_fleet_adapter_v2.maps import MapLoader
+
+
+class Duration:
+
+    def __init__(self, seconds=0, nanoseconds=0):
+        self.nanoseconds = int(seconds * 1e9 + nanoseconds)
+
+
+class Time:
+
+    def __init__(self, nanoseconds):
+        self.nanoseconds = int(nanoseconds)
+
+    def __add__(self, duration):
+        return Time(self.nanoseconds + duration.nanoseconds)
+
+    def __le__(self, other):
+        return self.nanoseconds <= other.nanoseconds
+
+    def __lt__(self, other):
+        return self.nanoseconds < other.nanoseconds
+
+
+class RobotCommandHandle:
+    """Stand-in for rmf_adapter.RobotCommandHandle."""
+
+    def __init__(self):
+        pass
+
+
+def _missing(name):
+    """True if name is neither imported nor importable."""
+    return name not in sys.modules and importlib.util.find_spec(name) is None
+
+
+def install():
+    """Register stub rclpy and rmf_adapter modules unless installed."""
+    if _missing('rclpy'):
+        rclpy = types.ModuleType('rclpy')
+        duration = types.ModuleType('rclpy.duration')
+        duration.Duration = Duration
+        rclpy.duration = duration
+        sys.modules['rclpy'] = rclpy
+        sys.modules['rclpy.duration'] = duration
+    if _missing('rmf_adapter'):
+        adpt = types.ModuleType('rmf_adapter')
+        adpt.RobotCommandHandle = RobotCommandHandle
+        sys.modules['rmf_adapter'] = adpt
+
+
+class Clock:
+    """Node clock running speed times faster than time.monotonic().
+
+    RMF times are datetimes, or with steady=True timedeltas since the start
+    of the clock, like rmf_traffic's steady clock time points.
+    """
+
+    def __init__(self, speed=1.0, steady=False):
+        self.speed = speed
+        self.steady = steady
+        self._start = time.monotonic()
+        self._epoch = time.time()
+
+    def seconds(self):
+        return self._epoch + (time.monotonic() - self._start) * self.speed
+
+    def now(self):
+        return Time(self.seconds() * 1e9)
+
+    def rmf_time(self, offset=0.0):
+        """RMF time offset seconds from now."""
+        if self.steady:
+            return timedelta(seconds=self.seconds() - self._epoch + offset)
+        return datetime.fromtimestamp(self.seconds() + offset)
+
+
+class Logger:
+
+    def __init__(self):
+        self.messages = []
+
+    def _log(self, level, message):
+        self.messages.append((level, message))
+
+    def debug(self, message):
+        self._log('debug', message)
+
+    def info(self, message):
+        self._log('info', message)
+
+    def warn(self, message):
+        self._log('warn', message)
+
+    def error(self, message):
+        self._log('error', message)
+
+
+class Node:
+
+    def __init__(self, clock):
+        self.clock = clock
+        self.logger = Logger()
+
+    def get_clock(self):
+        return self.clock
+
+    def get_logger(self):
+        return self.logger
+
+    def create_timer(self, period, callback):
+        raise AssertionError('The harness drives update() itself')
+
+
+class Adapter:
+
+    def __init__(self, clock):
+        self.clock = clock
+
+    def now(self):
+        return self.clock.rmf_time()
+
+
+class Graph:
+    """Navigation graph from named [x, y] locations and lanes."""
+
+    def __init__(self, locations, lanes, levels=None):
+        # levels maps waypoint names to their map, L1 by default
+        self.names = list(locations)
+        levels = levels or {}
+        self.waypoints = [
+            SimpleNamespace(
+                index=i, location=list(locations[name]), waypoint_name=name,
+                map_name=levels.get(name, 'L1'))
+            for i, name in enumerate(self.names)]
+        self.lanes = [
+            SimpleNamespace(
+                index=i,
+                entry=SimpleNamespace(waypoint_index=self.names.index(entry)),
+                exit=SimpleNamespace(waypoint_index=self.names.index(exit)))
+            for i, (entry, exit) in enumerate(lanes)]
+
+    @property
+    def num_waypoints(self):
+        return len(self.waypoints)
+
+    def find_waypoint(self, name):
+        if name not in self.names:
+            return None
+        return self.waypoints[self.names.index(name)]
+
+    def get_waypoint(self, index):
+        return self.waypoints[index]
+
+    def get_lane(self, index):
+        return self.lanes[index]
+
+    def lane_from(self, entry, exit):
+        for lane in self.lanes:
+            if lane.entry.waypoint_index == entry and \
+                    lane.exit.waypoint_index == exit:
+                return lane
+        return None
+
+    def plan(self, names, clock, wait=0.0):
+        """Plan waypoints through the named waypoints.
+
+        The robot is due at each waypoint wait node clock seconds from now.
+        """
+        waypoints = []
+        previous = None
+        for name in names:
+            waypoint = self.find_waypoint(name)
+            lane = None if previous is None else \
+                self.lane_from(previous.index, waypoint.index)
+            x, y = waypoint.location
+            waypoints.append(SimpleNamespace(
+                position=[x, y, 0.0],
+                time=clock.rmf_time(wait),
+                graph_index=waypoint.index,
+                approach_lanes=[] if lane is None else [lane.index]))
+            previous = waypoint
+        return waypoints
+
+
+class UpdateHandle:
+    """Records every call made to it, with its time.monotonic() stamp."""
+
+    def __init__(self):
+        self.calls = []
+
+    def __getattr__(self, name):
+        def record(*args):
+            self.calls.append((name, args, time.monotonic()))
+        return record
+
+    def named(self, name):
+        return [call for call in self.calls if call[0] == name]
+
+
+class Identity:
+
+    def transform(self, point):
+        return list(point)
+
+
+class FakeTemiAPI:
+    """Stands in for TemiAPI for a single robot.
+
+    A goal completes travel_time real seconds after it was sent. Goto
+    events are delivered to listeners from a timer thread, like the MQTT
+    network thread would.
+    """
+
+    def __init__(self, position=(0.0, 0.0, 0.0), travel_time=0.05,
+                 map_load_time=0.05):
+        self.travel_time = travel_time
+        self.map_load_time = map_load_time
+        self.maps = MapLoader(self._load_map)
+        self.map_loads = []
+        self.map_load_poses = []
+        # whether a goal was still active when each map load started
+        self.map_load_moving = []
+        # [x, y, yaw in degrees] in the robot frame, as reported by Temi
+        self.position = [position[0], position[1], math.degrees(position[2])]
+        self.position_time = time.monotonic()
+        self.soc = 0.8
+        self.charging = False
+        self.status = 'complete'
+        self.location = 'home base'
+        self.reachable = True
+        # RMF waypoint name -> (name saved on the robot, [x, y, yaw])
+        self.saved_locations = {}
+        self.goals = []
+        self.stops = 0
+        self.listeners = []
+        self.version = 0
+        self._changed = threading.Condition()
+        self._timer = None
+
+    def _event(self, status, location):
+        with self._changed:
+            self.status = status
+            self.location = location
+            self.version += 1
+            self._changed.notify_all()
+        for listener in self.listeners:
+            listener(status, location)
+
+    def _arrive(self, pose, location):
+        self.position = [pose[0], pose[1], math.degrees(pose[2])]
+        self.position_time = time.monotonic()
+        if location == 'home base':
+            self.charging = True
+        self._event('complete', location)
+
+    def _go(self, pose, location):
+        if self._timer is not None:
+            self._timer.cancel()
+        self.goals.append((list(pose), location))
+        self._event('going', location)
+        self._timer = threading.Timer(
+            self.travel_time, self._arrive, (pose, location))
+        self._timer.daemon = True
+        self._timer.start()
+
+    def _load_map(self, map_name, pose):
+        self.map_load_moving.append(self.has_active_goal(None))
+        time.sleep(self.map_load_time)
+        self.map_loads.append(map_name)
+        self.map_load_poses.append(pose)
+        return True
+
+    def abort(self):
+        """Make the robot give up its current goal."""
+        if self._timer is not None:
+            self._timer.cancel()
+        self._event('abort', self.location)
+
+    # TemiAPI interface
+
+    def add_goto_listener(self, robot_name, callback):
+        self.listeners.append(callback)
+
+    def clock(self):
+        return time.monotonic()
+
+    def snapshot(self):
+        return nullcontext()
+
+    def wait_until_ready(self, robot_name, timeout=None):
+        return True
+
+    def getPosition(self, robot_name):
+        return list(self.position)
+
+    def position_stamp(self, robot_name):
+        return self.position_time
+
+    def position_trace(self, robot_name):
+        # Received, parsed and stored at the same time
+        return [self.position_time] * 3
+
+    def request_position(self, robot_name):
+        self.position_time = time.monotonic()
+
+    def battery_soc(self, robot_name):
+        return self.soc
+
+    def request_battery(self, robot_name):
+        pass
+
+    def navigate(self, robot_name, pose, map_name):
+        if map_name and not self.maps.ensure(map_name):
+            return False
+        self._go(pose, 'COORDINATES')
+        return True
+
+    def prepare_map(self, robot_name, map_name, pose=None):
+        self.maps.prefetch(map_name, pose)
+
+    def map_stats(self, robot_name):
+        return self.maps.stats()
+
+    def saved_location(self, robot_name, waypoint_name):
+        saved = self.saved_locations.get(waypoint_name)
+        return None if saved is None else saved[0]
+
+    def navigate_to_location(self, robot_name, location, map_name=None):
+        if map_name and not self.maps.ensure(map_name):
+            return False
+        for name, pose in self.saved_locations.values():
+            if name == location:
+                self._go(pose, location)
+                return True
+        return False
+
+    def dock(self, robot_name):
+        self.charging = False
+        self._go([0.0, 0.0, 0.0], 'home base')
+        return True
+
+    def stop(self, robot_name):
+        self.stops += 1
+        if self._timer is not None:
+            self._timer.cancel()
+        self.status = 'abort'
+        return True
+
+    def has_active_goal(self, robot_name):
+        return self.status not in ('complete', 'abort')
+
+    def goto_status(self, robot_name):
+        return self.status, self.location
+
+    def navigation_completed(self, robot_name):
+        return self.status == 'complete'
+
+    def navigation_remaining_duration(self, robot_name):
+        return 0.0
+
+    def docking_completed(self, robot_name):
+        return self.status == 'complete' and \
+            self.location == 'home base' and self.charging
+
+    def is_reachable(self, robot_name):
+        return self.reachable
+
+    def connection_health(self, robot_name):
+        return {'alive': self.reachable}
+
+    def telemetry_version(self, robot_name):
+        return self.version
+
+    def wait_for_update(self, robot_name, version, timeout=None):
+        with self._changed:
+            return self._changed.wait_for(
+                lambda: self.version != version, timeout)
+
+
+def make_handle(api, graph, clock, start='A', config=None, name='temi_1',
+                task_runner=None):
+    """Create a RobotCommandHandle on the headless backend."""
+    install()
+    from temi_fleet_adapter_v2.TemiCommandHandle import RobotCommandHandle
+
+    node = Node(clock)
+    start_waypoint = graph.find_waypoint(start)
+    traits = SimpleNamespace(
+        linear=SimpleNamespace(nominal_velocity=0.4, nominal_acceleration=0.2),
+        rotational=SimpleNamespace(
+            nominal_velocity=0.3, nominal_acceleration=0.35))
+    handle = RobotCommandHandle(
+        name=name,
+        fleet_name='Temi',
+        config=dict(config or {}),
+        node=node,
+        graph=graph,
+        vehicle_traits=traits,
+        transforms={
+            'rmf_to_robot': Identity(),
+            'robot_to_rmf': Identity(),
+            'orientation_offset': 0.0},
+        map_name='L1',
+        start=SimpleNamespace(lane=None, waypoint=start_waypoint.index),
+        position=start_waypoint.location + [0.0],
+        charger_waypoint=start,
+        update_frequency=10.0,
+        adapter=Adapter(clock),
+        api=api,
+        task_runner=task_runner,
+        update_timer=False)
+    handle.update_handle = UpdateHandle()
+    return handle
+
+
+class Ticker:
+    """Calls handle.update() periodically, like the fleet's update tick."""
+
+    def __init__(self, handle, period=0.02):
+        self.handle = handle
+        self.period = period
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop_event.wait(self.period):
+            self.handle.update()
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self._stop_event.set()
+        self._thread.join()
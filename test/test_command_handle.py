@@ -0,0 +1,292 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import threading
+import time
+
+import pytest
+
+from temi_fleet_adapter_v2.tasks import TaskRunner
+
+from .headless import Clock, FakeTemiAPI, Graph, make_handle, Ticker
+
+
+@pytest.fixture
+def graph():
+    return Graph(
+        {'A': [0.0, 0.0], 'B': [1.0, 0.0], 'C': [1.0, 1.0]},
+        [('A', 'B'), ('B', 'A'), ('B', 'C'), ('C', 'B')])
+
+
+@pytest.fixture
+def clock():
+    # Waits at waypoints pass 50 times faster than real time
+    return Clock(speed=50.0)
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+def follow(handle, names, clock, wait=0.0):
+    finished = threading.Event()
+    estimates = []
+    handle.follow_new_path(
+        handle.graph.plan(names, clock, wait),
+        lambda index, duration: estimates.append((index, duration)),
+        finished.set)
+    return finished, estimates
+
+
+def test_follow_new_path(graph, clock):
+    api = FakeTemiAPI()
+    handle = make_handle(api, graph, clock)
+    start = time.monotonic()
+    cpu = time.process_time()
+    with Ticker(handle):
+        finished, estimates = follow(handle, ['A', 'B', 'C'], clock, wait=5.0)
+        assert finished.wait(5.0)
+    wall = time.monotonic() - start
+    # Three goals of 50 ms plus 5 s of waiting at 50x
+    assert wall < 2.0
+    assert time.process_time() - cpu < 2.0 * wall
+    assert [goal[0][:2] for goal in api.goals] == [[0.0, 0.0], [1.0, 0.0], [1.0, 1.0]]
+    assert estimates
+    # The robot was idle, so no stop was sent before the path
+    assert api.stops == 0
+    # New positions reach RMF within an update tick. The first one was
+    # stored before the ticks started
+    assert handle.tracer.summary()['total']['count'] >= 2
+    last = handle.tracer.records(1)[0]
+    assert last['tick'] < 0.05 and last['rmf'] < 0.01
+    assert handle.tracking.on_waypoint == graph.find_waypoint('C').index
+
+
+def test_steady_clock_times():
+    # rmf_traffic times are steady clock time points, i.e. timedeltas
+    clock = Clock(speed=50.0, steady=True)
+    graph = Graph({'A': [0.0, 0.0], 'B': [1.0, 0.0]}, [('A', 'B')])
+    api = FakeTemiAPI()
+    handle = make_handle(api, graph, clock)
+    with Ticker(handle):
+        finished, _ = follow(handle, ['A', 'B'], clock, wait=5.0)
+        assert finished.wait(2.0)
+    assert len(api.goals) == 2
+
+
+def test_abort_is_retried_then_replanned(graph, clock):
+    api = FakeTemiAPI(travel_time=10.0)
+    handle = make_handle(api, graph, clock, config={'goto_retries': 1})
+    finished, _ = follow(handle, ['B'], clock)
+    assert wait_for(lambda: len(api.goals) == 1)
+    api.abort()
+    assert wait_for(lambda: len(api.goals) == 2), 'the aborted goal was not resent'
+    aborted = time.monotonic()
+    api.abort()
+    assert wait_for(lambda: handle.update_handle.named('replan')), \
+        'RMF was not asked to replan'
+    # Reacting to the event does not wait for an update tick
+    assert handle.update_handle.named('replan')[0][2] - aborted < 0.05
+    assert len(api.goals) == 2
+    assert not finished.is_set()
+
+
+def test_unreachable_robot_is_replanned(graph, clock):
+    api = FakeTemiAPI()
+    api.reachable = False
+    handle = make_handle(
+        api, graph, clock, config={'unreachable_timeout': 0.2})
+    finished, _ = follow(handle, ['A', 'B'], clock)
+    assert wait_for(lambda: handle.update_handle.named('replan')), \
+        'RMF was not told the robot is unreachable'
+    assert api.goals == []
+    assert not finished.is_set()
+
+
+def test_new_path_gets_its_first_estimate(graph, clock):
+    api = FakeTemiAPI(travel_time=10.0)
+    handle = make_handle(api, graph, clock)
+    _, first = follow(handle, ['B'], clock)
+    assert wait_for(lambda: first)
+    # A similar path with a new estimator is not held back by the filter
+    _, second = follow(handle, ['B'], clock)
+    assert wait_for(lambda: second, timeout=0.3)
+    assert handle.update_stats()['sent']['arrival'] >= 2
+    handle.task_runner.cancel(handle.name)
+
+
+def test_path_is_compiled_once(graph, clock):
+    api = FakeTemiAPI(travel_time=10.0)
+    handle = make_handle(api, graph, clock)
+    waypoints = graph.plan(['A', 'B', 'C'], clock, wait=5.0)
+    path = handle.compile_path(handle.get_remaining_waypoints(waypoints))
+    assert path.check(graph.num_waypoints) == []
+    assert path.goals.shape == (3, 3)
+    assert path.segment_lengths.tolist() == [0.0, 1.0, 1.0]
+    assert path.graph_indices.tolist() == [0, 1, 2]
+    assert path.remaining_cost(0) > path.remaining_cost(1) > 0.0
+    follow(handle, ['A', 'B', 'C'], clock)
+    assert wait_for(lambda: handle.path is not None)
+    # The same plan sent again reuses the compiled path
+    again = handle.compile_path(
+        handle.get_remaining_waypoints(list(handle.path.waypoints)))
+    assert again is handle.path
+    handle.task_runner.cancel(handle.name)
+
+
+def test_map_is_only_loaded_on_level_change(clock):
+    graph = Graph(
+        # The L2 map is offset from the L1 map by 10 m
+        {'A': [0.0, 0.0], 'B': [1.0, 0.0], 'lift': [1.0, 1.0],
+         'lift_2': [11.0, 1.0], 'D': [10.0, 1.0]},
+        [('A', 'B'), ('B', 'lift'), ('lift', 'lift_2'), ('lift_2', 'D')],
+        levels={'lift_2': 'L2', 'D': 'L2'})
+    api = FakeTemiAPI(map_load_time=0.1)
+    handle = make_handle(api, graph, clock)
+    with Ticker(handle):
+        # The lift ride takes 25 s at the lift waypoint, 0.5 s at 50x
+        waypoints = graph.plan(['A', 'B', 'lift', 'lift_2', 'D'], clock)
+        waypoints[2].time = waypoints[3].time = clock.rmf_time(25.0)
+        finished = threading.Event()
+        handle.follow_new_path(waypoints, lambda *args: None, finished.set)
+        assert finished.wait(5.0)
+    stats = api.map_stats(handle.name)
+    assert api.map_loads == ['L2']
+    # The robot is placed at the lift on L2, not where it was on L1
+    assert api.map_load_poses == [[11.0, 1.0, 0.0]]
+    assert stats['loads'] == 1 and stats['skipped'] >= 3
+    assert stats['last_latency'] >= 0.1
+    # Loaded during the lift ride, so the goal on L2 did not wait for it
+    assert stats['blocked'] < 0.05
+    assert handle.map_name == 'L2'
+
+
+def test_map_is_loaded_after_previous_path_stopped(clock):
+    graph = Graph(
+        {'A': [0.0, 0.0], 'B': [1.0, 0.0], 'lift_2': [11.0, 1.0],
+         'D': [10.0, 1.0]},
+        [('A', 'B'), ('lift_2', 'D')], levels={'lift_2': 'L2', 'D': 'L2'})
+    api = FakeTemiAPI(travel_time=1.0)
+    handle = make_handle(api, graph, clock)
+    with Ticker(handle):
+        follow(handle, ['A', 'B'], clock)
+        assert wait_for(lambda: api.goals)
+        finished, _ = follow(handle, ['lift_2', 'D'], clock)
+        assert wait_for(lambda: api.map_loads)
+        handle.task_runner.cancel(handle.name)
+    # Loading the L2 map resets the pose, so the robot must not be driving
+    # the old path on L1 by then
+    assert api.map_load_moving == [False]
+    assert api.stops >= 1
+
+
+def test_saved_location_is_sent_by_name(graph, clock):
+    api = FakeTemiAPI()
+    api.saved_locations['C'] = ('c corner', [1.0, 1.0, 0.0])
+    handle = make_handle(api, graph, clock)
+    with Ticker(handle):
+        finished, _ = follow(handle, ['A', 'B', 'C'], clock)
+        assert finished.wait(5.0)
+    # Only the final waypoint goes to the robot's own planner
+    assert [location for _, location in api.goals] == \
+        ['COORDINATES', 'COORDINATES', 'c corner']
+    assert handle.tracking.on_waypoint == graph.find_waypoint('C').index
+
+
+def test_dock_finishes_on_charging_event(graph, clock):
+    api = FakeTemiAPI(travel_time=0.05)
+    handle = make_handle(api, graph, clock)
+    docked = threading.Event()
+    start = time.monotonic()
+    handle.dock('A', docked.set)
+    assert docked.wait(2.0)
+    # Woken by the goto event rather than a polling interval
+    assert time.monotonic() - start < 0.05 + 0.1
+    assert api.goals[-1][1] == 'home base'
+    assert handle.tracking.on_waypoint == graph.find_waypoint('A').index
+
+
+def test_failed_dock_is_replanned(graph, clock):
+    api = FakeTemiAPI(travel_time=10.0)
+    handle = make_handle(api, graph, clock, config={'goto_retries': 0})
+    docked = threading.Event()
+    handle.dock('A', docked.set)
+    assert wait_for(lambda: handle.tracking.dock_waypoint_index is not None)
+    api.abort()
+    assert wait_for(lambda: handle.update_handle.named('replan')), \
+        'RMF was not told the dock failed'
+    assert handle.tracking.dock_waypoint_index is None
+    assert not docked.is_set()
+
+
+def test_docking_robot_does_not_hold_up_others(graph, clock):
+    task_runner = TaskRunner()
+    docking = FakeTemiAPI(travel_time=10.0)
+    moving = FakeTemiAPI()
+    handles = [make_handle(api, graph, clock, name=name, task_runner=task_runner)
+               for api, name in ((docking, 'temi_1'), (moving, 'temi_2'))]
+    handles[0].dock('A', lambda: None)
+    assert wait_for(lambda: docking.goals)
+    finished, _ = follow(handles[1], ['A', 'B'], clock)
+    assert finished.wait(2.0)
+    assert len(moving.goals) == 2
+    task_runner.shutdown()
+
+
+def test_shutdown_waits_for_cancelled_tasks():
+    task_runner = TaskRunner()
+    started, returned = threading.Event(), threading.Event()
+
+    def task(token):
+        started.set()
+        while not token.wait(0.01):
+            pass
+        time.sleep(0.05)
+        returned.set()
+
+    task_runner.replace('temi_1', task)
+    assert started.wait(2.0)
+    task_runner.shutdown()
+    assert returned.is_set()
+
+
+def test_update_state_only_sends_changes(graph, clock):
+    api = FakeTemiAPI()
+    handle = make_handle(api, graph, clock)
+    start = time.perf_counter()
+    for _ in range(1000):
+        handle.update()
+    elapsed = time.perf_counter() - start
+    calls = handle.update_handle
+    assert len(calls.named('update_current_waypoint')) == 1
+    assert len(calls.named('update_battery_soc')) == 1
+    assert len(calls.named('set_charger_waypoint')) == 1
+    # Unchanged state is cheap to check
+    assert elapsed / 1000 < 1e-3
+
+
+def test_update_tick_does_not_contend_with_path(graph, clock):
+    api = FakeTemiAPI()
+    handle = make_handle(api, graph, clock)
+    with Ticker(handle, period=0.001):
+        finished, _ = follow(handle, ['A', 'B', 'C', 'B', 'A'], clock)
+        assert finished.wait(5.0)
+    stats = handle.lock_stats()
+    for lock in stats.values():
+        assert lock['max_wait'] < 0.05
@@ -0,0 +1,52 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+import json
+from types import SimpleNamespace
+
+import temi_fleet_adapter_v2.robot as robot_module
+from temi_fleet_adapter_v2.robot import Robot
+
+
+class Client:
+    """MQTT client that answers commands if ack, else stays silent"""
+
+    def __init__(self, ack):
+        self.ack = ack
+        self.routes = {}
+        self.router = SimpleNamespace(route=self._route)
+        self.publisher = SimpleNamespace(publish=self._publish)
+
+    def _route(self, serial, topic, callback):
+        self.routes[topic] = callback
+
+    def _publish(self, serial, topic, payload, qos=0, priority=0):
+        request = json.loads(payload)
+        if self.ack and "responseTopic" in request:
+            msg = SimpleNamespace(payload=json.dumps(
+                {"requestId": request["requestId"]}).encode())
+            self.routes["responseTopic"](self, None, msg)
+
+
+def test_goal_reports_acknowledgement(monkeypatch):
+    monkeypatch.setattr(robot_module, "RESPONSE_TIMEOUT", 0.05)
+    assert Robot(Client(ack=True), "00119").goToPosition(1.0, 2.0, 0.0) is True
+    assert Robot(Client(ack=False), "00119").goToLocation("lobby") is False
+
+
+def test_stop_waits_for_acknowledgement(monkeypatch):
+    monkeypatch.setattr(robot_module, "RESPONSE_TIMEOUT", 0.05)
+    assert Robot(Client(ack=True), "00119").stop() is True
+    assert Robot(Client(ack=False), "00119").stop() is False
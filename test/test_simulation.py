@@ -0,0 +1,171 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import math
+import os
+import threading
+import time
+
+import pytest
+import yaml
+
+from temi_fleet_adapter_v2.simulation import SimulatedTemiAPI
+
+from .headless import Clock, Graph, make_handle, Ticker
+
+
+CONFIG = os.path.join(os.path.dirname(__file__), '..', 'configs', 'config.yaml')
+
+
+@pytest.fixture
+def fleet_config():
+    with open(CONFIG) as f:
+        return yaml.safe_load(f)['rmf_fleet']
+
+
+def wait_for(predicate, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+def test_robot_moves_within_limits(fleet_config):
+    api = SimulatedTemiAPI(
+        fleet_config, {'temi_1': [0.0, 0.0, 0.0]}, speed=200.0, step=0.05)
+    try:
+        estimate = api.navigation_remaining_duration('temi_1')
+        assert estimate == 0.0
+        start = api.now
+        assert api.navigate('temi_1', [2.0, 0.0, math.pi / 2], None)
+        estimate = api.navigation_remaining_duration('temi_1')
+        assert wait_for(lambda: api.navigation_completed('temi_1'))
+        elapsed = api.now - start
+        x, y, yaw = api.getPosition('temi_1')
+        assert (x, y) == (2.0, 0.0)
+        assert abs(yaw - 90.0) < 0.1
+        # 2 m at 0.4 m/s and 0.2 m/s^2, then a quarter turn, give or take
+        # the steps at the end of each phase
+        assert estimate == pytest.approx(13.1, abs=0.2)
+        assert elapsed == pytest.approx(estimate, abs=0.3)
+        # Ambient power all along plus rolling friction over 2 m
+        energy = 20.0 * elapsed + 0.2 * 80.0 * 9.81 * 2.0
+        assert 1.0 - api.battery_soc('temi_1') == \
+            pytest.approx(energy / (24.0 * 40.0 * 3600.0), rel=0.05)
+    finally:
+        api.shutdown()
+
+
+def test_dock_charges(fleet_config):
+    api = SimulatedTemiAPI(
+        fleet_config, {'temi_1': [1.0, 0.0, 0.0]},
+        {'temi_1': [0.0, 0.0, 180.0]}, speed=200.0, step=0.05)
+    events = []
+    api.add_goto_listener('temi_1', lambda *event: events.append(event))
+    try:
+        api.robots['temi_1'].soc = 0.5
+        assert api.navigate_to_location('temi_1', 'home base')
+        assert wait_for(lambda: api.docking_completed('temi_1'))
+        assert events == [('going', 'home base'), ('complete', 'home base')]
+        soc = api.battery_soc('temi_1')
+        assert wait_for(lambda: api.battery_soc('temi_1') > soc)
+    finally:
+        api.shutdown()
+
+
+def test_handle_follows_path(fleet_config):
+    graph = Graph(
+        {'A': [0.0, 0.0], 'B': [1.0, 0.0], 'C': [1.0, 1.0]},
+        [('A', 'B'), ('B', 'A'), ('B', 'C'), ('C', 'B')])
+    clock = Clock(speed=50.0)
+    api = SimulatedTemiAPI(
+        fleet_config, {'temi_1': [0.0, 0.0, 0.0]}, speed=50.0, step=0.05)
+    handle = make_handle(api, graph, clock)
+    finished = threading.Event()
+    try:
+        with Ticker(handle):
+            handle.follow_new_path(
+                graph.plan(['A', 'B', 'C'], clock), lambda *args: None,
+                finished.set)
+            assert finished.wait(5.0)
+        x, y, _ = api.getPosition('temi_1')
+        assert (x, y) == pytest.approx((1.0, 1.0), abs=0.05)
+    finally:
+        handle.task_runner.cancel(handle.name)
+        api.shutdown()
+
+
+def test_stamps_follow_simulated_time(fleet_config):
+    api = SimulatedTemiAPI(
+        fleet_config, {'temi_1': [0.0, 0.0, 0.0]}, speed=200.0, step=0.05,
+        start_time=1000.0)
+    try:
+        assert api.navigate('temi_1', [1.0, 0.0, 0.0], None)
+        start = time.monotonic()
+        assert wait_for(lambda: api.clock() > 1002.0)
+        # Two simulated seconds in a fraction of the real time
+        assert time.monotonic() - start < 1.0
+        now = api.clock()
+        assert api.position_stamp('temi_1') == pytest.approx(now, abs=0.2)
+        assert api.position_trace('temi_1') == (
+            (api.position_stamp('temi_1'),) * 3)
+        assert 0.0 <= api.battery_age('temi_1') < 0.2
+    finally:
+        api.shutdown()
+
+
+def test_saved_location(fleet_config):
+    api = SimulatedTemiAPI(
+        fleet_config, {'temi_1': [0.0, 0.0, 0.0]}, speed=200.0, step=0.05,
+        locations={'Pantry': [1.0, 0.0, 90.0]})
+    events = []
+    api.add_goto_listener('temi_1', lambda *event: events.append(event))
+    try:
+        location = api.saved_location('temi_1', 'pantry')
+        assert location == 'Pantry'
+        assert not api.navigate_to_location('temi_1', 'lobby')
+        assert api.navigate_to_location('temi_1', location)
+        assert wait_for(lambda: api.navigation_completed('temi_1'))
+        assert events == [('going', 'Pantry'), ('complete', 'Pantry')]
+        x, y, yaw = api.getPosition('temi_1')
+        assert (x, y) == (1.0, 0.0)
+        assert abs(yaw - 90.0) < 0.1
+    finally:
+        api.shutdown()
+
+
+def test_wait_for_update_timeout_is_simulated(fleet_config):
+    api = SimulatedTemiAPI(
+        fleet_config, {'temi_1': [0.0, 0.0, 0.0]}, speed=100.0, step=100.0)
+    try:
+        # No step for a real second, so only the timeout ends the wait
+        start = time.monotonic()
+        api.wait_for_update('temi_1', api.telemetry_version('temi_1'), 10.0)
+        assert time.monotonic() - start < 0.5
+    finally:
+        api.shutdown()
+
+
+def test_teleop_is_accepted(fleet_config):
+    api = SimulatedTemiAPI(
+        fleet_config, {'temi_1': [0.0, 0.0, 0.0]}, speed=200.0, step=0.05)
+    try:
+        assert api.teleop('temi_1', x=0.0, y=0.5, tilt=10)
+        api.teleop_release('temi_1')
+        stats = api.teleop_stats('temi_1')
+        assert stats['submitted'] == stats['sent'] == 2
+    finally:
+        api.shutdown()
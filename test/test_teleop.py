@@ -0,0 +1,69 @@
+# Copyright 2021 Open Source Robotics Foundation, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import time
+
+from temi_fleet_adapter_v2.teleop import JOYSTICK, ROTATE, TeleopStream
+
+
+class Recorder:
+
+    def __init__(self):
+        self.messages = []
+
+    def __call__(self, command, payload, qos):
+        self.messages.append((time.monotonic(), command, json.loads(payload)))
+
+    def commands(self, command):
+        return [fields for _, c, fields in self.messages if c == command]
+
+
+def test_flood_is_paced_and_coalesced():
+    send = Recorder()
+    stream = TeleopStream(send, period=0.05, deadman=0.2)
+    start = time.monotonic()
+    # 1000 setpoints per second for 0.3 s
+    while time.monotonic() - start < 0.3:
+        stream.joystick(0.5, 0.0)
+        stream.rotate(10)
+        time.sleep(0.001)
+    stream.release()
+    time.sleep(0.15)
+    stamps = [stamp for stamp, command, _ in send.messages if command == JOYSTICK]
+    # One joystick message per period, instead of one per setpoint
+    assert len(stamps) <= 0.35 / 0.05 + 2
+    assert min(b - a for a, b in zip(stamps, stamps[1:])) > 0.04
+    assert 0 < len(send.commands(ROTATE)) < len(stamps)
+    assert send.commands(JOYSTICK)[-1] == {"x": 0, "y": 0}
+    stats = stream.stats()
+    assert stats['sent'] == len(send.messages)
+    assert stats['coalesced'] > stats['submitted'] / 2
+    assert stats['max_lag'] <= 0.06
+    assert not stats['active']
+
+
+def test_deadman_zeroes_joystick():
+    send = Recorder()
+    stream = TeleopStream(send, period=0.02, deadman=0.1)
+    stream.joystick(0.0, 1.0)
+    time.sleep(0.3)
+    # The operator went away: the robot was stopped once and the stream
+    # went quiet
+    assert send.commands(JOYSTICK)[-1] == {"x": 0, "y": 0}
+    assert stream.stats()['deadman_stops'] == 1
+    assert not stream.active
+    count = len(send.messages)
+    time.sleep(0.1)
+    assert len(send.messages) == count